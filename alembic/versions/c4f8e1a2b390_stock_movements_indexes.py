@@ -0,0 +1,48 @@
+"""stock movements indexes
+
+Revision ID: c4f8e1a2b390
+Revises: b51f0c9e7d24
+Create Date: 2026-10-20 10:12:41.318204
+
+"""
+
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = "c4f8e1a2b390"
+down_revision: Union[str, None] = "b51f0c9e7d24"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.drop_index(op.f("ix_stock_movements_compacted"), table_name="stock_movements")
+    op.create_index(
+        op.f("ix_stock_movements_order_id"),
+        "stock_movements",
+        ["order_id"],
+        unique=False,
+    )
+    # Matches the availability subquery, over the movements not compacted yet only.
+    op.create_index(
+        "ix_stock_movements_pending",
+        "stock_movements",
+        ["icecream_id"],
+        unique=False,
+        postgresql_where=sa.text("compacted IS false"),
+    )
+
+
+def downgrade() -> None:
+    op.drop_index("ix_stock_movements_pending", table_name="stock_movements")
+    op.drop_index(op.f("ix_stock_movements_order_id"), table_name="stock_movements")
+    op.create_index(
+        op.f("ix_stock_movements_compacted"),
+        "stock_movements",
+        ["compacted"],
+        unique=False,
+    )
@@ -1,6 +1,14 @@
 from fastapi import APIRouter
 
-from deep_ice.api.routes import auth, cart, icecream, orders, payments
+from deep_ice.api.routes import (
+    auth,
+    cart,
+    icecream,
+    orders,
+    payments,
+    profiling,
+    stats,
+)
 
 api_router = APIRouter()
 api_router.include_router(auth.router, prefix="/auth", tags=["auth"])
@@ -8,3 +16,5 @@ api_router.include_router(cart.router, prefix="/cart", tags=["cart"])
 api_router.include_router(icecream.router, prefix="/icecream", tags=["icecream"])
 api_router.include_router(orders.router, prefix="/orders", tags=["orders"])
 api_router.include_router(payments.router, prefix="/payments", tags=["payments"])
+api_router.include_router(stats.router, prefix="/stats", tags=["stats"])
+api_router.include_router(profiling.router, prefix="/profiling", tags=["profiling"])
@@ -3,7 +3,9 @@ from typing import Annotated, cast
 from fastapi import APIRouter, Body, HTTPException, Response, status
 from sqlalchemy.exc import IntegrityError
 
+from deep_ice.core.config import settings
 from deep_ice.core.dependencies import CartServiceDep, CurrentUserDep, SessionDep
+from deep_ice.core.serialization import FastJSONResponse, serialize_cart
 from deep_ice.models import (
     Cart,
     CartItem,
@@ -40,6 +42,8 @@ async def obtain_icecream(session, cart_item: CartItem) -> IceCream:
 @router.get("", response_model=RetrieveCart)
 async def get_cart_items(current_user: CurrentUserDep, cart_service: CartServiceDep):
     cart = await cart_service.ensure_cart(cast(int, current_user.id))
+    if settings.FAST_JSON:
+        return FastJSONResponse(serialize_cart(cart))
     return cart
 
 
@@ -0,0 +1,16 @@
+from fastapi import APIRouter, HTTPException, Request, status
+
+router = APIRouter()
+
+
+@router.get("/ready", include_in_schema=False)
+async def get_readiness(request: Request):
+    """Ready for traffic only after the worker warmed up its connections and queries."""
+    if not getattr(request.app.state, "ready", False):
+        error = getattr(request.app.state, "warm_up_error", None)
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail=f"Warm-up failed: {error}" if error else "Warming up",
+        )
+
+    return {"status": "ready"}
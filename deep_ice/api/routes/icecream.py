@@ -1,11 +1,22 @@
 from fastapi import APIRouter
+from sqlmodel.ext.asyncio.session import AsyncSession
 
+from deep_ice.core.config import settings
 from deep_ice.core.dependencies import SessionDep
-from deep_ice.models import IceCream, RetrieveIceCream
+from deep_ice.core.serialization import FastJSONResponse, serialize_icecream
+from deep_ice.models import RetrieveIceCream
+from deep_ice.read_models import fetch_catalog
 
 router = APIRouter()
 
 
+async def get_catalog(session: AsyncSession) -> list[dict]:
+    return [serialize_icecream(icecream) for icecream in await fetch_catalog(session)]
+
+
 @router.get("", response_model=list[RetrieveIceCream])
 async def get_icecream(session: SessionDep):
-    return (await IceCream.fetch(session)).all()
+    catalog = await get_catalog(session)
+    if settings.FAST_JSON:
+        return FastJSONResponse(catalog)
+    return catalog
@@ -0,0 +1,55 @@
+import redis.asyncio as aioredis
+from arq.constants import default_queue_name
+from fastapi import APIRouter, HTTPException, Request, status
+from fastapi.responses import PlainTextResponse
+from redis.exceptions import RedisError
+
+from deep_ice.core import logger
+from deep_ice.core.database import get_engine
+from deep_ice.core.metrics import Gauge, registry
+from deep_ice.services.outbox import OutboxDispatcher
+
+router = APIRouter()
+
+# Read at scrape time, so it's the pool of the process answering the scrape.
+DB_POOL = Gauge(
+    "db_pool_connections", "Database pool connections by state.", ("state",)
+)
+QUEUE_DEPTH = Gauge("arq_queue_depth", "Jobs waiting in the task queue.")
+OUTBOX_LAG = Gauge(
+    "outbox_lag_seconds", "Age of the oldest event in the last dispatched batch."
+)
+OUTBOX_DISPATCHED = Gauge("outbox_dispatched_events", "Events dispatched so far.")
+
+
+@registry.add_collector
+async def collect_db_pool(redis: aioredis.Redis) -> list[str]:
+    pool = get_engine().pool
+    # Not every pool class keeps track of its connections.
+    for state in ("size", "checkedin", "checkedout", "overflow"):
+        if counter := getattr(pool, state, None):
+            DB_POOL.set(counter(), state=state)
+    return DB_POOL.render()
+
+
+@registry.add_collector
+async def collect_queue(redis: aioredis.Redis) -> list[str]:
+    QUEUE_DEPTH.set(await redis.zcard(default_queue_name))
+    stats = await redis.hgetall(OutboxDispatcher.STATS_KEY)  # type: ignore[misc]
+    OUTBOX_LAG.set(float(stats.get(b"lag_seconds", 0)))
+    OUTBOX_DISPATCHED.set(float(stats.get(b"dispatched", 0)))
+    return QUEUE_DEPTH.render() + OUTBOX_LAG.render() + OUTBOX_DISPATCHED.render()
+
+
+@router.get("/metrics", response_class=PlainTextResponse, include_in_schema=False)
+async def get_metrics(request: Request):
+    try:
+        content = await registry.render(request.app.state.redis_pool)
+    except RedisError as exc:
+        logger.exception("Metrics error: %s", exc)
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Metrics unavailable",
+        )
+
+    return PlainTextResponse(content, media_type="text/plain; version=0.0.4")
@@ -1,22 +1,19 @@
+from typing import cast
+
 from fastapi import APIRouter
 
+from deep_ice.core.config import settings
 from deep_ice.core.dependencies import CurrentUserDep, SessionDep
-from deep_ice.models import Order, OrderItem, RetrieveOrder
+from deep_ice.core.serialization import FastJSONResponse, serialize_order
+from deep_ice.models import RetrieveOrder
+from deep_ice.read_models import fetch_orders
 
 router = APIRouter()
 
 
 @router.get("", response_model=list[RetrieveOrder])
 async def get_orders(session: SessionDep, current_user: CurrentUserDep):
-    orders = (
-        (
-            await Order.fetch(
-                session,
-                filters=[Order.user_id == current_user.id],
-                joinedloads=[Order.items, OrderItem.icecream],
-            )
-        )
-        .unique()
-        .all()
-    )
+    orders = await fetch_orders(session, user_id=cast(int, current_user.id))
+    if settings.FAST_JSON:
+        return FastJSONResponse([serialize_order(order) for order in orders])
     return orders
@@ -1,60 +1,97 @@
 from typing import Annotated, cast
 
-import sentry_sdk
-from aioredlock import LockError
-from fastapi import APIRouter, Body, HTTPException, Request, Response, status
-from fastapi.responses import RedirectResponse
-from sqlalchemy.exc import SQLAlchemyError
-from sqlmodel.ext.asyncio.session import AsyncSession
-
-from deep_ice.core import logger
+from arq.constants import in_progress_key_prefix
+from arq.jobs import Job, JobResult
+from fastapi import APIRouter, Body, Header, HTTPException, Request, Response, status
+from fastapi.responses import JSONResponse, RedirectResponse
+from pydantic import ValidationError
+from sqlalchemy.exc import NoResultFound
+
+from deep_ice.core import logger, security
+from deep_ice.core.config import settings
 from deep_ice.core.dependencies import (
+    AdmissionServiceDep,
     CartServiceDep,
     CurrentUserDep,
     RedlockDep,
     SessionDep,
 )
-from deep_ice.models import Cart, Payment, PaymentMethod, PaymentStatus, RetrievePayment
+from deep_ice.core.metrics import FLASH_SALE_ADMISSIONS
+from deep_ice.core.serialization import FastJSONResponse, serialize_payment
+from deep_ice.core.timing import timed
+from deep_ice.models import (
+    Cart,
+    CheckoutStatus,
+    PaymentCallback,
+    PaymentMethod,
+    PaymentStatus,
+    RetrieveCheckout,
+    RetrievePayment,
+)
+from deep_ice.services.admission import AdmissionService, AdmissionStatus
+from deep_ice.services.checkout import (
+    CheckoutError,
+    CheckoutService,
+    StockChangedError,
+    checkout_task,
+    get_checkout_id,
+    get_checkout_queue,
+)
 from deep_ice.services.order import OrderService
-from deep_ice.services.payment import PaymentError, PaymentService, payment_stub
-from deep_ice.services.stats import stats_service
+from deep_ice.services.payment import PaymentService, get_payment_stub
 
 router = APIRouter()
 
+QUEUE_POSITION_HEADER = "X-Queue-Position"
 
-async def _make_payment(
-    session: AsyncSession, *, cart: Cart, method: PaymentMethod, response: Response
-) -> Payment:
-    # Items are available and ready to be sold, make the order and pay for it.
-    order_service = OrderService(session, stats_service=stats_service)
-    payment_service = PaymentService(
-        session, order_service=order_service, payment_processor=payment_stub
-    )
-    order = None
-    try:
-        order = await order_service.make_order_from_cart(cart)
-        payment = await payment_service.make_payment_from_order(order, method=method)
-        # With a payment triggered over a successfully created order, we can safely
-        #  delete the cart and all its contents.
-        await session.delete(cart)
-    except (SQLAlchemyError, PaymentError) as exc:
-        logger.exception("Payment error: %s", exc)
-        sentry_sdk.capture_exception(exc)
-        await session.rollback()
-        if order:
-            await session.delete(order)
-            await session.commit()
+
+async def _admit(
+    admission_service: AdmissionService, *, cart: Cart, user_id: int
+) -> dict[int, int]:
+    # Carts which can't be served or have to wait are turned away before any
+    #  locking, while the flavors which aren't on sale are let through anyway.
+    quantities = {item.icecream_id: item.quantity for item in cart.items}
+    with timed("admission"):
+        admission = await admission_service.admit(user_id, quantities)
+    FLASH_SALE_ADMISSIONS.inc(outcome=admission.status.value)
+    if admission.status is AdmissionStatus.SOLD_OUT:
         raise HTTPException(
-            status_code=status.HTTP_400_BAD_REQUEST, detail="Payment failed"
+            status_code=status.HTTP_409_CONFLICT,
+            detail="Not enough stock left in the flash sale",
+        )
+    if admission.status is AdmissionStatus.WAITING:
+        raise HTTPException(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail=f"Waiting for checkout, at position {admission.position}",
+            headers={
+                "Retry-After": str(settings.WAITING_ROOM_RETRY_AFTER),
+                QUEUE_POSITION_HEADER: str(admission.position),
+            },
         )
+    return quantities
 
-    await session.commit()
-    response.status_code = (
-        status.HTTP_202_ACCEPTED
-        if payment.status == PaymentStatus.PENDING
-        else status.HTTP_201_CREATED
+
+async def _enqueue_checkout(
+    request: Request, *, cart: Cart, user_id: int, method: PaymentMethod
+) -> JSONResponse:
+    checkout_id = get_checkout_id()
+    with timed("enqueue"):
+        await request.app.state.redis_pool.enqueue_job(
+            checkout_task.__name__,
+            user_id=user_id,
+            method=method,
+            icecream_ids=[item.icecream_id for item in cart.items],
+            _job_id=checkout_id,
+            _queue_name=get_checkout_queue(cart),
+        )
+    checkout = RetrieveCheckout(id=checkout_id, status=CheckoutStatus.QUEUED)
+    return JSONResponse(
+        checkout.model_dump(mode="json"),
+        status_code=status.HTTP_202_ACCEPTED,
+        headers={
+            "Location": str(request.url_for("get_checkout", checkout_id=checkout_id))
+        },
     )
-    return payment
 
 
 @router.post("", response_model=RetrievePayment)
@@ -63,42 +100,129 @@ async def make_payment(
     current_user: CurrentUserDep,
     cart_service: CartServiceDep,
     redlock: RedlockDep,
+    admission_service: AdmissionServiceDep,
     method: Annotated[PaymentMethod, Body(embed=True)],
     request: Request,
     response: Response,
 ):
-    cart = await cart_service.get_cart(cast(int, current_user.id))
+    user_id = cast(int, current_user.id)
+    cart = await cart_service.get_cart(user_id)
     if not cart or not cart.items:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="There are no items in the cart",
         )
 
-    lock_keys = [f"ice-lock:{item.icecream_id}" for item in cart.items]
-    locks = []
+    quantities = await _admit(admission_service, cart=cart, user_id=user_id)
+    if settings.ASYNC_CHECKOUT:
+        # The checkout job frees the admission place instead, once done.
+        return await _enqueue_checkout(
+            request, cart=cart, user_id=user_id, method=method
+        )
+
+    payment = None
     try:
-        for lock_key in lock_keys:
-            lock = await redlock.lock(lock_key)
-            locks.append(lock)
-
-            cart_ok = await cart_service.check_items_against_stock(cart)
-            if not cart_ok:
-                # Redirect back to the cart so we get aware of the new state based on
-                #  the available stock. And let the user decide if it continues with a
-                #  payment.
-                return RedirectResponse(url=request.url_for("get_cart_items"))
-
-            return await _make_payment(
-                session, cart=cart, method=method, response=response
-            )
-    except LockError as exc:
-        logger.exception("Payment lock error with key %r: %s", lock_key, exc)
-        sentry_sdk.capture_exception(exc)
+        checkout_service = CheckoutService(
+            session,
+            cart_service=cart_service,
+            redlock=redlock,
+            redis=request.app.state.redis_pool,
+        )
+        payment = await checkout_service.checkout(cart, method=method)
+    except StockChangedError:
+        # Redirect back to the cart so we get aware of the new state based on the
+        #  available stock. And let the user decide if it continues with a payment.
+        return RedirectResponse(url=request.url_for("get_cart_items"))
+    except CheckoutError:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST, detail="Payment failed"
+        )
     finally:
-        for lock in locks:
-            await redlock.unlock(lock)
+        # The next in line gets the place, along with the tokens left unsold.
+        await admission_service.leave(
+            user_id, list(quantities), sold=payment is not None
+        )
+
+    if payment:
+        response.status_code = (
+            status.HTTP_202_ACCEPTED
+            if payment.status == PaymentStatus.PENDING
+            else status.HTTP_201_CREATED
+        )
+    return payment
+
+
+@router.get("/checkouts/{checkout_id}", response_model=RetrieveCheckout)
+async def get_checkout(
+    current_user: CurrentUserDep, checkout_id: str, request: Request
+):
+    """Status of a queued checkout, along with its payment once completed."""
+    redis = request.app.state.redis_pool
+    job = Job(checkout_id, redis)
+    job_info = await job.result_info() or await job.info()
+    if not job_info or job_info.kwargs.get("user_id") != current_user.id:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND, detail="Checkout does not exist"
+        )
+
+    if isinstance(job_info, JobResult):
+        if not job_info.success:
+            return RetrieveCheckout(
+                id=checkout_id, status=CheckoutStatus.FAILED, detail="Checkout failed"
+            )
+        return RetrieveCheckout(id=checkout_id, **job_info.result)
+
+    checkout_status = (
+        CheckoutStatus.IN_PROGRESS
+        if await redis.exists(in_progress_key_prefix + checkout_id)
+        else CheckoutStatus.QUEUED
+    )
+    return RetrieveCheckout(id=checkout_id, status=checkout_status)
 
 
 @router.get("", response_model=list[RetrievePayment])
 async def get_payments(current_user: CurrentUserDep):
-    return await current_user.awaitable_attrs.payments
+    payments = await current_user.awaitable_attrs.payments
+    if settings.FAST_JSON:
+        return FastJSONResponse([serialize_payment(payment) for payment in payments])
+    return payments
+
+
+@router.post("/callback", status_code=status.HTTP_204_NO_CONTENT)
+async def payment_callback(
+    session: SessionDep,
+    signature: Annotated[str, Header(alias=security.SIGNATURE_HEADER)],
+    request: Request,
+):
+    """Webhook called by the payment gateway once a submitted payment is processed."""
+    payload = await request.body()
+    if not security.verify_signature(payload, signature):
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid signature"
+        )
+    try:
+        callback = PaymentCallback.model_validate_json(payload)
+    except ValidationError as exc:
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail=exc.errors()
+        )
+    if callback.status is PaymentStatus.PENDING:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Payment is still being processed",
+        )
+
+    order_service = OrderService(session)
+    payment_service = PaymentService(
+        session, order_service=order_service, payment_processor=get_payment_stub()
+    )
+    try:
+        await payment_service.apply_payment_status(callback.order_id, callback.status)
+    except NoResultFound:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND, detail="Payment does not exist"
+        )
+    await session.commit()
+    logger.info(
+        "Payment callback for order #%d: %s", callback.order_id, callback.status.value
+    )
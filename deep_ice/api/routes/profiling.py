@@ -0,0 +1,73 @@
+from typing import Annotated, Literal
+
+from fastapi import APIRouter, Depends, Header, HTTPException, Query, status
+from fastapi.responses import PlainTextResponse
+
+from deep_ice.core.config import settings
+from deep_ice.core.dependencies import get_current_user
+from deep_ice.core.profiling import (
+    ProfilingMiddleware,
+    format_profile,
+    get_profile_path,
+    is_token_valid,
+    memory_tracker,
+)
+from deep_ice.models import RetrieveMemoryDiff
+
+
+async def verify_profiling_token(
+    token: Annotated[str | None, Header(alias=ProfilingMiddleware.HEADER)] = None,
+):
+    if not settings.PROFILING_TOKEN:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND, detail="Profiling is disabled"
+        )
+    if not is_token_valid(token):
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN, detail="Invalid profiling token"
+        )
+
+
+router = APIRouter(
+    dependencies=[Depends(get_current_user), Depends(verify_profiling_token)]
+)
+
+
+@router.get("/profiles/{name}", response_class=PlainTextResponse)
+async def get_profile(
+    name: str,
+    sort_by: Literal["cumulative", "tottime", "ncalls"] = "cumulative",
+    limit: Annotated[int, Query(ge=1, le=500)] = 50,
+):
+    """Stats of a CPU profile stored for a request or a task."""
+    try:
+        path = get_profile_path(name)
+    except ValueError:
+        path = None
+    if not path or not path.is_file():
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND, detail="Profile not found"
+        )
+
+    return format_profile(path, sort_by=sort_by, limit=limit)
+
+
+@router.post("/memory/snapshots", response_model=list[RetrieveMemoryDiff])
+async def take_memory_snapshot(limit: Annotated[int, Query(ge=1, le=100)] = 20):
+    """Snapshot the allocated memory and compare it with the previous snapshot."""
+    return [
+        RetrieveMemoryDiff(
+            location=str(diff.traceback[0]),
+            size=diff.size,
+            size_diff=diff.size_diff,
+            count=diff.count,
+            count_diff=diff.count_diff,
+        )
+        for diff in memory_tracker.take_snapshot(limit=limit)
+    ]
+
+
+@router.delete("/memory", status_code=status.HTTP_204_NO_CONTENT)
+async def stop_memory_tracing():
+    """Stop tracing the allocations, which slow everything down while enabled."""
+    memory_tracker.stop()
@@ -0,0 +1,47 @@
+import functools
+from typing import Annotated
+
+import sentry_sdk
+from fastapi import APIRouter, HTTPException, Query, status
+from redis.exceptions import RedisError
+
+from deep_ice.core import logger
+from deep_ice.core.cache import CoalescingCache
+from deep_ice.core.config import settings
+from deep_ice.models import RetrieveTopIceCream
+from deep_ice.services.stats import StatsWindow, stats_service
+
+router = APIRouter()
+
+
+@functools.cache
+def get_top_icecream_cache() -> CoalescingCache:
+    # Traffic spikes end up in at most one Redis query per TTL and distinct parameters.
+    return CoalescingCache(ttl=settings.STATS_TOP_CACHE_TTL)
+
+
+@router.get("/top", response_model=list[RetrieveTopIceCream])
+async def get_top_icecream(
+    size: Annotated[int, Query(ge=1, le=50)] = 5,
+    window: StatsWindow | None = None,
+):
+    """Most ordered ice cream, all-time or within the last hour/day/week."""
+
+    async def _fetch_top_icecream() -> list[RetrieveTopIceCream]:
+        top_ice = await stats_service.get_top_icecream(size, window=window)
+        return [
+            RetrieveTopIceCream(name=name, quantity=int(quantity))
+            for name, quantity in top_ice.items()
+        ]
+
+    try:
+        return await get_top_icecream_cache().get_or_set(
+            (size, window), _fetch_top_icecream
+        )
+    except RedisError as exc:
+        logger.exception("Stats retrieval error: %s", exc)
+        sentry_sdk.capture_exception(exc)
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Stats are unavailable",
+        )
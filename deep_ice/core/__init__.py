@@ -1,12 +1,18 @@
+import functools
 import logging
 
-from .config import settings
+from .log import setup_logging
 
-LOG_LEVEL = logging.getLevelName(settings.LOG_LEVEL)
-# Basic configuration, applied only if the logger has not been configured before.
-logging.basicConfig(
-    level=LOG_LEVEL,
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
-)
 logger = logging.getLogger("uvicorn.error")
-logger.setLevel(LOG_LEVEL)
+
+
+@functools.cache
+def init_logging():
+    """Set up the logging once per process, as configured by the settings."""
+    from .config import settings
+
+    level = logging.getLevelName(settings.LOG_LEVEL)
+    setup_logging(
+        level, json_format=settings.LOG_JSON, sample_rate=settings.LOG_SAMPLE_RATE
+    )
+    logger.setLevel(level)
@@ -0,0 +1,41 @@
+import asyncio
+import time
+from typing import Any, Awaitable, Callable, Hashable, TypeVar
+
+T = TypeVar("T")
+
+
+class CoalescingCache:
+    """In-memory cache with expiring values, computed only once per key and TTL.
+
+    Concurrent misses over the same key wait for a single computation of the value
+    instead of triggering one each.
+    """
+
+    def __init__(self, ttl: float):
+        self._ttl = ttl
+        self._values: dict[Hashable, tuple[float, Any]] = {}
+        self._pending: dict[Hashable, asyncio.Future] = {}
+
+    async def _compute(self, key: Hashable, factory: Callable[[], Awaitable[T]]) -> T:
+        try:
+            value = await factory()
+            self._values[key] = (time.monotonic() + self._ttl, value)
+            return value
+        finally:
+            del self._pending[key]
+
+    async def get_or_set(self, key: Hashable, factory: Callable[[], Awaitable[T]]) -> T:
+        cached = self._values.get(key)
+        if cached and cached[0] > time.monotonic():
+            return cached[1]
+
+        pending = self._pending.get(key)
+        if not pending:
+            pending = asyncio.ensure_future(self._compute(key, factory))
+            self._pending[key] = pending
+        # A cancelled caller shouldn't cancel the computation the others wait for.
+        return await asyncio.shield(pending)
+
+    def clear(self):
+        self._values.clear()
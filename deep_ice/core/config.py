@@ -1,10 +1,14 @@
+import functools
 import secrets
+from typing import TYPE_CHECKING, Any, Self, cast
 
-from arq.connections import RedisSettings
-from pydantic import PostgresDsn, computed_field
+from pydantic import PostgresDsn, computed_field, field_validator, model_validator
 from pydantic_core import MultiHostUrl
 from pydantic_settings import BaseSettings, SettingsConfigDict
 
+if TYPE_CHECKING:
+    from arq.connections import RedisSettings
+
 
 class Settings(BaseSettings):
     model_config = SettingsConfigDict(
@@ -15,6 +19,8 @@ class Settings(BaseSettings):
     )
 
     LOG_LEVEL: str = "INFO"
+    LOG_JSON: bool = False  # structured logs, one JSON object per line
+    LOG_SAMPLE_RATE: float = 1.0  # fraction of the hot path info logs kept
     DEBUG: bool = False
     PROJECT_NAME: str = "Deep Ice"
     API_V1_STR: str = "/v1"
@@ -30,6 +36,12 @@ class Settings(BaseSettings):
     POSTGRES_PASSWORD: str = ""
     POSTGRES_DB: str
 
+    # API serving processes, forked from a master process sharing the same socket.
+    #  The connection budgets below are split evenly among them.
+    WEB_WORKERS: int = 1
+    DB_MAX_CONNECTIONS: int = 15  # keep under the DB limit, minus the other clients
+    REDIS_MAX_CONNECTIONS: int = 1000  # Redis accepts 10000 clients by default
+
     REDIS_HOST: str = "localhost"
     REDIS_PORT: int = 6379
     REDLOCK_TTL: int = 30  # seconds for the lock to persists in Redis
@@ -38,9 +50,101 @@ class Settings(BaseSettings):
     TASK_RETRY_DELAY: int = 1  # seconds between retries
     TASK_BACKOFF_FACTOR: int = 5  # seconds to wait based on the job try counter
 
+    # Card payments are confirmed by the gateway calling back this URL, instead of
+    #  keeping the worker busy while waiting for the result. (blocking if empty)
+    PAYMENT_CALLBACK_URL: str = ""
+    # Shared between the gateway and us for signing and checking the callbacks.
+    #  (required along with the callback URL, all the processes using the same one)
+    PAYMENT_WEBHOOK_SECRET: str = ""
+
+    STATS_TOP_CACHE_TTL: int = 10  # seconds to keep the computed rankings for
+
+    # Order events are recorded in the DB and dispatched to Redis in batches.
+    OUTBOX_BATCH_SIZE: int = 100  # events dispatched at once
+    OUTBOX_DISPATCH_INTERVAL: int = 1  # seconds between dispatches
+    OUTBOX_RETENTION_DAYS: int = 7  # days to keep the dispatched events for
+
+    # The stock of the flavors split into slots is evened out between them.
+    INVENTORY_REBALANCE_INTERVAL: int = 10  # seconds between rebalances
+    # Stock movements are folded into the product snapshots, for faster reads.
+    STOCK_LEDGER_COMPACTION_INTERVAL: int = 5  # seconds between compactions
+    # Checkouts can skip locking the flavors and have their ledger reservations
+    #  committed together instead, when gathered for a few milliseconds. (off if 0)
+    RESERVATION_WINDOW: float = 0.0  # seconds to gather the reservations for
+    RESERVATION_BATCH_SIZE: int = 100  # reservations committed at once, at most
+
+    # Flash sales admit the buyers into the checkout through a waiting room, as long
+    #  as there are stock tokens left for their carts.
+    WAITING_ROOM_SLOTS: int = 50  # buyers checking out the same flavor at once
+    WAITING_ROOM_TTL: int = 30  # seconds to keep the place in line without retrying
+    # Seconds an admitted buyer keeps its checkout place, until done with it. (also
+    #  counted from when a queued checkout starts)
+    WAITING_ROOM_HOLD_TTL: int = 300
+    WAITING_ROOM_RETRY_AFTER: int = 2  # seconds suggested between retries
+
+    # Checkouts get queued and answered with their ID to poll the status for, then
+    #  processed one by one by the worker serving their partition. (sync if off)
+    ASYNC_CHECKOUT: bool = False
+    CHECKOUT_PARTITIONS: int = 4  # queues the checkouts are split into, by flavor
+    CHECKOUT_PARTITION: int = 0  # the queue served by the current checkout worker
+    CHECKOUT_RESULT_TTL: int = 3600  # seconds to keep the checkout results for
+
+    # Requests issuing more SQL statements than this get logged, along with the
+    #  statements repeated at least `QUERY_REPEAT_THRESHOLD` times. (likely N+1)
+    QUERY_BUDGET: int = 20
+    QUERY_REPEAT_THRESHOLD: int = 5
+
+    # The event loop is checked for lag this often, and stalls longer than the
+    #  threshold get logged with the blocking stack. (seconds)
+    LOOP_LAG_INTERVAL: float = 0.5
+    LOOP_LAG_THRESHOLD: float = 0.25
+    # Each process adds its metrics to the totals in Redis this often. (seconds)
+    METRICS_FLUSH_INTERVAL: float = 5.0
+
+    # Before serving, each worker opens this many DB connections (up to its pool
+    #  size) and runs the hot queries once. If that takes longer than the timeout
+    #  (seconds), it continues in the background, with the worker reporting ready
+    #  only once done.
+    WARM_UP_CONNECTIONS: int = 5
+    WARM_UP_TIMEOUT: float = 10.0
+    WARM_UP_ATTEMPTS: int = 30  # before giving up, reporting the error as not ready
+    # Read endpoints encode the DB rows straight into JSON, without validating them
+    #  against the response models first.
+    FAST_JSON: bool = False
+
+    # Fraction of the requests reporting their per-stage timing.
+    SERVER_TIMING_SAMPLE_RATE: float = 0.1
+
+    # Local profiling is available only to the callers presenting this token.
+    #  (disabled if empty)
+    PROFILING_TOKEN: str = ""
+    PROFILING_DIR: str = "profiles"  # where the CPU profiles are stored
+    PROFILING_TASKS: bool = False  # profile every payment job in the worker
+
     SENTRY_DSN: str = ""  # without a value we won't initialize Sentry capturing
     SENTRY_SAMPLE_RATE: float = 0.2  # percentage of traces to capture
 
+    @field_validator(
+        "OUTBOX_DISPATCH_INTERVAL",
+        "INVENTORY_REBALANCE_INTERVAL",
+        "STOCK_LEDGER_COMPACTION_INTERVAL",
+    )
+    @classmethod
+    def _check_cron_interval(cls, value: int) -> int:
+        # The worker runs these on the matching seconds of every minute, which are
+        #  evenly spaced only when the interval divides the minute.
+        if value <= 0 or 60 % value:
+            raise ValueError("must divide 60 seconds evenly, like 1, 5, 15 or 60")
+        return value
+
+    @model_validator(mode="after")
+    def _check_payment_callback(self) -> Self:
+        if self.PAYMENT_CALLBACK_URL and not self.PAYMENT_WEBHOOK_SECRET:
+            raise ValueError(
+                "PAYMENT_WEBHOOK_SECRET is required when PAYMENT_CALLBACK_URL is set"
+            )
+        return self
+
     @computed_field  # type: ignore[prop-decorator]
     @property
     def SQLALCHEMY_DATABASE_URI(self) -> PostgresDsn:
@@ -53,6 +157,57 @@ class Settings(BaseSettings):
             path=self.POSTGRES_DB,
         )
 
+    @computed_field  # type: ignore[prop-decorator]
+    @property
+    def DB_POOL_SIZE(self) -> int:
+        # Half of the process' share is kept open, the rest is opened on bursts.
+        return max(1, self.DB_MAX_CONNECTIONS // self.WEB_WORKERS // 2)
+
+    @computed_field  # type: ignore[prop-decorator]
+    @property
+    def DB_MAX_OVERFLOW(self) -> int:
+        return max(0, self.DB_MAX_CONNECTIONS // self.WEB_WORKERS - self.DB_POOL_SIZE)
+
+    @computed_field  # type: ignore[prop-decorator]
+    @property
+    def REDIS_POOL_SIZE(self) -> int:
+        # Shared by the two clients of a process. (ARQ pool and stats)
+        return max(1, self.REDIS_MAX_CONNECTIONS // self.WEB_WORKERS // 2)
+
+
+@functools.cache
+def get_settings() -> Settings:
+    return Settings()  # type: ignore
+
+
+@functools.cache
+def get_redis_settings() -> "RedisSettings":
+    from arq.connections import RedisSettings
+
+    settings = get_settings()
+    return RedisSettings(
+        host=settings.REDIS_HOST,
+        port=settings.REDIS_PORT,
+        max_connections=settings.REDIS_POOL_SIZE,
+    )
+
+
+class _LazySettings:
+    """Stands for the settings, which get read on first use instead of on import.
+
+    Values set on it (like patched ones) take precedence over the actual settings.
+    """
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(get_settings(), name)
+
+
+settings = cast(Settings, _LazySettings())
+# Read on first access instead of when importing this module.
+redis_settings: "RedisSettings"
+
 
-settings = Settings()  # type: ignore
-redis_settings = RedisSettings(host=settings.REDIS_HOST, port=settings.REDIS_PORT)
+def __getattr__(name: str) -> Any:
+    if name == "redis_settings":
+        return get_redis_settings()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -1,18 +1,90 @@
-from typing import AsyncGenerator
+import functools
+import time
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from typing import AsyncGenerator, Iterator
 
-from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncEngine, async_sessionmaker, create_async_engine
 from sqlmodel.ext.asyncio.session import AsyncSession
 
 from deep_ice.core.config import settings
 
-async_engine = create_async_engine(
-    str(settings.SQLALCHEMY_DATABASE_URI), echo=settings.DEBUG, future=True
-)
 
+@dataclass
+class QueryStats:
+    """Statements executed within a context, like a request, and their DB time."""
 
-async def get_async_session() -> AsyncGenerator[AsyncSession, None]:
-    async_session = async_sessionmaker(
-        bind=async_engine, class_=AsyncSession, expire_on_commit=False
+    count: int = 0
+    duration: float = 0.0
+    statements: Counter[str] = field(default_factory=Counter)
+
+    def get_repeated(self, threshold: int) -> list[tuple[str, int]]:
+        # The same statement issued over and over usually means a N+1 pattern.
+        return [
+            (statement, count)
+            for statement, count in self.statements.most_common()
+            if count >= threshold
+        ]
+
+
+_query_stats: ContextVar[QueryStats | None] = ContextVar("query_stats", default=None)
+
+
+@contextmanager
+def track_queries() -> Iterator[QueryStats]:
+    """Collect stats about the SQL statements executed within this context."""
+    stats = QueryStats()
+    token = _query_stats.set(stats)
+    try:
+        yield stats
+    finally:
+        _query_stats.reset(token)
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    context._query_start = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    # The async engine runs these hooks in the context of the awaiting task.
+    if stats := _query_stats.get():
+        stats.count += 1
+        stats.duration += time.perf_counter() - context._query_start
+        stats.statements[statement] += 1
+
+
+def instrument_engine(engine: AsyncEngine):
+    """Account the statements executed through the engine into `track_queries`."""
+    event.listen(engine.sync_engine, "before_cursor_execute", _before_cursor_execute)
+    event.listen(engine.sync_engine, "after_cursor_execute", _after_cursor_execute)
+
+
+@functools.cache
+def get_engine() -> AsyncEngine:
+    """The engine is created on first use, not when importing this module."""
+    async_engine = create_async_engine(
+        str(settings.SQLALCHEMY_DATABASE_URI),
+        echo=settings.DEBUG,
+        future=True,
+        pool_size=settings.DB_POOL_SIZE,
+        max_overflow=settings.DB_MAX_OVERFLOW,
+        # Connections are checked before use, as the workers live long.
+        pool_pre_ping=True,
+    )
+    instrument_engine(async_engine)
+    return async_engine
+
+
+@functools.cache
+def get_session_maker() -> async_sessionmaker[AsyncSession]:
+    return async_sessionmaker(
+        bind=get_engine(), class_=AsyncSession, expire_on_commit=False
     )
-    async with async_session() as session:
+
+
+async def get_async_session() -> AsyncGenerator[AsyncSession, None]:
+    async with get_session_maker()() as session:
         yield session
@@ -3,16 +3,18 @@ from typing import Annotated, AsyncGenerator
 import jwt
 import sentry_sdk
 from aioredlock import Aioredlock
-from fastapi import Depends, HTTPException, status
+from fastapi import Depends, HTTPException, Request, status
 from fastapi.security import OAuth2PasswordBearer
 from jwt.exceptions import InvalidTokenError
 from pydantic import ValidationError
 from sqlmodel.ext.asyncio.session import AsyncSession
 
 from deep_ice.core import logger, security
-from deep_ice.core.config import redis_settings, settings
+from deep_ice.core.config import get_redis_settings, settings
 from deep_ice.core.database import get_async_session
+from deep_ice.core.timing import timed
 from deep_ice.models import TokenPayload, User
+from deep_ice.services.admission import AdmissionService
 from deep_ice.services.cart import CartService
 
 reusable_oauth2 = OAuth2PasswordBearer(
@@ -25,10 +27,11 @@ TokenDep = Annotated[str, Depends(reusable_oauth2)]
 
 async def get_current_user(session: SessionDep, token: TokenDep) -> User:
     try:
-        payload = jwt.decode(
-            token, settings.SECRET_KEY, algorithms=[security.ALGORITHM]
-        )
-        token_data = TokenPayload.model_validate(payload)
+        with timed("jwt"):
+            payload = jwt.decode(
+                token, settings.SECRET_KEY, algorithms=[security.ALGORITHM]
+            )
+            token_data = TokenPayload.model_validate(payload)
     except (InvalidTokenError, ValidationError) as exc:
         logger.exception("Invalid token: %s", exc)
         sentry_sdk.capture_exception(exc)
@@ -36,7 +39,8 @@ async def get_current_user(session: SessionDep, token: TokenDep) -> User:
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Couldn't validate credentials",
         )
-    user: User | None = await session.get(User, int(token_data.sub))
+    with timed("user"):
+        user: User | None = await session.get(User, int(token_data.sub))
     if not user:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND, detail="User not found"
@@ -52,7 +56,12 @@ async def get_cart_service(session: SessionDep) -> CartService:
     return CartService(session)
 
 
+async def get_admission_service(request: Request) -> AdmissionService:
+    return AdmissionService(request.app.state.redis_pool)
+
+
 async def get_lock_manager() -> AsyncGenerator[Aioredlock, None]:
+    redis_settings = get_redis_settings()
     lock_manager = Aioredlock(
         [{"host": redis_settings.host, "port": redis_settings.port}],
         internal_lock_timeout=settings.REDLOCK_TTL,
@@ -64,3 +73,4 @@ async def get_lock_manager() -> AsyncGenerator[Aioredlock, None]:
 CurrentUserDep = Annotated[User, Depends(get_current_user)]
 CartServiceDep = Annotated[CartService, Depends(get_cart_service)]
 RedlockDep = Annotated[Aioredlock, Depends(get_lock_manager)]
+AdmissionServiceDep = Annotated[AdmissionService, Depends(get_admission_service)]
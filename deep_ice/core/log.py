@@ -0,0 +1,124 @@
+"""Logging off the event loop, through a queue drained by a background thread."""
+
+import atexit
+import copy
+import functools
+import json
+import logging
+import os
+import random
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+from queue import SimpleQueue
+
+FORMAT = "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+# Pass as `extra` to the info/debug logs which may be dropped by sampling.
+SAMPLED = {"sampled": True}
+
+# Attributes every record has, anything else was passed through `extra`.
+_RECORD_ATTRS = set(vars(logging.makeLogRecord({}))) | {"message", "asctime"}
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line, ready to be shipped to Logstash."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        data = {
+            "@timestamp": datetime.fromtimestamp(
+                record.created, tz=timezone.utc
+            ).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        data.update(
+            (key, value)
+            for key, value in vars(record).items()
+            if key not in _RECORD_ATTRS and key != "sampled"
+        )
+        if record.exc_info:
+            data["exception"] = self.formatException(record.exc_info)
+        return json.dumps(data, default=str)
+
+
+class SamplingFilter(logging.Filter):
+    """Keep only a fraction of the hot path logs, marked with `SAMPLED`."""
+
+    def __init__(self, rate: float):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno > logging.INFO or not getattr(record, "sampled", False):
+            return True
+
+        return random.random() < self.rate
+
+
+class LocalQueueHandler(QueueHandler):
+    IMMUTABLE_TYPES = (str, int, float, bytes, type(None))
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # The message is rendered right away if its arguments may change later on,
+        #  otherwise in the listener thread, as some formatters need the arguments.
+        #  (like Uvicorn's access log one) Since the queue never leaves the process,
+        #  the exception info is kept for the formatters as well.
+        record = copy.copy(record)
+        if not isinstance(record.args, tuple) or not all(
+            isinstance(arg, self.IMMUTABLE_TYPES) for arg in record.args
+        ):
+            record.msg = record.getMessage()
+            record.args = None
+        return record
+
+
+def _restart_listener(listener: QueueListener, handler: QueueHandler):
+    # Neither the listener thread, nor the state of the queue's lock survive a fork,
+    #  so the child gets a fresh pair. (the records left belong to the parent)
+    listener.queue = handler.queue = SimpleQueue()
+    listener._thread = None  # type: ignore[attr-defined]
+    listener.start()
+
+
+def _enqueue_handlers(
+    logger: logging.Logger, *, sample_rate: float
+) -> QueueListener | None:
+    # The handlers of the logger are moved behind a queue, so logging calls only
+    #  enqueue records, while the listener thread does the I/O.
+    if not logger.handlers:
+        return None
+
+    queue: SimpleQueue = SimpleQueue()
+    listener = QueueListener(queue, *logger.handlers, respect_handler_level=True)
+    handler = LocalQueueHandler(queue)
+    handler.addFilter(SamplingFilter(sample_rate))
+    logger.handlers = [handler]
+    listener.start()
+    atexit.register(listener.stop)
+    # Forked processes (like the API workers) need their own listener thread.
+    os.register_at_fork(
+        after_in_child=functools.partial(_restart_listener, listener, handler)
+    )
+    return listener
+
+
+def setup_logging(
+    level: int, *, json_format: bool = False, sample_rate: float = 1.0
+) -> list[QueueListener]:
+    """Configure the root logger, along with the handlers set by Uvicorn if any."""
+    # Basic configuration, applied only if the logger has not been configured before.
+    logging.basicConfig(level=level, format=FORMAT)
+    loggers = [logging.getLogger(name) for name in (None, "uvicorn", "uvicorn.access")]
+    if json_format:
+        for logger in loggers:
+            for handler in logger.handlers:
+                handler.setFormatter(JsonFormatter())
+
+    listeners = []
+    for logger in loggers:
+        # Skip the loggers already set up, like when importing this again.
+        if any(isinstance(handler, QueueHandler) for handler in logger.handlers):
+            continue
+        if listener := _enqueue_handlers(logger, sample_rate=sample_rate):
+            listeners.append(listener)
+    return listeners
@@ -0,0 +1,95 @@
+"""Detect the event loop getting blocked by synchronous work."""
+
+import asyncio
+import sys
+import threading
+import time
+import traceback
+
+import redis.asyncio as aioredis
+
+from deep_ice.core import logger
+from deep_ice.core.config import settings
+from deep_ice.core.metrics import Histogram, RedisHistogram
+
+
+class LoopLagMonitor:
+    """Sample how late the event loop wakes up and report the stalls.
+
+    A coroutine measures the lag of its periodic wake-ups, while a watchdog thread
+    logs the stack the loop is stuck in whenever it stops beating for longer than
+    the threshold.
+    """
+
+    def __init__(
+        self,
+        histogram: Histogram,
+        *,
+        redis: aioredis.Redis | None = None,
+        interval: float | None = None,
+        threshold: float | None = None,
+    ):
+        self._histogram = histogram
+        # Shared histograms are written to Redis, for the workers.
+        self._redis = redis
+        self._interval = settings.LOOP_LAG_INTERVAL if interval is None else interval
+        self._threshold = (
+            settings.LOOP_LAG_THRESHOLD if threshold is None else threshold
+        )
+        self._last_beat = time.monotonic()
+        self._loop_thread_id = threading.get_ident()
+        self._sampler: asyncio.Task | None = None
+        self._watchdog: threading.Thread | None = None
+        self._stopped = threading.Event()
+
+    async def _observe(self, lag: float):
+        if self._redis and isinstance(self._histogram, RedisHistogram):
+            await self._histogram.observe_shared(self._redis, lag)
+        else:
+            self._histogram.observe(lag)
+
+    async def _sample(self):
+        while True:
+            start = time.monotonic()
+            await asyncio.sleep(self._interval)
+            self._last_beat = time.monotonic()
+            await self._observe(max(self._last_beat - start - self._interval, 0))
+
+    def _watch(self):
+        reported_beat = None
+        while not self._stopped.wait(self._threshold / 2):
+            last_beat = self._last_beat
+            stalled = time.monotonic() - last_beat - self._interval
+            if stalled < self._threshold or last_beat == reported_beat:
+                continue
+
+            # Report a stall once, with the stack the loop thread is currently in.
+            reported_beat = last_beat
+            frame = sys._current_frames().get(self._loop_thread_id)
+            stack = "".join(traceback.format_stack(frame)) if frame else "unknown"
+            logger.warning("Event loop blocked for %.3fs at:\n%s", stalled, stack)
+
+    def start(self):
+        if self._sampler:
+            return
+
+        self._loop_thread_id = threading.get_ident()
+        self._last_beat = time.monotonic()
+        self._stopped.clear()
+        self._sampler = asyncio.create_task(self._sample())
+        self._watchdog = threading.Thread(
+            target=self._watch, name="loop-lag-watchdog", daemon=True
+        )
+        self._watchdog.start()
+
+    async def stop(self):
+        if not self._sampler:
+            return
+
+        self._stopped.set()
+        self._sampler.cancel()
+        await asyncio.gather(self._sampler, return_exceptions=True)
+        self._sampler = None
+        if self._watchdog:
+            await asyncio.to_thread(self._watchdog.join)
+            self._watchdog = None
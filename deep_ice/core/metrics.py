@@ -0,0 +1,457 @@
+"""Lightweight metrics exposed in the Prometheus text format.
+
+Each process records its metrics in memory, then adds them periodically to the ones
+accumulated in Redis, through the `MetricsFlusher`. Scrapes are answered with the
+totals of all the API and task queue worker processes, whichever of them takes the
+request.
+"""
+
+import asyncio
+import bisect
+import json
+import time
+from abc import ABC, abstractmethod
+from contextlib import asynccontextmanager, contextmanager
+from typing import AsyncIterator, Awaitable, Callable, Iterator, TypeVar
+
+import redis.asyncio as aioredis
+from redis.asyncio.client import Pipeline
+from redis.exceptions import RedisError
+from starlette.datastructures import MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from deep_ice.core import logger
+from deep_ice.core.config import settings
+from deep_ice.core.database import QueryStats, track_queries
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+LabelValues = tuple[str, ...]
+Collector = Callable[[aioredis.Redis], Awaitable[list[str]]]
+
+
+def _format_labels(names: tuple[str, ...], values: LabelValues, **extra: str) -> str:
+    pairs = list(zip(names, values)) + list(extra.items())
+    if not pairs:
+        return ""
+    labels = ",".join(f'{name}="{value}"' for name, value in pairs)
+    return f"{{{labels}}}"
+
+
+def _format_value(value: float) -> str:
+    return "+Inf" if value == float("inf") else repr(float(value))
+
+
+def _encode_field(key: LabelValues, suffix: str) -> str:
+    # Label values can hold any character, so they're stored as JSON.
+    return f"{suffix}:{json.dumps(key)}" if key else suffix
+
+
+def _decode_field(field: bytes) -> tuple[LabelValues, str]:
+    suffix, _, key = field.decode().partition(":")
+    return (tuple(json.loads(key)) if key else ()), suffix
+
+
+class Metric(ABC):
+    TYPE = ""
+    KEY_PREFIX = "METRICS"
+
+    def __init__(self, name: str, help: str, labelnames: tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+
+    @property
+    def key(self) -> str:
+        return f"{self.KEY_PREFIX}:{self.name}"
+
+    def _get_label_values(self, labels: dict[str, str]) -> LabelValues:
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def header(self) -> list[str]:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.TYPE}"]
+
+    @abstractmethod
+    def render(self) -> list[str]:
+        """Lines of the metric in the Prometheus text format, header included."""
+
+    @abstractmethod
+    def flush(self, pipe: Pipeline):
+        """Queue adding the values recorded since the last flush to the shared ones."""
+
+    @abstractmethod
+    async def collect(self, redis: aioredis.Redis) -> list[str]:
+        """Lines of the values shared by all the processes, header included."""
+
+
+MetricT = TypeVar("MetricT", bound=Metric)
+
+
+class _ValueMetric(Metric):
+    def __init__(self, name: str, help: str, labelnames: tuple[str, ...] = ()):
+        super().__init__(name, help, labelnames)
+        self._values: dict[LabelValues, float] = {}
+
+    def _render_values(self, values: dict[LabelValues, float]) -> list[str]:
+        return self.header() + [
+            f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"
+            for key, value in values.items()
+        ]
+
+    def render(self) -> list[str]:
+        return self._render_values(self._values)
+
+    async def collect(self, redis: aioredis.Redis) -> list[str]:
+        fields = await redis.hgetall(self.key)  # type: ignore[misc]
+        values = {}
+        for field, value in fields.items():
+            key, _ = _decode_field(field)
+            values[key] = float(value)
+        return self._render_values(values)
+
+
+class Counter(_ValueMetric):
+    TYPE = "counter"
+
+    def inc(self, amount: float = 1, **labels: str):
+        key = self._get_label_values(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def flush(self, pipe: Pipeline):
+        values, self._values = self._values, {}
+        for key, value in values.items():
+            pipe.hincrbyfloat(self.key, _encode_field(key, "value"), value)
+
+
+class Gauge(_ValueMetric):
+    TYPE = "gauge"
+
+    def flush(self, pipe: Pipeline):
+        # Values don't add up, so the last one set by any of the processes wins.
+        for key, value in self._values.items():
+            pipe.hset(self.key, _encode_field(key, "value"), str(value))
+
+    def set(self, value: float, **labels: str):
+        self._values[self._get_label_values(labels)] = value
+
+
+class Histogram(Metric):
+    TYPE = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labelnames: tuple[str, ...] = (),
+        *,
+        buckets: tuple[float, ...] = DEFAULT_BUCKETS,
+    ):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+        # Non-cumulative counts per bucket, along with the sum of observations.
+        self._counts: dict[LabelValues, list[int]] = {}
+        self._sums: dict[LabelValues, float] = {}
+
+    def observe(self, value: float, **labels: str):
+        key = self._get_label_values(labels)
+        counts = self._counts.setdefault(key, [0] * len(self.buckets))
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        self._sums[key] = self._sums.get(key, 0) + value
+
+    @contextmanager
+    def time(self, **labels: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def flush(self, pipe: Pipeline):
+        counts, self._counts = self._counts, {}
+        sums, self._sums = self._sums, {}
+        for key, series in counts.items():
+            for idx, count in enumerate(series):
+                if count:
+                    pipe.hincrby(self.key, _encode_field(key, str(idx)), count)
+            pipe.hincrbyfloat(self.key, _encode_field(key, "sum"), sums[key])
+
+    def _render_series(
+        self, key: LabelValues, counts: list[int], total: float
+    ) -> list[str]:
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets, counts):
+            cumulative += count
+            labels = _format_labels(self.labelnames, key, le=_format_value(bound))
+            lines.append(f"{self.name}_bucket{labels} {cumulative}")
+        labels = _format_labels(self.labelnames, key)
+        lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+        lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+    def _render_values(
+        self, counts: dict[LabelValues, list[int]], sums: dict[LabelValues, float]
+    ) -> list[str]:
+        lines = self.header()
+        for key, series in counts.items():
+            lines.extend(self._render_series(key, series, sums.get(key, 0)))
+        return lines
+
+    def render(self) -> list[str]:
+        return self._render_values(self._counts, self._sums)
+
+    async def collect(self, redis: aioredis.Redis) -> list[str]:
+        fields = await redis.hgetall(self.key)  # type: ignore[misc]
+        counts: dict[LabelValues, list[int]] = {}
+        sums: dict[LabelValues, float] = {}
+        for field, value in fields.items():
+            key, suffix = _decode_field(field)
+            series = counts.setdefault(key, [0] * len(self.buckets))
+            if suffix == "sum":
+                sums[key] = float(value)
+            else:
+                series[int(suffix)] = int(value)
+        return self._render_values(counts, sums)
+
+
+class RedisHistogram(Histogram):
+    """Histogram written to Redis on every observation, instead of on flushes."""
+
+    async def observe_shared(self, redis: aioredis.Redis, value: float):
+        idx = bisect.bisect_left(self.buckets, value)
+        try:
+            await redis.hincrby(  # type: ignore[misc]
+                self.key, _encode_field((), str(idx)), 1
+            )
+            await redis.hincrbyfloat(  # type: ignore[misc]
+                self.key, _encode_field((), "sum"), value
+            )
+        except RedisError as exc:
+            # Losing an observation is better than failing the measured operation.
+            logger.warning("Couldn't record %s: %s", self.name, exc)
+
+    @asynccontextmanager
+    async def time_shared(self, redis: aioredis.Redis) -> AsyncIterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            await self.observe_shared(redis, time.perf_counter() - start)
+
+
+class Registry:
+    def __init__(self) -> None:
+        self._metrics: list[Metric] = []
+        self._collectors: list[Collector] = []
+
+    def register(self, metric: MetricT) -> MetricT:
+        self._metrics.append(metric)
+        return metric
+
+    def add_collector(self, collector: Collector) -> Collector:
+        """Add a callback rendering metrics which are only known at scrape time."""
+        self._collectors.append(collector)
+        return collector
+
+    async def flush(self, redis: aioredis.Redis):
+        """Add the values recorded by this process since the last flush to Redis."""
+        pipe = redis.pipeline(transaction=True)
+        for metric in self._metrics:
+            metric.flush(pipe)
+        await pipe.execute()
+
+    async def render(self, redis: aioredis.Redis) -> str:
+        # The process answering the scrape counts with its latest values too.
+        await self.flush(redis)
+        lines = []
+        for metric in self._metrics:
+            lines.extend(await metric.collect(redis))
+        for collector in self._collectors:
+            lines.extend(await collector(redis))
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+REQUEST_LATENCY = registry.register(
+    Histogram(
+        "http_request_duration_seconds",
+        "HTTP request latency by route.",
+        ("method", "route"),
+    )
+)
+REQUESTS = registry.register(
+    Counter(
+        "http_requests_total",
+        "HTTP responses by route and status code.",
+        ("method", "route", "status"),
+    )
+)
+REDLOCK_ACQUIRE_LATENCY = registry.register(
+    Histogram("redlock_acquire_seconds", "Time spent acquiring Redis locks.")
+)
+REDLOCK_FAILURES = registry.register(
+    Counter("redlock_failures_total", "Redis locks which couldn't be acquired.")
+)
+FLASH_SALE_ADMISSIONS = registry.register(
+    Counter(
+        "flash_sale_admissions_total",
+        "Flash sale checkouts by admission outcome.",
+        ("outcome",),
+    )
+)
+# Observed by the checkout workers too, which flush it to Redis like the API does.
+RESERVATION_BATCH_SIZE = registry.register(
+    Histogram(
+        "stock_reservation_batch_size",
+        "Reservations committed together by the coalescer.",
+        buckets=(1, 2, 5, 10, 20, 50, 100),
+    )
+)
+PAYMENT_JOB_LATENCY = registry.register(
+    RedisHistogram(
+        "payment_job_duration_seconds",
+        "Duration of the payment jobs.",
+        buckets=(0.1, 0.5, 1, 2, 3, 5, 10, 30),
+    )
+)
+STATS_WRITE_LATENCY = registry.register(
+    RedisHistogram("stats_write_duration_seconds", "Latency of the Redis stats writes.")
+)
+LOOP_LAG = registry.register(
+    Histogram(
+        "event_loop_lag_seconds",
+        "How late the API event loop wakes up.",
+        buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 5),
+    )
+)
+WORKER_LOOP_LAG = registry.register(
+    RedisHistogram(
+        "worker_event_loop_lag_seconds",
+        "How late the worker event loops wake up.",
+        buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 5),
+    )
+)
+
+
+class MetricsFlusher:
+    """Add the metrics recorded by this process to the shared ones, periodically.
+
+    Without it, each process of a prefork server would answer the scrapes with its
+    own share of the requests only.
+    """
+
+    def __init__(self, redis: aioredis.Redis, *, interval: float | None = None):
+        self._redis = redis
+        self._interval = (
+            settings.METRICS_FLUSH_INTERVAL if interval is None else interval
+        )
+        self._flusher: asyncio.Task | None = None
+
+    async def flush(self):
+        try:
+            await registry.flush(self._redis)
+        except RedisError as exc:
+            # Like with the shared histograms, the values taken out are lost.
+            logger.warning("Couldn't flush the metrics: %s", exc)
+
+    async def _flush_periodically(self):
+        while True:
+            await asyncio.sleep(self._interval)
+            await self.flush()
+
+    def start(self):
+        if not self._flusher:
+            self._flusher = asyncio.create_task(self._flush_periodically())
+
+    async def stop(self):
+        if not self._flusher:
+            return
+
+        self._flusher.cancel()
+        await asyncio.gather(self._flusher, return_exceptions=True)
+        self._flusher = None
+        # The values recorded since the last flush aren't lost on shutdown.
+        await self.flush()
+
+
+class MetricsMiddleware:
+    """Measure every HTTP request latency and response status, by route."""
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        status_code = 500
+
+        async def send_wrapper(message: Message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            # Label by route template instead of the actual path, so the number of
+            #  series stays bounded.
+            route = scope.get("route")
+            labels = {
+                "method": scope["method"],
+                "route": getattr(route, "path", "unmatched"),
+            }
+            REQUEST_LATENCY.observe(time.perf_counter() - start, **labels)
+            REQUESTS.inc(**labels, status=str(status_code))
+
+
+class QueryStatsMiddleware:
+    """Keep the SQL statements of each request within a budget.
+
+    In debug mode, the number of statements and their DB time are sent back through
+    response headers as well.
+    """
+
+    COUNT_HEADER = "X-DB-Queries"
+    DURATION_HEADER = "X-DB-Duration"
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        with track_queries() as stats:
+
+            async def send_wrapper(message: Message):
+                if message["type"] == "http.response.start" and settings.DEBUG:
+                    headers = MutableHeaders(scope=message)
+                    headers[self.COUNT_HEADER] = str(stats.count)
+                    headers[self.DURATION_HEADER] = f"{stats.duration * 1000:.3f}"
+                await send(message)
+
+            await self.app(scope, receive, send_wrapper)
+
+        self._check_budget(scope, stats)
+
+    @staticmethod
+    def _check_budget(scope: Scope, stats: QueryStats):
+        if stats.count > settings.QUERY_BUDGET:
+            logger.warning(
+                "%s %s issued %d SQL statements in %.3fs. (budget of %d)",
+                scope["method"],
+                scope["path"],
+                stats.count,
+                stats.duration,
+                settings.QUERY_BUDGET,
+            )
+        for statement, count in stats.get_repeated(settings.QUERY_REPEAT_THRESHOLD):
+            logger.warning(
+                "Possible N+1, statement repeated %d times: %s", count, statement
+            )
@@ -0,0 +1,149 @@
+"""On-demand CPU and memory profiling, kept local to the box."""
+
+import cProfile
+import io
+import pstats
+import re
+import secrets
+import time
+import tracemalloc
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Iterator
+
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from deep_ice.core import logger
+from deep_ice.core.config import settings
+
+# Only one profiler can be active at a time within the interpreter.
+_profiling = False
+
+
+def is_token_valid(token: str | None) -> bool:
+    # Profiling is disabled as long as no token is configured.
+    if not settings.PROFILING_TOKEN or not token:
+        return False
+
+    return secrets.compare_digest(token, settings.PROFILING_TOKEN)
+
+
+def get_profile_path(name: str) -> Path:
+    """Path of a stored profile, given its name only."""
+    if not re.fullmatch(r"[\w.-]+\.prof", name):
+        raise ValueError(f"invalid profile name {name!r}")
+
+    return Path(settings.PROFILING_DIR) / name
+
+
+@contextmanager
+def profiled(label: str) -> Iterator[Path | None]:
+    """Profile the code within, then dump the stats into a file named after `label`.
+
+    The profiler sees everything running in the thread, so with concurrent requests
+    or tasks their work shows up in the stats too. Yields no path if another
+    profiling is already underway.
+    """
+    global _profiling
+
+    if _profiling:
+        yield None
+        return
+
+    label = re.sub(r"[^\w.-]+", "_", label).strip("_")
+    path = get_profile_path(f"{int(time.time() * 1000)}-{label}.prof")
+    profiler = cProfile.Profile()
+    _profiling = True
+    profiler.enable()
+    try:
+        yield path
+    finally:
+        profiler.disable()
+        _profiling = False
+        path.parent.mkdir(parents=True, exist_ok=True)
+        profiler.dump_stats(path)
+        logger.info("Profile stored in %s.", path)
+
+
+def format_profile(path: Path, *, sort_by: str = "cumulative", limit: int = 50) -> str:
+    stream = io.StringIO()
+    stats = pstats.Stats(str(path), stream=stream)
+    stats.sort_stats(sort_by).print_stats(limit)
+    return stream.getvalue()
+
+
+class MemoryTracker:
+    """Take `tracemalloc` snapshots and compare each with the previous one."""
+
+    def __init__(self, *, frames: int = 1):
+        self._frames = frames
+        self._snapshot: tracemalloc.Snapshot | None = None
+
+    def start(self):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(self._frames)
+
+    def stop(self):
+        tracemalloc.stop()
+        self._snapshot = None
+
+    def take_snapshot(self, *, limit: int = 20) -> list[tracemalloc.StatisticDiff]:
+        """Return the top allocation differences since the last snapshot.
+
+        Tracing starts with the first snapshot, which gets compared with nothing.
+        """
+        self.start()
+        snapshot = tracemalloc.take_snapshot().filter_traces(
+            [tracemalloc.Filter(False, tracemalloc.__file__)]
+        )
+        previous, self._snapshot = self._snapshot, snapshot
+        if not previous:
+            return []
+
+        return snapshot.compare_to(previous, "lineno")[:limit]
+
+
+memory_tracker = MemoryTracker()
+
+
+@contextmanager
+def profiled_task(name: str) -> Iterator[None]:
+    """Profile a task queue job, along with its memory allocations, if enabled."""
+    if not settings.PROFILING_TASKS:
+        yield
+        return
+
+    memory_tracker.take_snapshot()
+    with profiled(name):
+        yield
+    for diff in memory_tracker.take_snapshot(limit=10):
+        logger.info("Memory allocated by %s: %s", name, diff)
+
+
+class ProfilingMiddleware:
+    """Profile the requests carrying the profiling token in their header.
+
+    The name of the stored profile is sent back in the same response header.
+    """
+
+    HEADER = "X-Profile"
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http" or not is_token_valid(
+            Headers(scope=scope).get(self.HEADER)
+        ):
+            await self.app(scope, receive, send)
+            return
+
+        with profiled(f"{scope['method']}-{scope['path']}") as path:
+
+            async def send_wrapper(message: Message):
+                if message["type"] == "http.response.start" and path:
+                    MutableHeaders(scope=message)[self.HEADER] = path.name
+                await send(message)
+
+            await self.app(scope, receive, send_wrapper)
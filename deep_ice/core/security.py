@@ -1,3 +1,5 @@
+import hashlib
+import hmac
 from datetime import datetime, timedelta, timezone
 
 import jwt
@@ -9,6 +11,7 @@ from deep_ice.models import User
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 
 ALGORITHM = "HS256"
+SIGNATURE_HEADER = "X-Signature"
 
 
 def create_access_token(user: User, expires_delta: timedelta | None = None) -> str:
@@ -31,3 +34,16 @@ def verify_password(plain_password: str, hashed_password: str) -> bool:
 
 def get_password_hash(password: str) -> str:
     return pwd_context.hash(password)
+
+
+def sign_payload(payload: bytes) -> str:
+    return hmac.new(
+        settings.PAYMENT_WEBHOOK_SECRET.encode(), payload, hashlib.sha256
+    ).hexdigest()
+
+
+def verify_signature(payload: bytes, signature: str) -> bool:
+    # Without a secret there are no callbacks expected, so none is trusted.
+    if not settings.PAYMENT_WEBHOOK_SECRET:
+        return False
+    return hmac.compare_digest(sign_payload(payload), signature)
@@ -0,0 +1,99 @@
+"""Fast JSON path for the read endpoints, skipping the response model validation.
+
+Rows loaded from our own DB are trusted to match the `Retrieve*` models, so they
+get turned into plain data straight away, then encoded with `orjson` when
+installed, or with the standard library otherwise.
+"""
+
+import json
+from typing import Any
+
+from fastapi.responses import Response
+
+from deep_ice.models import Cart, CartItem, IceCream, Order, OrderItem, Payment
+from deep_ice.read_models import IceCreamRow, OrderItemRow, OrderRow
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None  # type: ignore[assignment]
+
+
+def dumps(content: Any) -> bytes:
+    if orjson:
+        return orjson.dumps(content)
+
+    return json.dumps(content, ensure_ascii=False, separators=(",", ":")).encode()
+
+
+class FastJSONResponse(Response):
+    """JSON response expecting content which is already made of plain data."""
+
+    media_type = "application/json"
+
+    def render(self, content: Any) -> bytes:
+        return dumps(content)
+
+
+# Each serializer matches the output of its `Retrieve*` model counterpart, taking
+#  either the ORM instances or their read models.
+
+
+def serialize_icecream(icecream: IceCream | IceCreamRow) -> dict[str, Any]:
+    return {
+        "name": icecream.name,
+        "flavor": icecream.flavor,
+        "price": icecream.price,
+        "id": icecream.id,
+        "available_stock": icecream.available_stock,
+    }
+
+
+def serialize_cart_item(item: CartItem) -> dict[str, Any]:
+    return {
+        "icecream_id": item.icecream_id,
+        "quantity": item.quantity,
+        "id": item.id,
+        "icecream": serialize_icecream(item.icecream),
+    }
+
+
+def serialize_cart(cart: Cart) -> dict[str, Any]:
+    return {
+        "user_id": cart.user_id,
+        "id": cart.id,
+        "items": [serialize_cart_item(item) for item in cart.items],
+    }
+
+
+def serialize_order_item(item: OrderItem | OrderItemRow) -> dict[str, Any]:
+    return {
+        "icecream_id": item.icecream_id,
+        "order_id": item.order_id,
+        "quantity": item.quantity,
+        "total_price": item.total_price,
+        "id": item.id,
+        # Products deleted since then are no longer linked.
+        "icecream": item.icecream and serialize_icecream(item.icecream),
+    }
+
+
+def serialize_order(order: Order | OrderRow) -> dict[str, Any]:
+    return {
+        "user_id": order.user_id,
+        "status": order.status.value,
+        "id": order.id,
+        "amount": order.amount,
+        "items": [serialize_order_item(item) for item in order.items],
+    }
+
+
+def serialize_payment(payment: Payment) -> dict[str, Any]:
+    return {
+        "order_id": payment.order_id,
+        "user_id": payment.user_id,
+        "status": payment.status.value,
+        "amount": payment.amount,
+        "method": payment.method.value,
+        "id": payment.id,
+    }
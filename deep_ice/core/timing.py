@@ -0,0 +1,100 @@
+"""Per-stage request timing, reported through the `Server-Timing` header."""
+
+import random
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Iterator
+
+from starlette.datastructures import MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from deep_ice.core import logger
+from deep_ice.core.config import settings
+
+
+class RequestTiming:
+    """Durations accumulated by stage, as a stage can be entered multiple times."""
+
+    def __init__(self) -> None:
+        self.start = time.perf_counter()
+        self.stages: defaultdict[str, float] = defaultdict(float)
+
+    def get_durations(self) -> dict[str, float]:
+        # In milliseconds, including the total time spent so far.
+        durations = {stage: duration * 1000 for stage, duration in self.stages.items()}
+        durations["total"] = (time.perf_counter() - self.start) * 1000
+        return durations
+
+    def get_header(self) -> str:
+        return ", ".join(
+            f"{stage};dur={duration:.3f}"
+            for stage, duration in self.get_durations().items()
+        )
+
+
+_request_timing: ContextVar[RequestTiming | None] = ContextVar(
+    "request_timing", default=None
+)
+
+
+@contextmanager
+def timed(stage: str) -> Iterator[None]:
+    """Time a stage of the current request, if its timing is sampled."""
+    timing = _request_timing.get()
+    if not timing:
+        yield
+        return
+
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timing.stages[stage] += time.perf_counter() - start
+
+
+class ServerTimingMiddleware:
+    """Report the stage durations of a sample of the requests.
+
+    These are sent back with the `Server-Timing` header and logged along with the
+    request.
+    """
+
+    HEADER = "Server-Timing"
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if (
+            scope["type"] != "http"
+            or random.random() >= settings.SERVER_TIMING_SAMPLE_RATE
+        ):
+            await self.app(scope, receive, send)
+            return
+
+        timing = RequestTiming()
+        status_code = 500
+
+        async def send_wrapper(message: Message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+                MutableHeaders(scope=message)[self.HEADER] = timing.get_header()
+            await send(message)
+
+        token = _request_timing.set(timing)
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            _request_timing.reset(token)
+            durations = timing.get_durations()
+            logger.info(
+                "%s %s %d timing: %s",
+                scope["method"],
+                scope["path"],
+                status_code,
+                " ".join(f"{stage}={value:.3f}" for stage, value in durations.items()),
+                extra={"timing": durations},
+            )
@@ -0,0 +1,281 @@
+"""Bulk-load a synthetic dataset for evaluating the service at scale.
+
+Usage: python -m deep_ice.dataset --users 1000000 --orders 2000000 --icecream 1000
+"""
+
+import argparse
+import asyncio
+import enum
+import itertools
+import random
+from dataclasses import dataclass
+from typing import Any, Iterator
+
+from sqlalchemy import Table, func, insert, select, text
+from sqlalchemy.ext.asyncio import AsyncConnection
+from sqlmodel import SQLModel
+
+from deep_ice.core import init_logging, logger
+from deep_ice.core.security import get_password_hash
+from deep_ice.models import (
+    IceCream,
+    Order,
+    OrderItem,
+    OrderStatus,
+    Payment,
+    PaymentMethod,
+    PaymentStatus,
+    User,
+)
+
+FLAVORS = [
+    "vanilla",
+    "chocolate",
+    "strawberry",
+    "pistachio",
+    "mango",
+    "hazelnut",
+    "caramel",
+    "coconut",
+    "lemon",
+    "mint",
+]
+STYLES = ["Classic", "Double", "Vegan", "Gelato", "Sorbet", "Swirl", "Premium"]
+# Most orders get confirmed, a few fail and some are still waiting for payment.
+ORDER_STATUSES = {
+    OrderStatus.CONFIRMED: 0.9,
+    OrderStatus.CANCELLED: 0.07,
+    OrderStatus.PENDING: 0.03,
+}
+PAYMENT_STATUSES = {
+    OrderStatus.CONFIRMED: PaymentStatus.SUCCESS,
+    OrderStatus.CANCELLED: PaymentStatus.FAILED,
+    OrderStatus.PENDING: PaymentStatus.PENDING,
+}
+PASSWORD = "dataset-password"
+# Keeps multi-row inserts under the bound parameters limit of the drivers.
+MAX_PARAMS = 30_000
+
+
+@dataclass
+class DatasetSpec:
+    users: int = 100_000
+    orders: int = 200_000
+    icecream: int = 1_000
+    max_items: int = 3  # distinct flavors per order
+    skew: float = 1.1  # Zipf exponent of the flavor popularity
+    batch_size: int = 5_000
+    seed: int | None = None
+
+
+class DatasetGenerator:
+    """Generate rows in batches, loaded with COPY on PostgreSQL and multi-row inserts
+    otherwise.
+
+    IDs are assigned here, following the existing ones, so the rows referencing
+    each other can be generated without reading them back.
+    """
+
+    def __init__(self, conn: AsyncConnection, spec: DatasetSpec):
+        self._conn = conn
+        self._spec = spec
+        self._rng = random.Random(spec.seed)
+        self._copy = conn.dialect.name == "postgresql"
+
+    async def _get_next_id(self, model: type[SQLModel]) -> int:
+        table = self._get_table(model)
+        max_id = await self._conn.scalar(select(func.max(table.c.id)))
+        return (max_id or 0) + 1
+
+    @staticmethod
+    def _get_table(model: type[SQLModel]) -> Table:
+        return model.__table__  # type: ignore
+
+    async def _load(self, model: type[SQLModel], rows: list[dict[str, Any]]):
+        if not rows:
+            return
+
+        table = self._get_table(model)
+        if not self._copy:
+            chunk_size = MAX_PARAMS // len(rows[0])
+            for idx in range(0, len(rows), chunk_size):
+                await self._conn.execute(
+                    insert(table).values(rows[idx : idx + chunk_size])
+                )
+            return
+
+        # Enums are stored by name, as SQLAlchemy does it.
+        columns = list(rows[0])
+        records = [
+            tuple(
+                value.name if isinstance(value, enum.Enum) else value
+                for value in row.values()
+            )
+            for row in rows
+        ]
+        raw_conn = await self._conn.get_raw_connection()
+        await raw_conn.driver_connection.copy_records_to_table(  # type: ignore
+            table.name, records=records, columns=columns
+        )
+
+    def _batched(self, start: int, count: int) -> Iterator[range]:
+        for batch_start in range(start, start + count, self._spec.batch_size):
+            yield range(
+                batch_start, min(batch_start + self._spec.batch_size, start + count)
+            )
+
+    async def _generate_icecream(self) -> tuple[list[int], list[float]]:
+        start = await self._get_next_id(IceCream)
+        ids, prices = [], []
+        for batch in self._batched(start, self._spec.icecream):
+            rows = []
+            for icecream_id in batch:
+                flavor = self._rng.choice(FLAVORS)
+                style = self._rng.choice(STYLES)
+                price = round(self._rng.uniform(1.5, 9.5), 2)
+                rows.append(
+                    {
+                        "id": icecream_id,
+                        "name": f"{style} {flavor.title()} #{icecream_id}",
+                        "flavor": flavor,
+                        "price": price,
+                        "stock": self._rng.randint(100, 100_000),
+                        "blocked_quantity": 0,
+                        "is_active": self._rng.random() > 0.05,
+                    }
+                )
+                ids.append(icecream_id)
+                prices.append(price)
+            await self._load(IceCream, rows)
+        return ids, prices
+
+    async def _generate_users(self) -> range:
+        start = await self._get_next_id(User)
+        # Hashing is slow on purpose, so all the users share the same password.
+        hashed_password = get_password_hash(PASSWORD)
+        for batch in self._batched(start, self._spec.users):
+            await self._load(
+                User,
+                [
+                    {
+                        "id": user_id,
+                        "name": f"User {user_id}",
+                        "email": f"user.{user_id}@dataset.deepicecream.ai",
+                        "hashed_password": hashed_password,
+                        "is_active": True,
+                    }
+                    for user_id in batch
+                ],
+            )
+        return range(start, start + self._spec.users)
+
+    def _pick_icecream(self, weights: list[float], count: int) -> set[int]:
+        # Weighted picks of distinct products, as an order has one item per product.
+        picked: set[int] = set()
+        while len(picked) < count:
+            picked.update(self._rng.choices(range(len(weights)), cum_weights=weights))
+        return picked
+
+    async def _generate_orders(
+        self, user_ids: range, icecream_ids: list[int], prices: list[float]
+    ):
+        # Product popularity follows a Zipf distribution, a few get most of the sales.
+        cum_weights = list(
+            itertools.accumulate(
+                1 / rank**self._spec.skew for rank in range(1, len(icecream_ids) + 1)
+            )
+        )
+        max_items = min(self._spec.max_items, len(icecream_ids))
+        statuses, status_weights = zip(*ORDER_STATUSES.items())
+        start = await self._get_next_id(Order)
+        item_id = await self._get_next_id(OrderItem)
+        payment_id = await self._get_next_id(Payment)
+        for batch in self._batched(start, self._spec.orders):
+            orders, items, payments = [], [], []
+            for order_id in batch:
+                user_id = self._rng.choice(user_ids)
+                status = self._rng.choices(statuses, weights=status_weights)[0]
+                orders.append({"id": order_id, "user_id": user_id, "status": status})
+                amount = 0.0
+                count = self._rng.randint(1, max_items)
+                for idx in self._pick_icecream(cum_weights, count):
+                    quantity = self._rng.randint(1, 5)
+                    total_price = round(prices[idx] * quantity, 2)
+                    amount += total_price
+                    items.append(
+                        {
+                            "id": item_id,
+                            "order_id": order_id,
+                            "icecream_id": icecream_ids[idx],
+                            "quantity": quantity,
+                            "total_price": total_price,
+                        }
+                    )
+                    item_id += 1
+                payments.append(
+                    {
+                        "id": payment_id,
+                        "order_id": order_id,
+                        "user_id": user_id,
+                        "status": PAYMENT_STATUSES[status],
+                        "amount": round(amount, 2),
+                        "method": self._rng.choice(list(PaymentMethod)),
+                    }
+                )
+                payment_id += 1
+            await self._load(Order, orders)
+            await self._load(OrderItem, items)
+            await self._load(Payment, payments)
+            logger.info(
+                "Generated %d/%d orders.", batch.stop - start, self._spec.orders
+            )
+
+    async def _reset_sequences(self):
+        # Explicit IDs don't advance the sequences, which need to catch up.
+        if not self._copy:
+            return
+
+        for model in (IceCream, User, Order, OrderItem, Payment):
+            table = self._get_table(model).name
+            await self._conn.execute(
+                text(
+                    f"SELECT setval(pg_get_serial_sequence('{table}', 'id'),"
+                    f" (SELECT max(id) FROM {table}))"
+                )
+            )
+
+    async def generate(self):
+        icecream_ids, prices = await self._generate_icecream()
+        logger.info("Generated %d ice cream products.", len(icecream_ids))
+        user_ids = await self._generate_users()
+        logger.info("Generated %d users.", len(user_ids))
+        if icecream_ids and user_ids:
+            await self._generate_orders(user_ids, icecream_ids, prices)
+        await self._reset_sequences()
+
+
+async def generate_dataset(spec: DatasetSpec):
+    from deep_ice.core.database import get_engine
+
+    async_engine = get_engine()
+    async with async_engine.begin() as conn:
+        await DatasetGenerator(conn, spec).generate()
+    await async_engine.dispose()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    defaults = DatasetSpec()
+    for name, value in vars(defaults).items():
+        parser.add_argument(
+            f"--{name.replace('_', '-')}",
+            type=type(value) if value is not None else int,
+            default=value,
+        )
+    spec = DatasetSpec(**vars(parser.parse_args()))
+    init_logging()
+    asyncio.run(generate_dataset(spec))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,139 @@
+import asyncio
+import functools
+from contextlib import asynccontextmanager
+
+import sentry_sdk
+from arq import ArqRedis, create_pool
+from fastapi import FastAPI
+from fastapi.routing import APIRoute
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from deep_ice import init_sentry
+from deep_ice.core import init_logging, logger
+from deep_ice.core.config import get_redis_settings, settings
+from deep_ice.core.database import get_async_session, get_engine
+from deep_ice.core.loop_monitor import LoopLagMonitor
+from deep_ice.core.metrics import (
+    LOOP_LAG,
+    MetricsFlusher,
+    MetricsMiddleware,
+    QueryStatsMiddleware,
+)
+from deep_ice.core.profiling import ProfilingMiddleware
+from deep_ice.core.timing import ServerTimingMiddleware
+from deep_ice.models import IceCream, User
+from deep_ice.read_models import fetch_orders
+from deep_ice.services.cart import CartService
+from deep_ice.services.stats import stats_service
+
+WARM_UP_RETRY_DELAY = 1  # seconds
+
+
+def custom_generate_unique_id(route: APIRoute) -> str:
+    return f"{route.tags[0]}-{route.name}"
+
+
+async def warm_up_connections(redis_pool: ArqRedis):
+    # Each worker opens its pooled connections before serving, instead of making
+    #  the first requests wait for them.
+    engine = get_engine()
+    count = min(settings.WARM_UP_CONNECTIONS, settings.DB_POOL_SIZE)
+    connections = [engine.connect() for _ in range(count)]
+    try:
+        await asyncio.gather(*(conn.start() for conn in connections))
+    finally:
+        await asyncio.gather(*(conn.close() for conn in connections))
+    await redis_pool.ping()
+    await stats_service.ping()
+
+
+async def prime_hot_queries(session: AsyncSession):
+    """Run the queries of the busiest routes, so they're compiled and cached once.
+
+    IDs which don't exist are used, as only the statements matter.
+    """
+    from deep_ice.api.routes import icecream
+
+    await session.get(User, 0)
+    await CartService(session).get_cart(0)
+    await IceCream.fetch(session, filters=[IceCream.id == 0])
+    await fetch_orders(session, user_id=0)
+    await icecream.get_catalog(session)
+
+
+async def warm_up(fast_app: FastAPI):
+    attempts = settings.WARM_UP_ATTEMPTS
+    for attempt in range(1, attempts + 1):
+        try:
+            await warm_up_connections(fast_app.state.redis_pool)
+            async for session in get_async_session():
+                await prime_hot_queries(session)
+        except Exception as exc:
+            # Reported by the readiness probe, until a later attempt succeeds.
+            fast_app.state.warm_up_error = str(exc) or type(exc).__name__
+            if attempt == attempts:
+                logger.exception(
+                    "Warm-up failed %d times, giving up: %s", attempts, exc
+                )
+                sentry_sdk.capture_exception(exc)
+                return
+
+            logger.warning(
+                "Warm-up attempt %d/%d failed, retrying in %ds: %s",
+                attempt,
+                attempts,
+                WARM_UP_RETRY_DELAY,
+                exc,
+            )
+            await asyncio.sleep(WARM_UP_RETRY_DELAY)
+        else:
+            fast_app.state.warm_up_error = None
+            fast_app.state.ready = True
+            logger.info("Warm-up complete.")
+            return
+
+
+@asynccontextmanager
+async def lifespan(fast_app: FastAPI):
+    redis_pool = await create_pool(get_redis_settings())
+    fast_app.state.redis_pool = redis_pool
+    # Serving starts once warmed up, or after the timeout while still warming up.
+    fast_app.state.ready = False
+    fast_app.state.warm_up_error = None
+    warm_up_task = asyncio.create_task(warm_up(fast_app))
+    await asyncio.wait([warm_up_task], timeout=settings.WARM_UP_TIMEOUT)
+    loop_monitor = LoopLagMonitor(LOOP_LAG)
+    loop_monitor.start()
+    metrics_flusher = MetricsFlusher(redis_pool)
+    metrics_flusher.start()
+    yield
+    warm_up_task.cancel()
+    await loop_monitor.stop()
+    await metrics_flusher.stop()
+    await redis_pool.close()
+
+
+@functools.cache
+def get_app() -> FastAPI:
+    init_logging()
+    # Sentry patches the routes while they're created, so it goes first.
+    init_sentry()
+
+    from deep_ice.api import api_router
+    from deep_ice.api.routes import health, metrics
+
+    app = FastAPI(
+        title=settings.PROJECT_NAME,
+        openapi_url=f"{settings.API_V1_STR}/openapi.json",
+        generate_unique_id_function=custom_generate_unique_id,
+        lifespan=lifespan,
+    )
+    app.include_router(api_router, prefix=settings.API_V1_STR)
+    # Scraped by Prometheus, outside the versioned API.
+    app.include_router(metrics.router, tags=["metrics"])
+    app.include_router(health.router, tags=["health"])
+    app.add_middleware(ProfilingMiddleware)
+    app.add_middleware(QueryStatsMiddleware)
+    app.add_middleware(ServerTimingMiddleware)
+    app.add_middleware(MetricsMiddleware)
+    return app
@@ -1,17 +1,23 @@
 import enum
-from typing import Annotated, Any, Type, TypeVar
+import uuid
+from datetime import datetime, timezone
+from typing import TYPE_CHECKING, Annotated, Any, Type, TypeVar
 
 from pydantic import EmailStr
+from sqlalchemy import Index, func
 from sqlalchemy.engine.result import ScalarResult
 from sqlalchemy.ext.asyncio import AsyncAttrs, AsyncSession
-from sqlalchemy.orm import joinedload
+from sqlalchemy.orm import column_property, joinedload
 from sqlmodel import (
+    JSON,
     Column,
+    DateTime,
     Enum,
     Field,
     Relationship,
     SQLModel,
     UniqueConstraint,
+    col,
     select,
 )
 
@@ -70,15 +76,124 @@ class IceCream(BaseIceCream, FetchMixin, table=True):
     stock: int
     blocked_quantity: int = 0  # reserved during payments
     is_active: bool = True
+    # Hot flavors split their stock across multiple rows, updated independently.
+    #  (see `IceCreamStockSlot`)
+    stock_slots: Annotated[int, Field(sa_column_kwargs={"server_default": "1"})] = 1
 
     cart_items: list["CartItem"] = Relationship(
         back_populates="icecream", cascade_delete=True
     )
     order_items: list["OrderItem"] = Relationship(back_populates="icecream")
 
+    if TYPE_CHECKING:
+        slots_available_stock: int | None
+        ledger_available_delta: int | None
+
     @property
     def available_stock(self) -> int:
-        return self.stock - self.blocked_quantity
+        # The sharded flavors keep their stock and blocked quantities in slots.
+        if self.slots_available_stock is not None:
+            return self.slots_available_stock
+
+        # The others have them as a snapshot, plus the movements not compacted yet.
+        #  (none for the products which weren't loaded from the DB)
+        return self.stock - self.blocked_quantity + (self.ledger_available_delta or 0)
+
+
+class IceCreamStockSlot(SQLModel, table=True):
+    """A share of a sharded flavor's stock, with its own row lock.
+
+    The product row's `stock` and `blocked_quantity` are kept only as a snapshot
+    of the slot totals, refreshed when rebalancing them.
+    """
+
+    __tablename__ = "icecream_stock_slots"
+
+    icecream_id: Annotated[
+        int, Field(foreign_key="icecream.id", primary_key=True, ondelete="CASCADE")
+    ]
+    slot: Annotated[int, Field(primary_key=True)]
+    stock: int = 0
+    blocked_quantity: int = 0
+
+
+class StockMovementKind(enum.Enum):
+    RESERVE = "RESERVE"
+    RELEASE = "RELEASE"
+    SELL = "SELL"
+    RESTOCK = "RESTOCK"
+
+
+class StockMovement(SQLModel, FetchMixin, table=True):
+    """An append-only record of a change in a product's stock.
+
+    Movements are folded into the product's `stock` and `blocked_quantity`
+    snapshot once compacted, and kept afterwards as the stock history.
+    """
+
+    __tablename__ = "stock_movements"
+
+    # Generated on our side, so the movements get inserted in batches, without
+    #  waiting for their keys to be returned.
+    id: Annotated[uuid.UUID, Field(default_factory=uuid.uuid4, primary_key=True)]
+    icecream_id: Annotated[
+        int, Field(foreign_key="icecream.id", index=True, ondelete="CASCADE")
+    ]
+    # Looked up by order when releasing its stock or deleting it.
+    order_id: Annotated[
+        int | None,
+        Field(foreign_key="orders.id", nullable=True, ondelete="SET NULL", index=True),
+    ] = None
+    kind: Annotated[StockMovementKind, Field(sa_column=Column(Enum(StockMovementKind)))]
+    quantity: int
+    # The effect over the snapshot, as given by the kind of movement.
+    stock_delta: int = 0
+    blocked_delta: int = 0
+    compacted: bool = False
+    created_at: Annotated[
+        datetime,
+        Field(
+            sa_column=Column(DateTime(timezone=True)),
+            default_factory=lambda: datetime.now(timezone.utc),
+        ),
+    ]
+
+
+# Only the movements not compacted yet count towards the available stock, while the
+#  rest of the ledger just grows as history.
+Index(
+    "ix_stock_movements_pending",
+    col(StockMovement.icecream_id),
+    postgresql_where=col(StockMovement.compacted).is_(False),
+    sqlite_where=col(StockMovement.compacted).is_(False),
+)
+
+# Both are loaded along with the products and kept as loaded when flushing them,
+#  instead of being lazily loaded again. Slots are empty for the flavors without any.
+IceCream.slots_available_stock = column_property(  # type: ignore[assignment]
+    select(
+        func.sum(col(IceCreamStockSlot.stock) - col(IceCreamStockSlot.blocked_quantity))
+    )
+    .where(col(IceCreamStockSlot.icecream_id) == col(IceCream.id))
+    .correlate_except(IceCreamStockSlot)
+    .scalar_subquery(),
+    expire_on_flush=False,
+)
+IceCream.ledger_available_delta = column_property(  # type: ignore[assignment]
+    select(
+        func.coalesce(
+            func.sum(col(StockMovement.stock_delta) - col(StockMovement.blocked_delta)),
+            0,
+        )
+    )
+    .where(
+        col(StockMovement.icecream_id) == col(IceCream.id),
+        col(StockMovement.compacted).is_(False),
+    )
+    .correlate_except(StockMovement)
+    .scalar_subquery(),
+    expire_on_flush=False,
+)
 
 
 class RetrieveIceCream(BaseIceCream):
@@ -246,3 +361,63 @@ class Payment(BasePayment, FetchMixin, table=True):
 
 class RetrievePayment(BasePayment):
     id: int
+
+
+class CheckoutStatus(enum.Enum):
+    QUEUED = "QUEUED"
+    IN_PROGRESS = "IN_PROGRESS"
+    COMPLETED = "COMPLETED"  # with a payment made, which might be still pending
+    OUT_OF_STOCK = "OUT_OF_STOCK"
+    FAILED = "FAILED"
+
+
+class RetrieveCheckout(SQLModel):
+    id: str
+    status: CheckoutStatus
+    payment: RetrievePayment | None = None
+    detail: str | None = None
+
+
+class PaymentCallback(SQLModel):
+    order_id: int
+    status: PaymentStatus
+
+
+class RetrieveTopIceCream(SQLModel):
+    name: str
+    quantity: int
+
+
+class RetrieveMemoryDiff(SQLModel):
+    location: str
+    size: int
+    size_diff: int
+    count: int
+    count_diff: int
+
+
+class OutboxTopic(enum.Enum):
+    ORDER_CONFIRMED = "order.confirmed"
+    ORDER_CANCELLED = "order.cancelled"
+    PAYMENT_CREATED = "payment.created"
+    PAYMENT_UPDATED = "payment.updated"
+
+
+class OutboxEvent(SQLModel, FetchMixin, table=True):
+    __tablename__ = "outbox"
+
+    id: Annotated[int | None, Field(primary_key=True)] = None
+    # Kept as plain text, so new topics don't require a migration.
+    topic: str
+    payload: Annotated[dict[str, Any], Field(sa_column=Column(JSON))]
+    created_at: Annotated[
+        datetime,
+        Field(
+            sa_column=Column(DateTime(timezone=True)),
+            default_factory=lambda: datetime.now(timezone.utc),
+        ),
+    ]
+    dispatched_at: Annotated[
+        datetime | None,
+        Field(sa_column=Column(DateTime(timezone=True), index=True, nullable=True)),
+    ] = None
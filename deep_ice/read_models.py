@@ -0,0 +1,116 @@
+"""Read-only views of the listed rows, loaded without the ORM's unit of work.
+
+The columns are selected as plain Core rows and packed into named tuples, so there
+is no identity map, change tracking or relationship loading to pay for when
+listing many rows which get serialized right away. Their fields match the
+`Retrieve*` models.
+"""
+
+from typing import Any, NamedTuple
+
+from sqlalchemy import func, select
+from sqlmodel import col
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from deep_ice.models import IceCream, Order, OrderItem, OrderStatus
+
+
+class IceCreamRow(NamedTuple):
+    name: str
+    flavor: str
+    price: float
+    id: int
+    available_stock: int
+
+
+class OrderItemRow(NamedTuple):
+    icecream_id: int | None
+    order_id: int
+    quantity: int
+    total_price: float
+    id: int
+    icecream: IceCreamRow | None
+
+
+class OrderRow(NamedTuple):
+    user_id: int
+    status: OrderStatus
+    id: int
+    amount: float
+    items: list[OrderItemRow]
+
+
+_ICECREAM_COLUMNS: tuple[Any, ...] = (
+    col(IceCream.name),
+    col(IceCream.flavor),
+    col(IceCream.price),
+    col(IceCream.id),
+    func.coalesce(
+        IceCream.slots_available_stock,
+        col(IceCream.stock)
+        - col(IceCream.blocked_quantity)
+        + IceCream.ledger_available_delta,
+    ).label("available_stock"),
+)
+
+
+async def fetch_catalog(session: AsyncSession) -> list[IceCreamRow]:
+    result = await session.execute(
+        select(*_ICECREAM_COLUMNS).order_by(col(IceCream.id))
+    )
+    return [IceCreamRow(*row) for row in result]
+
+
+async def fetch_orders(session: AsyncSession, *, user_id: int) -> list[OrderRow]:
+    # A single query over the orders along with their items and products, grouped
+    #  back per order afterwards.
+    query = (
+        select(
+            col(Order.id),
+            col(Order.status),
+            col(OrderItem.id),
+            col(OrderItem.icecream_id),
+            col(OrderItem.quantity),
+            col(OrderItem.total_price),
+            *_ICECREAM_COLUMNS,
+        )
+        .outerjoin(OrderItem, col(OrderItem.order_id) == col(Order.id))
+        .outerjoin(IceCream, col(IceCream.id) == col(OrderItem.icecream_id))
+        .where(col(Order.user_id) == user_id)
+        .order_by(col(Order.id), col(OrderItem.id))
+    )
+    orders: dict[int, tuple[OrderStatus, list[OrderItemRow]]] = {}
+    # The same products repeat across orders, so they're shared between the items.
+    products: dict[int, IceCreamRow] = {}
+    for row in await session.execute(query):
+        order_id, status, item_id, icecream_id, quantity, total_price = row[:6]
+        _, items = orders.setdefault(order_id, (status, []))
+        if item_id is None:
+            continue  # an order without items
+
+        icecream = None
+        if icecream_id is not None:
+            icecream = products.get(icecream_id) or products.setdefault(
+                icecream_id, IceCreamRow(*row[6:])
+            )
+        items.append(
+            OrderItemRow(
+                icecream_id=icecream_id,
+                order_id=order_id,
+                quantity=quantity,
+                total_price=total_price,
+                id=item_id,
+                icecream=icecream,
+            )
+        )
+
+    return [
+        OrderRow(
+            user_id=user_id,
+            status=status,
+            id=order_id,
+            amount=sum(item.total_price for item in items),
+            items=items,
+        )
+        for order_id, (status, items) in orders.items()
+    ]
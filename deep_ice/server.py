@@ -0,0 +1,118 @@
+"""Pre-fork server running the API in multiple worker processes.
+
+The master process builds the app once, freezes everything created so far out of
+the garbage collector's reach and then forks the workers, all accepting
+connections on the same socket. This way the memory pages holding the app stay
+shared between the workers, instead of being copied once the collector touches
+them. (copy-on-write)
+
+    python -m deep_ice.server --port 80 --workers 4
+"""
+
+import argparse
+import gc
+import os
+import signal
+import socket
+import sys
+
+import uvicorn
+from uvicorn.config import Config
+
+
+class PreforkServer:
+    """Supervise the worker processes serving the app, restarting the crashed ones."""
+
+    STARTUP_FAILURE = 3
+
+    def __init__(self, config: Config, *, workers: int):
+        self._config = config
+        self._workers = workers
+        self._children: set[int] = set()
+        self._should_exit = False
+
+    def _warm_up(self):
+        # Imported here, after Uvicorn configures its loggers, so they get queued
+        #  like the rest by the logging setup.
+        from deep_ice import app
+
+        # Builds and caches the OpenAPI schema, along with the models validation.
+        app.openapi()
+        # The connections are opened by each worker, as they can't be shared.
+        gc.collect()
+        gc.freeze()
+
+    def _spawn(self, sock: socket.socket):
+        pid = os.fork()
+        if pid:
+            self._children.add(pid)
+            return
+
+        # Worker process from here on. Uvicorn handles the signals while serving,
+        #  then raises the captured ones again, to be ignored at that point.
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
+        server = uvicorn.Server(self._config)
+        server.run(sockets=[sock])
+        # Exiting normally (not through `os._exit`) flushes the queued logs.
+        sys.exit(0 if server.started else self.STARTUP_FAILURE)
+
+    def _handle_exit(self, signum, frame):
+        # Workers shut down gracefully on SIGTERM, even when receiving a SIGINT
+        #  already. (like on Ctrl+C in a terminal)
+        self._should_exit = True
+        for pid in self._children:
+            os.kill(pid, signal.SIGTERM)
+
+    def run(self):
+        from deep_ice.core import logger
+
+        sock = self._config.bind_socket()
+        self._warm_up()
+        for _ in range(self._workers):
+            self._spawn(sock)
+        signal.signal(signal.SIGINT, self._handle_exit)
+        signal.signal(signal.SIGTERM, self._handle_exit)
+        logger.info("Started %d workers from master [%d].", self._workers, os.getpid())
+
+        while self._children:
+            pid, status = os.wait()
+            self._children.discard(pid)
+            code = os.waitstatus_to_exitcode(status)
+            if self._should_exit:
+                continue
+
+            if code == self.STARTUP_FAILURE:
+                # The others won't start either, so there's nothing to keep serving.
+                logger.error("Worker [%d] failed to start, shutting down.", pid)
+                self._handle_exit(signal.SIGTERM, None)
+            else:
+                logger.warning("Worker [%d] exited with %d, restarting it.", pid, code)
+                self._spawn(sock)
+
+        sock.close()
+        logger.info("Stopped master [%d].", os.getpid())
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=80)
+    parser.add_argument(
+        "--workers", type=int, help="Defaults to the `WEB_WORKERS` setting."
+    )
+    args = parser.parse_args()
+    if args.workers:
+        # The connection pools are split by this count, so the settings built from
+        #  here on (by the forked workers too) follow the actual number of workers.
+        os.environ["WEB_WORKERS"] = str(args.workers)
+
+    # Configures the Uvicorn logging as well, before the app sets up its own.
+    config = Config("deep_ice:app", host=args.host, port=args.port, proxy_headers=True)
+    from deep_ice.core.config import settings
+
+    PreforkServer(config, workers=settings.WEB_WORKERS).run()
+
+
+if __name__ == "__main__":
+    main()
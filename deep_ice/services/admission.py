@@ -0,0 +1,255 @@
+"""Admission of the buyers into the checkout of the flavors on flash sale.
+
+Usage: python -m deep_ice.services.admission "Vanilla" [--close]
+"""
+
+import argparse
+import asyncio
+import enum
+import time
+from dataclasses import dataclass
+from typing import Mapping, cast
+
+from arq import create_pool
+from redis.asyncio import Redis
+from redis.asyncio.client import Pipeline
+
+from deep_ice.core import init_logging, logger
+from deep_ice.core.config import get_redis_settings, settings
+from deep_ice.core.database import get_async_session, get_engine
+from deep_ice.models import IceCream
+
+# Keys of every flavor on sale. They all share the same hash tag, so the scripts
+#  spanning the flavors of a cart run on a single node with Redis Cluster.
+KEYS = ("tokens", "queue", "seen", "holders", "seq")
+HASH_TAG = "{flash-sale}"
+
+# Admits a cart into the checkout only when all of its flavors on sale can take it.
+#  Buyers are `seen` until a deadline, which is further away once admitted.
+#  KEYS: the `KEYS` of each flavor in the cart
+#  ARGV: user, now, TTL, hold TTL, slots, followed by the quantity of each flavor
+ADMIT_SCRIPT = """
+local user, now = ARGV[1], tonumber(ARGV[2])
+local ttl, hold_ttl, slots = tonumber(ARGV[3]), tonumber(ARGV[4]), tonumber(ARGV[5])
+local held, wanted = {}, {}
+for idx = 0, #KEYS / 5 - 1 do
+    local tokens, queue, seen, holders, seq = unpack(KEYS, idx * 5 + 1, idx * 5 + 5)
+    local quantity = tonumber(ARGV[6 + idx])
+    if redis.call("EXISTS", tokens) == 1 then
+        -- Buyers who stopped retrying lose their place, along with what they held.
+        for _, stale in ipairs(redis.call("ZRANGEBYSCORE", seen, "-inf", now)) do
+            local stale_held = redis.call("HGET", holders, stale)
+            if stale_held then
+                redis.call("INCRBY", tokens, stale_held)
+                redis.call("HDEL", holders, stale)
+            end
+            redis.call("ZREM", queue, stale)
+        end
+        redis.call("ZREMRANGEBYSCORE", seen, "-inf", now)
+
+        local flavor = {tokens, queue, seen, holders, seq, quantity}
+        if redis.call("HEXISTS", holders, user) == 1 then
+            table.insert(held, flavor)
+        elseif tonumber(redis.call("GET", tokens)) < quantity then
+            -- Turned away before getting in any line, so no place is kept for it.
+            return {-1, 0}
+        else
+            table.insert(wanted, flavor)
+        end
+    end
+end
+
+local position = 0
+for _, flavor in ipairs(held) do
+    redis.call("ZADD", flavor[3], now + hold_ttl, user)
+end
+for _, flavor in ipairs(wanted) do
+    local queue, seen, seq = flavor[2], flavor[3], flavor[5]
+    if not redis.call("ZSCORE", queue, user) then
+        redis.call("ZADD", queue, redis.call("INCR", seq), user)
+    end
+    redis.call("ZADD", seen, now + ttl, user)
+    local rank = redis.call("ZRANK", queue, user)
+    position = math.max(position, rank - slots + 1)
+end
+if position > 0 then
+    return {0, position}
+end
+
+for _, flavor in ipairs(wanted) do
+    redis.call("DECRBY", flavor[1], flavor[6])
+    redis.call("HSET", flavor[4], user, flavor[6])
+    redis.call("ZADD", flavor[3], now + hold_ttl, user)
+end
+return {1, 0}
+"""
+
+# Keeps the place of an admitted buyer whose checkout is getting processed.
+#  KEYS: the `KEYS` of each flavor in the cart
+#  ARGV: user, the new deadline
+HOLD_SCRIPT = """
+local user = ARGV[1]
+for idx = 0, #KEYS / 5 - 1 do
+    local seen, holders = KEYS[idx * 5 + 3], KEYS[idx * 5 + 4]
+    if redis.call("HEXISTS", holders, user) == 1 then
+        redis.call("ZADD", seen, ARGV[2], user)
+    end
+end
+return 1
+"""
+
+# Takes the buyer out of line, giving back what it held unless it was sold.
+#  KEYS: the `KEYS` of each flavor in the cart
+#  ARGV: user, 1 for giving back the tokens or 0 otherwise
+LEAVE_SCRIPT = """
+local user = ARGV[1]
+for idx = 0, #KEYS / 5 - 1 do
+    local tokens, queue, seen, holders = unpack(KEYS, idx * 5 + 1, idx * 5 + 4)
+    local held = redis.call("HGET", holders, user)
+    if held and ARGV[2] == "1" and redis.call("EXISTS", tokens) == 1 then
+        redis.call("INCRBY", tokens, held)
+    end
+    redis.call("HDEL", holders, user)
+    redis.call("ZREM", queue, user)
+    redis.call("ZREM", seen, user)
+end
+return 1
+"""
+
+# Gives back the tokens of the sales which fell through after leaving the checkout,
+#  like card payments failing later on.
+#  KEYS: the tokens key of each flavor
+#  ARGV: the quantity of each flavor
+RETURN_SCRIPT = """
+for idx, tokens in ipairs(KEYS) do
+    if redis.call("EXISTS", tokens) == 1 then
+        redis.call("INCRBY", tokens, ARGV[idx])
+    end
+end
+return 1
+"""
+
+
+class AdmissionStatus(enum.Enum):
+    ADMITTED = "admitted"
+    WAITING = "waiting"
+    SOLD_OUT = "sold_out"
+
+
+@dataclass
+class Admission:
+    status: AdmissionStatus
+    position: int = 0  # in the waiting line, ahead of the checkout
+
+
+def _get_keys(icecream_id: int) -> list[str]:
+    return [f"{HASH_TAG}:{icecream_id}:{key}" for key in KEYS]
+
+
+class AdmissionService:
+    """Token bucket and waiting room for the flavors on flash sale.
+
+    Each flavor on sale gets as many tokens as its available stock, taken by the
+    carts admitted into the checkout and given back when they fail to pay. Only
+    the first `WAITING_ROOM_SLOTS` buyers in line check out at once, while the
+    ones which can't be served anymore are turned away right away.
+    """
+
+    _STATUSES = {
+        -1: AdmissionStatus.SOLD_OUT,
+        0: AdmissionStatus.WAITING,
+        1: AdmissionStatus.ADMITTED,
+    }
+
+    def __init__(self, redis: Redis):
+        self._redis = redis
+
+    async def admit(self, user_id: int, quantities: dict[int, int]) -> Admission:
+        """Let the user's cart into the checkout, given the quantity per flavor."""
+        keys = [key for icecream_id in quantities for key in _get_keys(icecream_id)]
+        args = [
+            user_id,
+            time.time(),
+            settings.WAITING_ROOM_TTL,
+            settings.WAITING_ROOM_HOLD_TTL,
+            settings.WAITING_ROOM_SLOTS,
+            *quantities.values(),
+        ]
+        status, position = await self._redis.eval(  # type: ignore[misc]
+            ADMIT_SCRIPT, len(keys), *keys, *map(str, args)
+        )
+        return Admission(self._STATUSES[int(status)], int(position))
+
+    async def hold(self, user_id: int, icecream_ids: list[int]):
+        """Keep the user's place in the checkout, as long as it's still admitted."""
+        keys = [key for icecream_id in icecream_ids for key in _get_keys(icecream_id)]
+        deadline = time.time() + settings.WAITING_ROOM_HOLD_TTL
+        await self._redis.eval(  # type: ignore[misc]
+            HOLD_SCRIPT, len(keys), *keys, str(user_id), str(deadline)
+        )
+
+    async def leave(self, user_id: int, icecream_ids: list[int], *, sold: bool):
+        """Free the user's place in the checkout, once done with it."""
+        keys = [key for icecream_id in icecream_ids for key in _get_keys(icecream_id)]
+        await self._redis.eval(  # type: ignore[misc]
+            LEAVE_SCRIPT, len(keys), *keys, str(user_id), str(int(not sold))
+        )
+
+    def queue_return(self, pipe: Pipeline, quantities: Mapping[int, int]):
+        """Add the commands giving back the tokens of cancelled orders to a Redis
+        pipeline, for the flavors still on sale."""
+        if not quantities:
+            return
+
+        keys = [_get_keys(icecream_id)[0] for icecream_id in quantities]
+        pipe.eval(RETURN_SCRIPT, len(keys), *keys, *map(str, quantities.values()))
+
+    async def open_sale(self, icecream: IceCream):
+        """Start admitting buyers, as long as the flavor's current stock lasts."""
+        keys = _get_keys(cast(int, icecream.id))
+        async with self._redis.pipeline(transaction=True) as pipe:
+            pipe.delete(*keys)
+            pipe.set(keys[0], icecream.available_stock)
+            await pipe.execute()
+        logger.info(
+            "Flash sale of %r opened with %d tokens.",
+            icecream.name,
+            icecream.available_stock,
+        )
+
+    async def close_sale(self, icecream: IceCream):
+        """Let buyers check out the flavor freely again."""
+        await self._redis.delete(*_get_keys(cast(int, icecream.id)))
+        logger.info("Flash sale of %r closed.", icecream.name)
+
+
+async def toggle_sale(name: str, *, close: bool):
+    redis = await create_pool(get_redis_settings())
+    try:
+        async for session in get_async_session():
+            icecream = (
+                await IceCream.fetch(session, filters=[IceCream.name == name])
+            ).one()
+            admission = AdmissionService(redis)
+            if close:
+                await admission.close_sale(icecream)
+            else:
+                await admission.open_sale(icecream)
+    finally:
+        await redis.close()
+        await get_engine().dispose()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("name", help="Name of the ice cream product.")
+    parser.add_argument(
+        "--close", action="store_true", help="End the sale instead of starting it."
+    )
+    args = parser.parse_args()
+    init_logging()
+    asyncio.run(toggle_sale(args.name, close=args.close))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,6 @@
 from sqlmodel.ext.asyncio.session import AsyncSession
 
+from deep_ice.core.timing import timed
 from deep_ice.models import Cart, CartItem
 
 
@@ -10,17 +11,18 @@ class CartService:
         self._session = session
 
     async def get_cart(self, user_id: int) -> Cart | None:
-        cart: Cart | None = (
-            (
-                await Cart.fetch(
-                    self._session,
-                    filters=[Cart.user_id == user_id],
-                    joinedloads=[Cart.items, CartItem.icecream],
+        with timed("cart"):
+            cart: Cart | None = (
+                (
+                    await Cart.fetch(
+                        self._session,
+                        filters=[Cart.user_id == user_id],
+                        joinedloads=[Cart.items, CartItem.icecream],
+                    )
                 )
+                .unique()
+                .one_or_none()
             )
-            .unique()
-            .one_or_none()
-        )
         return cart
 
     async def ensure_cart(self, user_id: int) -> Cart:
@@ -43,7 +45,8 @@ class CartService:
 
     async def check_items_against_stock(self, cart: Cart) -> bool:
         # Ensure once again that we still have on stock the items we intend to buy.
-        await self._refresh_icecream_stock(cart)
+        with timed("stock"):
+            await self._refresh_icecream_stock(cart)
         cart_ok = True
         for item in cart.items:
             if item.quantity > item.icecream.available_stock:
@@ -0,0 +1,216 @@
+import asyncio
+import uuid
+from typing import Any, cast
+
+import sentry_sdk
+from aioredlock import Aioredlock, LockError
+from arq import ArqRedis
+from sqlalchemy.exc import SQLAlchemyError
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from deep_ice.core import logger
+from deep_ice.core.config import settings
+from deep_ice.core.database import get_session_maker
+from deep_ice.core.metrics import REDLOCK_ACQUIRE_LATENCY, REDLOCK_FAILURES
+from deep_ice.core.timing import timed
+from deep_ice.models import (
+    Cart,
+    CheckoutStatus,
+    Payment,
+    PaymentMethod,
+    RetrievePayment,
+)
+from deep_ice.services.admission import AdmissionService
+from deep_ice.services.cart import CartService
+from deep_ice.services.inventory import (
+    InventoryError,
+    ReservationCoalescer,
+    reservation_coalescer,
+)
+from deep_ice.services.order import OrderService
+from deep_ice.services.payment import (
+    PaymentError,
+    PaymentService,
+    get_payment_stub,
+)
+
+
+class CheckoutError(Exception):
+    """The order couldn't be made or paid for."""
+
+
+class StockChangedError(CheckoutError):
+    """The cart got adjusted to the stock left, waiting for the user to review it."""
+
+
+def get_checkout_id() -> str:
+    return uuid.uuid4().hex
+
+
+def get_checkout_queue(cart: Cart | None = None, *, partition: int = 0) -> str:
+    # Carts are partitioned by their first flavor, so the checkouts of the same
+    #  flavors line up in the same queue.
+    if cart is not None:
+        partition = min(item.icecream_id for item in cart.items)
+        partition %= settings.CHECKOUT_PARTITIONS
+    return f"arq:checkout:{partition}"
+
+
+async def checkout_task(
+    ctx, *, user_id: int, method: PaymentMethod, icecream_ids: list[int]
+) -> dict[str, Any]:
+    payment = None
+    admission_service = AdmissionService(ctx["redis"])
+    # Queued for a while maybe, so the place is kept from here on.
+    await admission_service.hold(user_id, icecream_ids)
+    try:
+        async with get_session_maker()() as session:
+            cart_service = CartService(session)
+            cart = await cart_service.get_cart(user_id)
+            if not cart or not cart.items:
+                return {
+                    "status": CheckoutStatus.FAILED,
+                    "detail": "There are no items in the cart",
+                }
+
+            checkout_service = CheckoutService(
+                session,
+                cart_service=cart_service,
+                redlock=ctx["redlock"],
+                redis=ctx["redis"],
+            )
+            try:
+                payment = await checkout_service.checkout(cart, method=method)
+            except StockChangedError:
+                return {
+                    "status": CheckoutStatus.OUT_OF_STOCK,
+                    "detail": "The cart was adjusted to the available stock",
+                }
+            except CheckoutError:
+                return {"status": CheckoutStatus.FAILED, "detail": "Payment failed"}
+    finally:
+        # The next in line gets the place, along with the tokens left unsold.
+        await admission_service.leave(user_id, icecream_ids, sold=payment is not None)
+
+    if payment is None:
+        return {
+            "status": CheckoutStatus.FAILED,
+            "detail": "Checkout is busy, try again",
+        }
+    return {
+        "status": CheckoutStatus.COMPLETED,
+        "payment": RetrievePayment.model_validate(payment).model_dump(mode="json"),
+    }
+
+
+class CheckoutService:
+    """Turn the cart into a paid order, while holding the locks of its flavors."""
+
+    def __init__(
+        self,
+        session: AsyncSession,
+        *,
+        cart_service: CartService,
+        redlock: Aioredlock,
+        redis: ArqRedis,
+    ):
+        self._session = session
+        self._cart_service = cart_service
+        self._redlock = redlock
+        # Card payments are queued further for the main worker, through this pool.
+        self._redis = redis
+
+    async def _make_payment(
+        self,
+        cart: Cart,
+        *,
+        method: PaymentMethod,
+        coalescer: ReservationCoalescer | None = None,
+    ) -> Payment:
+        # Items are available and ready to be sold, make the order and pay for it.
+        order_service = OrderService(self._session, coalescer=coalescer)
+        payment_service = PaymentService(
+            self._session,
+            order_service=order_service,
+            payment_processor=get_payment_stub(),
+            redis=self._redis,
+        )
+        order = None
+        try:
+            with timed("order"):
+                order = await order_service.make_order_from_cart(cart)
+            with timed("payment"):
+                payment = await payment_service.make_payment_from_order(
+                    order, method=method
+                )
+            # With a payment triggered over a successfully created order, we can
+            #  safely delete the cart and all its contents.
+            await self._session.delete(cart)
+        except (SQLAlchemyError, PaymentError, InventoryError) as exc:
+            if isinstance(exc, InventoryError):
+                logger.warning("Stock error: %s", exc)
+            else:
+                logger.exception("Payment error: %s", exc)
+                sentry_sdk.capture_exception(exc)
+            if order:
+                await order_service.drop_order(order)
+            else:
+                await self._session.rollback()
+            raise CheckoutError("Payment failed") from exc
+        except asyncio.CancelledError:
+            # Given up midway, like on client disconnects, with the coalesced stock
+            #  already committed.
+            if coalescer and order:
+                coalescer.abandon(cast(int, order.id))
+            raise
+
+        await self._session.commit()
+        return payment
+
+    async def _checkout_coalesced(
+        self, cart: Cart, *, method: PaymentMethod
+    ) -> Payment:
+        # The stock is checked while reserving it, so the flavors aren't locked and
+        #  the concurrent checkouts get their reservations committed together.
+        if not await self._cart_service.check_items_against_stock(cart):
+            raise StockChangedError("Not enough stock for the cart")
+
+        try:
+            return await self._make_payment(
+                cart, method=method, coalescer=reservation_coalescer
+            )
+        except CheckoutError as exc:
+            if not isinstance(exc.__cause__, InventoryError):
+                raise
+
+            # Sold to others in the meantime, so the cart follows the stock left.
+            await self._cart_service.check_items_against_stock(cart)
+            raise StockChangedError("Not enough stock for the cart") from exc
+
+    async def checkout(self, cart: Cart, *, method: PaymentMethod) -> Payment | None:
+        """Order and pay for the cart, returning nothing if it couldn't be locked."""
+        if settings.RESERVATION_WINDOW:
+            return await self._checkout_coalesced(cart, method=method)
+
+        lock_keys = [f"ice-lock:{item.icecream_id}" for item in cart.items]
+        locks = []
+        try:
+            for lock_key in lock_keys:
+                with REDLOCK_ACQUIRE_LATENCY.time(), timed("lock"):
+                    lock = await self._redlock.lock(lock_key)
+                locks.append(lock)
+
+                cart_ok = await self._cart_service.check_items_against_stock(cart)
+                if not cart_ok:
+                    raise StockChangedError("Not enough stock for the cart")
+
+                return await self._make_payment(cart, method=method)
+        except LockError as exc:
+            REDLOCK_FAILURES.inc()
+            logger.exception("Payment lock error with key %r: %s", lock_key, exc)
+            sentry_sdk.capture_exception(exc)
+        finally:
+            for lock in locks:
+                await self._redlock.unlock(lock)
+
+        return None
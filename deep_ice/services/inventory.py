@@ -0,0 +1,680 @@
+"""Stock reservations, kept either in a ledger or split into slots.
+
+The ledger reservations made concurrently by the checkouts of a process can also
+be committed together, through the `ReservationCoalescer`.
+
+Usage: python -m deep_ice.services.inventory "Vanilla" --slots 8
+"""
+
+import argparse
+import asyncio
+import random
+from abc import ABC, abstractmethod
+from collections import defaultdict
+from dataclasses import dataclass
+from typing import Any, Callable, Coroutine, cast
+
+import sentry_sdk
+from sqlalchemy import ColumnElement
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.orm import Mapped
+from sqlalchemy.orm.attributes import set_committed_value
+from sqlmodel import col, delete, func, select, update
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from deep_ice.core import init_logging, logger
+from deep_ice.core.config import settings
+from deep_ice.core.database import get_async_session, get_engine, get_session_maker
+from deep_ice.core.metrics import RESERVATION_BATCH_SIZE
+from deep_ice.models import (
+    IceCream,
+    IceCreamStockSlot,
+    Order,
+    OrderStatus,
+    Payment,
+    StockMovement,
+    StockMovementKind,
+)
+
+Slot = IceCreamStockSlot
+SlotChanges = Callable[[int], dict[str, Any]]
+
+# How each kind of movement changes the stock and blocked quantities.
+MOVEMENT_DELTAS: dict[StockMovementKind, tuple[int, int]] = {
+    StockMovementKind.RESERVE: (0, 1),
+    StockMovementKind.RELEASE: (0, -1),
+    StockMovementKind.SELL: (-1, -1),
+    StockMovementKind.RESTOCK: (1, 0),
+}
+
+
+async def rebalance_inventory_task(ctx) -> int:
+    rebalanced = 0
+    async for session in get_async_session():
+        inventory = ShardedInventory(session)
+        sharded = await IceCream.fetch(session, filters=[col(IceCream.stock_slots) > 1])
+        for icecream in sharded.all():
+            await inventory.rebalance(icecream)
+            # Slots are locked for as little as possible, one flavor at a time.
+            await session.commit()
+            rebalanced += 1
+
+    return rebalanced
+
+
+async def compact_stock_ledger_task(ctx) -> int:
+    compacted = 0
+    async for session in get_async_session():
+        compacted = await LedgerInventory(session).compact()
+        await session.commit()
+
+    return compacted
+
+
+class InventoryError(Exception):
+    """Not enough stock left to reserve, sell or release."""
+
+
+class InventoryInterface(ABC):
+    @abstractmethod
+    async def reserve(
+        self, icecream: IceCream, quantity: int, *, order_id: int | None = None
+    ):
+        """Block a quantity of the product while its order is being paid."""
+
+    @abstractmethod
+    async def release(
+        self, icecream: IceCream, quantity: int, *, order_id: int | None = None
+    ):
+        """Unblock the quantity reserved by a cancelled order."""
+
+    @abstractmethod
+    async def deduct(
+        self, icecream: IceCream, quantity: int, *, order_id: int | None = None
+    ):
+        """Take the quantity reserved by a confirmed order out of the stock."""
+
+    @abstractmethod
+    async def restock(self, icecream: IceCream, quantity: int):
+        """Add a quantity of the product to its stock."""
+
+
+def _add_movement(
+    session: AsyncSession,
+    icecream_id: int | None,
+    kind: StockMovementKind,
+    quantity: int,
+    *,
+    order_id: int | None = None,
+    compacted: bool = False,
+) -> int:
+    # Returns the change in the available stock.
+    stock_sign, blocked_sign = MOVEMENT_DELTAS[kind]
+    movement = StockMovement(
+        icecream_id=icecream_id,
+        order_id=order_id,
+        kind=kind,
+        quantity=quantity,
+        stock_delta=stock_sign * quantity,
+        blocked_delta=blocked_sign * quantity,
+        compacted=compacted,
+    )
+    session.add(movement)
+    return movement.stock_delta - movement.blocked_delta
+
+
+def _shift_available(icecream: IceCream, key: str, delta: int):
+    # The availability loaded along with the product follows its changes, just like
+    #  its own columns do, without marking it as modified.
+    if (value := icecream.__dict__.get(key)) is not None:
+        set_committed_value(icecream, key, value + delta)
+
+
+class LedgerInventory(InventoryInterface):
+    """Stock changes appended as movements, without touching the product row.
+
+    The product's `stock` and `blocked_quantity` are a snapshot, to which the
+    movements are periodically added by compacting them.
+    """
+
+    def __init__(self, session: AsyncSession):
+        self._session = session
+
+    def _append(
+        self,
+        icecream: IceCream,
+        kind: StockMovementKind,
+        quantity: int,
+        order_id: int | None = None,
+    ):
+        delta = _add_movement(
+            self._session, icecream.id, kind, quantity, order_id=order_id
+        )
+        _shift_available(icecream, "ledger_available_delta", delta)
+
+    async def reserve(
+        self, icecream: IceCream, quantity: int, *, order_id: int | None = None
+    ):
+        self._append(icecream, StockMovementKind.RESERVE, quantity, order_id)
+
+    async def release(
+        self, icecream: IceCream, quantity: int, *, order_id: int | None = None
+    ):
+        self._append(icecream, StockMovementKind.RELEASE, quantity, order_id)
+
+    async def deduct(
+        self, icecream: IceCream, quantity: int, *, order_id: int | None = None
+    ):
+        self._append(icecream, StockMovementKind.SELL, quantity, order_id)
+
+    async def restock(self, icecream: IceCream, quantity: int):
+        self._append(icecream, StockMovementKind.RESTOCK, quantity)
+
+    async def release_order(self, order_id: int):
+        """Give back the stock still blocked for an order which is dropped.
+
+        Only what's left blocked after its other movements (sold or released) is
+        given back, so releasing the same order twice has no further effect.
+        """
+        blocked = await self._session.exec(
+            select(
+                col(StockMovement.icecream_id),
+                func.sum(col(StockMovement.blocked_delta)),
+            )
+            .join(IceCream, col(IceCream.id) == col(StockMovement.icecream_id))
+            # The sharded flavors keep their blocked stock in slots instead.
+            .where(
+                col(StockMovement.order_id) == order_id, col(IceCream.stock_slots) <= 1
+            )
+            .group_by(col(StockMovement.icecream_id))
+        )
+        for icecream_id, quantity in blocked.all():
+            if quantity > 0:
+                _add_movement(
+                    self._session,
+                    icecream_id,
+                    StockMovementKind.RELEASE,
+                    quantity,
+                    order_id=order_id,
+                )
+
+    async def compact(self, icecream_id: int | None = None) -> int:
+        """Fold the movements into the snapshot of their products.
+
+        Only the committed movements get marked as compacted, so the ones still
+        being written are left for the next compaction.
+        """
+        query = update(StockMovement).where(  # type: ignore
+            col(StockMovement.compacted).is_(False)
+        )
+        if icecream_id is not None:
+            query = query.where(col(StockMovement.icecream_id) == icecream_id)
+        movements = await self._session.exec(
+            query.values(compacted=True).returning(  # type: ignore
+                col(StockMovement.icecream_id),
+                col(StockMovement.stock_delta),
+                col(StockMovement.blocked_delta),
+            )
+        )
+        deltas: dict[int, list[int]] = defaultdict(lambda: [0, 0])
+        count = 0
+        for movement_icecream_id, stock_delta, blocked_delta in movements:
+            deltas[movement_icecream_id][0] += stock_delta
+            deltas[movement_icecream_id][1] += blocked_delta
+            count += 1
+
+        # Products are updated in order, against deadlocks with other compactions. The
+        #  loaded ones are left as they are, along with their loaded movements delta.
+        for movement_icecream_id, (stock_delta, blocked_delta) in sorted(
+            deltas.items()
+        ):
+            await self._session.exec(
+                update(IceCream)  # type: ignore
+                .where(col(IceCream.id) == movement_icecream_id)
+                .values(
+                    stock=col(IceCream.stock) + stock_delta,
+                    blocked_quantity=col(IceCream.blocked_quantity) + blocked_delta,
+                )
+                .execution_options(synchronize_session=False)
+            )
+        if count:
+            logger.info(
+                "Compacted %d stock movements of %d products.", count, len(deltas)
+            )
+        return count
+
+
+@dataclass
+class _Reservation:
+    items: list[tuple[IceCream, int]]
+    order_id: int | None
+    granted: asyncio.Future[bool]
+
+
+class ReservationCoalescer:
+    """Group commit of the ledger reservations made concurrently in this process.
+
+    Carts reserving within the same short window are checked at once against the
+    stock of their products, locked for the whole batch, and granted in their
+    order of arrival, each either entirely or not at all. The granted movements
+    are then written with a single commit, instead of one per checkout.
+    """
+
+    def __init__(
+        self,
+        *,
+        window: float | None = None,
+        batch_size: int | None = None,
+        session_maker: Callable[[], AsyncSession] | None = None,
+    ):
+        # Without explicit values, the settings are read on use. (not on import)
+        self._window = window
+        self._batch_size = batch_size
+        self._session_maker = session_maker
+        self._batch: list[_Reservation] = []
+        # Reservations of the orders which aren't granted or refused yet.
+        self._pending: dict[int, asyncio.Future[bool]] = {}
+        self._flusher: asyncio.Task | None = None
+        self._tasks: set[asyncio.Task] = set()
+
+    def _spawn(self, coro: Coroutine[Any, Any, None]):
+        # Kept until done, as the event loop holds weak references to tasks only.
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    @property
+    def window(self) -> float:
+        return settings.RESERVATION_WINDOW if self._window is None else self._window
+
+    @property
+    def batch_size(self) -> int:
+        if self._batch_size is None:
+            return settings.RESERVATION_BATCH_SIZE
+        return self._batch_size
+
+    def _get_session(self) -> AsyncSession:
+        session_maker = self._session_maker or get_session_maker()
+        return session_maker()
+
+    async def reserve(
+        self, items: list[tuple[IceCream, int]], *, order_id: int | None = None
+    ):
+        """Reserve all the quantities of the products, or raise if any won't fit."""
+        reservation = _Reservation(
+            items, order_id, asyncio.get_running_loop().create_future()
+        )
+        self._batch.append(reservation)
+        if order_id is not None:
+            self._pending[order_id] = reservation.granted
+            reservation.granted.add_done_callback(
+                lambda _: self._pending.pop(order_id, None)
+            )
+        if len(self._batch) >= self.batch_size:
+            # A full batch doesn't wait for the window to end.
+            self._spawn(self._flush(self._take_batch()))
+        elif not self._flusher:
+            self._flusher = asyncio.create_task(self._flush_later())
+
+        # A cancelled caller leaves the batch committing its reservation regardless,
+        #  so it can be given back through `abandon` once settled.
+        if not await asyncio.shield(reservation.granted):
+            raise InventoryError("Not enough stock for the cart")
+
+        for icecream, quantity in items:
+            _shift_available(icecream, "ledger_available_delta", -quantity)
+
+    def _take_batch(self) -> list[_Reservation]:
+        batch, self._batch = self._batch, []
+        return batch
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.window)
+        self._flusher = None
+        await self._flush(self._take_batch())
+
+    def abandon(self, order_id: int):
+        """Give back the stock reserved for an order whose checkout was given up.
+
+        Done in the background, with a session of its own, as the caller is being
+        cancelled. Orders paid in the meantime are left as they are.
+        """
+        self._spawn(self._abandon(order_id))
+
+    async def _abandon(self, order_id: int):
+        if pending := self._pending.get(order_id):
+            await asyncio.wait([pending])
+
+        try:
+            async with self._get_session() as session:
+                paid = await Payment.fetch(
+                    session, filters=[Payment.order_id == order_id]
+                )
+                if paid.first():
+                    return
+
+                await LedgerInventory(session).release_order(order_id)
+                order = await session.get(Order, order_id)
+                if order and order.status is OrderStatus.PENDING:
+                    await session.delete(order)
+                await session.commit()
+        except SQLAlchemyError as exc:
+            logger.exception("Couldn't abandon order #%d: %s", order_id, exc)
+            sentry_sdk.capture_exception(exc)
+            return
+
+        logger.warning("Abandoned order #%d, releasing its stock.", order_id)
+
+    async def _flush(self, batch: list[_Reservation]):
+        if not batch:
+            return
+
+        try:
+            granted = await self._commit(batch)
+        except Exception as exc:
+            for reservation in batch:
+                reservation.granted.set_exception(exc)
+            return
+
+        RESERVATION_BATCH_SIZE.observe(len(batch))
+        for reservation, ok in zip(batch, granted):
+            reservation.granted.set_result(ok)
+
+    async def _commit(self, batch: list[_Reservation]) -> list[bool]:
+        icecream_ids = sorted(
+            {
+                cast(int, icecream.id)
+                for reservation in batch
+                for icecream, _ in reservation.items
+            }
+        )
+        async with self._get_session() as session:
+            # Products are locked in order, against deadlocks with the other
+            #  processes, then read once locked, so their latest movements count too.
+            await session.exec(
+                select(IceCream.id)
+                .where(col(IceCream.id).in_(icecream_ids))
+                .order_by(col(IceCream.id))
+                .with_for_update()
+            )
+            available: dict[int | None, int] = dict(
+                (
+                    await session.exec(
+                        select(
+                            IceCream.id,
+                            col(IceCream.stock)
+                            - col(IceCream.blocked_quantity)
+                            + IceCream.ledger_available_delta,
+                        ).where(col(IceCream.id).in_(icecream_ids))
+                    )
+                ).all()
+            )
+
+            granted = []
+            for reservation in batch:
+                ok = all(
+                    available[icecream.id] >= quantity
+                    for icecream, quantity in reservation.items
+                )
+                if ok:
+                    for icecream, quantity in reservation.items:
+                        available[icecream.id] -= quantity
+                        _add_movement(
+                            session,
+                            icecream.id,
+                            StockMovementKind.RESERVE,
+                            quantity,
+                            order_id=reservation.order_id,
+                        )
+                granted.append(ok)
+            await session.commit()
+
+        return granted
+
+
+def _spread(total: int, parts: int) -> list[int]:
+    # Even shares, with the remainder going to the first ones.
+    share, remainder = divmod(total, parts)
+    return [share + (idx < remainder) for idx in range(parts)]
+
+
+class ShardedInventory(InventoryInterface):
+    """Stock split across `IceCream.stock_slots` rows, changed independently.
+
+    Concurrent buyers of the same flavor land on random slots, instead of queueing
+    up for the same row lock. An operation not fitting into a single slot spreads
+    over all of them, while a periodic rebalance evens out their stock.
+    """
+
+    def __init__(self, session: AsyncSession):
+        self._session = session
+
+    async def _apply(
+        self,
+        icecream: IceCream,
+        quantity: int,
+        *,
+        capacity: ColumnElement[int] | Mapped[int],
+        changes: SlotChanges,
+    ):
+        icecream_id = col(Slot.icecream_id) == icecream.id
+        # Most of the time, a random slot alone can take the whole quantity.
+        slot = random.randrange(icecream.stock_slots)
+        result = await self._session.exec(
+            update(Slot)  # type: ignore
+            .where(icecream_id, col(Slot.slot) == slot, capacity >= quantity)
+            .values(**changes(quantity))
+        )
+        if result.rowcount:
+            return
+
+        # Otherwise it's spread over the slots, locked in order against deadlocks.
+        rows = (
+            await self._session.exec(
+                select(Slot.slot, capacity)
+                .where(icecream_id)
+                .order_by(col(Slot.slot))
+                .with_for_update()
+            )
+        ).all()
+        if sum(available for _, available in rows) < quantity:
+            raise InventoryError(f"Not enough stock for {icecream.name!r}")
+
+        left = quantity
+        for slot, available in rows:
+            if part := min(available, left):
+                await self._session.exec(
+                    update(Slot)  # type: ignore
+                    .where(icecream_id, col(Slot.slot) == slot)
+                    .values(**changes(part))
+                )
+                left -= part
+            if not left:
+                break
+
+    async def reserve(
+        self, icecream: IceCream, quantity: int, *, order_id: int | None = None
+    ):
+        await self._apply(
+            icecream,
+            quantity,
+            capacity=col(Slot.stock) - col(Slot.blocked_quantity),
+            changes=lambda part: {
+                "blocked_quantity": col(Slot.blocked_quantity) + part
+            },
+        )
+        self._add_movement(icecream, StockMovementKind.RESERVE, quantity, order_id)
+
+    async def release(
+        self, icecream: IceCream, quantity: int, *, order_id: int | None = None
+    ):
+        await self._apply(
+            icecream,
+            quantity,
+            capacity=col(Slot.blocked_quantity),
+            changes=lambda part: {
+                "blocked_quantity": col(Slot.blocked_quantity) - part
+            },
+        )
+        self._add_movement(icecream, StockMovementKind.RELEASE, quantity, order_id)
+
+    async def deduct(
+        self, icecream: IceCream, quantity: int, *, order_id: int | None = None
+    ):
+        await self._apply(
+            icecream,
+            quantity,
+            capacity=col(Slot.blocked_quantity),
+            changes=lambda part: {
+                "stock": col(Slot.stock) - part,
+                "blocked_quantity": col(Slot.blocked_quantity) - part,
+            },
+        )
+        self._add_movement(icecream, StockMovementKind.SELL, quantity, order_id)
+
+    async def restock(self, icecream: IceCream, quantity: int):
+        # Any slot can take it, as the rebalancing spreads it to the others later.
+        slot = random.randrange(icecream.stock_slots)
+        await self._session.exec(
+            update(Slot)  # type: ignore
+            .where(col(Slot.icecream_id) == icecream.id, col(Slot.slot) == slot)
+            .values(stock=col(Slot.stock) + quantity)
+        )
+        self._add_movement(icecream, StockMovementKind.RESTOCK, quantity)
+
+    def _add_movement(
+        self,
+        icecream: IceCream,
+        kind: StockMovementKind,
+        quantity: int,
+        order_id: int | None = None,
+    ):
+        # Kept for the history only, since the slots already account for them.
+        delta = _add_movement(
+            self._session,
+            icecream.id,
+            kind,
+            quantity,
+            order_id=order_id,
+            compacted=True,
+        )
+        _shift_available(icecream, "slots_available_stock", delta)
+
+    async def _get_slots(self, icecream: IceCream) -> list[IceCreamStockSlot]:
+        query = (
+            select(Slot)
+            .where(col(Slot.icecream_id) == icecream.id)
+            .order_by(col(Slot.slot))
+            .with_for_update()
+            # Locked rows get their latest values, not the ones known by the session.
+            .execution_options(populate_existing=True)
+        )
+        return list((await self._session.exec(query)).all())
+
+    async def _fold_slots(self, icecream: IceCream) -> list[IceCreamStockSlot]:
+        # Brings the slot totals back into the product row.
+        slots = await self._get_slots(icecream)
+        if slots:
+            icecream.stock = sum(slot.stock for slot in slots)
+            icecream.blocked_quantity = sum(slot.blocked_quantity for slot in slots)
+        return slots
+
+    async def rebalance(self, icecream: IceCream):
+        """Spread the stock evenly across the slots, keeping what each blocked."""
+        slots = await self._fold_slots(icecream)
+        free = _spread(icecream.stock - icecream.blocked_quantity, len(slots))
+        for slot, slot_free in zip(slots, free, strict=True):
+            slot.stock = slot.blocked_quantity + slot_free
+        self._session.add_all([icecream, *slots])
+
+    async def set_slots(self, icecream: IceCream, slots: int):
+        """Split the stock across this many slots, or keep it in the ledger with 1."""
+        # The slots start from the latest snapshot.
+        await LedgerInventory(self._session).compact(icecream.id)
+        await self._session.refresh(icecream)
+        if await self._fold_slots(icecream):
+            await self._session.exec(
+                delete(Slot).where(col(Slot.icecream_id) == icecream.id)  # type: ignore
+            )
+        icecream.stock_slots = slots
+        self._session.add(icecream)
+        if slots > 1:
+            free = _spread(icecream.stock - icecream.blocked_quantity, slots)
+            blocked = _spread(icecream.blocked_quantity, slots)
+            self._session.add_all(
+                [
+                    Slot(
+                        icecream_id=icecream.id,
+                        slot=idx,
+                        stock=blocked[idx] + free[idx],
+                        blocked_quantity=blocked[idx],
+                    )
+                    for idx in range(slots)
+                ]
+            )
+        logger.info("Stock of %r split across %d slots.", icecream.name, slots)
+
+
+class InventoryService(InventoryInterface):
+    """Keep the stock of each flavor according to its model. (ledger or sharded)"""
+
+    def __init__(self, session: AsyncSession):
+        self._ledger_inventory = LedgerInventory(session)
+        self._sharded_inventory = ShardedInventory(session)
+
+    def _get_inventory(self, icecream: IceCream) -> InventoryInterface:
+        if icecream.stock_slots > 1:
+            return self._sharded_inventory
+        return self._ledger_inventory
+
+    async def reserve(
+        self, icecream: IceCream, quantity: int, *, order_id: int | None = None
+    ):
+        await self._get_inventory(icecream).reserve(
+            icecream, quantity, order_id=order_id
+        )
+
+    async def release(
+        self, icecream: IceCream, quantity: int, *, order_id: int | None = None
+    ):
+        await self._get_inventory(icecream).release(
+            icecream, quantity, order_id=order_id
+        )
+
+    async def deduct(
+        self, icecream: IceCream, quantity: int, *, order_id: int | None = None
+    ):
+        await self._get_inventory(icecream).deduct(
+            icecream, quantity, order_id=order_id
+        )
+
+    async def restock(self, icecream: IceCream, quantity: int):
+        await self._get_inventory(icecream).restock(icecream, quantity)
+
+
+reservation_coalescer = ReservationCoalescer()
+
+
+async def split_stock(name: str, *, slots: int):
+    async for session in get_async_session():
+        icecream = (
+            await IceCream.fetch(session, filters=[IceCream.name == name])
+        ).one()
+        await ShardedInventory(session).set_slots(icecream, slots)
+        await session.commit()
+    await get_engine().dispose()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("name", help="Name of the ice cream product.")
+    parser.add_argument(
+        "--slots", type=int, default=1, help="Stock slots, with 1 for none."
+    )
+    args = parser.parse_args()
+    init_logging()
+    asyncio.run(split_stock(args.name, slots=args.slots))
+
+
+if __name__ == "__main__":
+    main()
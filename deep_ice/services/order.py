@@ -1,19 +1,36 @@
+import asyncio
 from typing import cast
 
 from sqlalchemy.exc import SQLAlchemyError
+from sqlmodel import col, update
 from sqlmodel.ext.asyncio.session import AsyncSession
 
 from deep_ice.core import logger
-from deep_ice.models import Cart, Order, OrderItem, OrderStatus
-from deep_ice.services.stats import StatsInterface
+from deep_ice.models import Cart, IceCream, Order, OrderItem, OrderStatus, OutboxTopic
+from deep_ice.services.inventory import (
+    InventoryError,
+    InventoryService,
+    LedgerInventory,
+    ReservationCoalescer,
+)
+from deep_ice.services.outbox import OutboxService
 
 
 class OrderService:
     """Manage orders, their status and ice cream stock implications."""
 
-    def __init__(self, session: AsyncSession, *, stats_service: StatsInterface):
+    def __init__(
+        self, session: AsyncSession, *, coalescer: ReservationCoalescer | None = None
+    ):
         self._session = session
-        self._stats_service = stats_service
+        self._outbox_service = OutboxService(session)
+        self._inventory = InventoryService(session)
+        self._coalescer = coalescer
+
+    def _is_coalesced(self, icecream: IceCream) -> bool:
+        # Only the flavors kept in the ledger, as the sharded ones already spread
+        #  their writes across slots.
+        return self._coalescer is not None and icecream.stock_slots <= 1
 
     async def _get_order(self, order_id: int) -> Order:
         order: Order = (
@@ -29,11 +46,30 @@ class OrderService:
         )
         return order
 
-    async def confirm_order(self, order_id: int):
-        order = await self._get_order(order_id)
-        order.status = OrderStatus.CONFIRMED
-        self._session.add(order)
+    async def _transition_order(self, order_id: int, status: OrderStatus) -> bool:
+        # Moves the order out of its pending status with a conditional update, so only
+        #  the first of any repeated or concurrent transitions gets to act upon it.
+        result = await self._session.exec(
+            update(Order)  # type: ignore
+            .where(col(Order.id) == order_id, col(Order.status) == OrderStatus.PENDING)
+            .values(status=status)
+        )
+        if not result.rowcount:
+            logger.warning(
+                "Order #%d isn't pending anymore, skipping the %s transition.",
+                order_id,
+                status.value,
+            )
+            return False
 
+        return True
+
+    async def confirm_order(self, order_id: int) -> bool:
+        if not await self._transition_order(order_id, OrderStatus.CONFIRMED):
+            return False
+
+        order = await self._get_order(order_id)
+        sold_items = []
         for item in order.items:
             if (icecream := item.icecream) is None:
                 logger.warning(
@@ -41,18 +77,32 @@ class OrderService:
                 )
                 continue
 
-            icecream.stock -= item.quantity
-            icecream.blocked_quantity -= item.quantity
-            self._session.add(icecream)
-            await self._stats_service.acknowledge_icecream_demand(
-                cast(int, icecream.id), name=icecream.name, quantity=item.quantity
+            await self._inventory.deduct(icecream, item.quantity, order_id=order_id)
+            sold_items.append(
+                {
+                    "icecream_id": icecream.id,
+                    "name": icecream.name,
+                    "quantity": item.quantity,
+                    "revenue": item.total_price,
+                }
             )
 
-    async def cancel_order(self, order_id: int):
-        order = await self._get_order(order_id)
-        order.status = OrderStatus.CANCELLED
-        self._session.add(order)
+        # Stats and notifications are dispatched later on, out of the same
+        #  transaction confirming the order.
+        self._outbox_service.add_event(
+            OutboxTopic.ORDER_CONFIRMED,
+            order_id=order_id,
+            user_id=order.user_id,
+            items=sold_items,
+        )
+        return True
+
+    async def cancel_order(self, order_id: int) -> bool:
+        if not await self._transition_order(order_id, OrderStatus.CANCELLED):
+            return False
 
+        order = await self._get_order(order_id)
+        released_items = []
         for item in order.items:
             if (icecream := item.icecream) is None:
                 logger.warning(
@@ -60,8 +110,19 @@ class OrderService:
                 )
                 continue
 
-            icecream.blocked_quantity -= item.quantity
-            self._session.add(icecream)
+            await self._inventory.release(icecream, item.quantity, order_id=order_id)
+            released_items.append(
+                {"icecream_id": icecream.id, "quantity": item.quantity}
+            )
+
+        # The flash sale tokens kept for the order are given back when dispatched.
+        self._outbox_service.add_event(
+            OutboxTopic.ORDER_CANCELLED,
+            order_id=order_id,
+            user_id=order.user_id,
+            items=released_items,
+        )
+        return True
 
     async def make_order_from_cart(self, cart: Cart) -> Order:
         # Creates and saves an order out of the current cart and returns it for later
@@ -72,13 +133,24 @@ class OrderService:
         await self._session.refresh(order)
 
         try:
+            coalesced = [
+                (item.icecream, item.quantity)
+                for item in cart.items
+                if self._is_coalesced(item.icecream)
+            ]
+            if self._coalescer and coalesced:
+                # Committed on its own, along with the reservations of other carts.
+                await self._coalescer.reserve(coalesced, order_id=order.id)
+
             order_items = await order.awaitable_attrs.items
             for cart_item in cart.items:
                 icecream = cart_item.icecream
                 # NOTE(cmin764): Make sure to deduct this blocked amount from the main
                 #  stock once the order gets confirmed.
-                icecream.blocked_quantity += cart_item.quantity
-                self._session.add(icecream)
+                if not self._is_coalesced(icecream):
+                    await self._inventory.reserve(
+                        icecream, cart_item.quantity, order_id=order.id
+                    )
 
                 order_item = OrderItem(
                     icecream_id=icecream.id,
@@ -89,10 +161,24 @@ class OrderService:
                 order_items.append(order_item)
 
             self._session.add_all(order_items)
-        except SQLAlchemyError:
-            await self._session.rollback()
-            await self._session.delete(order)
-            await self._session.commit()
+        except (SQLAlchemyError, InventoryError):
+            await self.drop_order(order)
+            raise
+        except asyncio.CancelledError:
+            if self._coalescer:
+                # The coalesced stock might get committed regardless.
+                self._coalescer.abandon(cast(int, order.id))
             raise
 
         return order
+
+    async def drop_order(self, order: Order):
+        # Removes the order which couldn't be made or paid for, along with what it
+        #  had in the current transaction.
+        order_id = cast(int, order.id)  # read before being expired by the rollback
+        await self._session.rollback()
+        if self._coalescer:
+            # The stock reserved by the coalescer was already committed.
+            await LedgerInventory(self._session).release_order(order_id)
+        await self._session.delete(order)
+        await self._session.commit()
@@ -0,0 +1,177 @@
+import json
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+from typing import Any
+
+import redis.asyncio as aioredis
+import sentry_sdk
+from redis.exceptions import RedisError
+from sqlmodel import col, delete, select, update
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from deep_ice.core import logger
+from deep_ice.core.config import settings
+from deep_ice.core.database import get_async_session
+from deep_ice.core.log import SAMPLED
+from deep_ice.core.metrics import STATS_WRITE_LATENCY
+from deep_ice.models import OutboxEvent, OutboxTopic
+from deep_ice.services.admission import AdmissionService
+from deep_ice.services.stats import StatsBuffer, StatsService, stats_service
+
+
+async def dispatch_outbox_task(ctx) -> int:
+    dispatched = 0
+    async for session in get_async_session():
+        dispatcher = OutboxDispatcher(
+            session, redis=ctx["redis"], stats_service=stats_service
+        )
+        dispatched = await dispatcher.dispatch()
+
+    return dispatched
+
+
+def _as_utc(moment: datetime) -> datetime:
+    # Some backends (like SQLite) drop the timezone info of the stored values.
+    return moment if moment.tzinfo else moment.replace(tzinfo=timezone.utc)
+
+
+class OutboxService:
+    """Record events within the same transaction as the changes causing them."""
+
+    def __init__(self, session: AsyncSession):
+        self._session = session
+
+    def add_event(self, topic: OutboxTopic, **payload: Any):
+        self._session.add(OutboxEvent(topic=topic.value, payload=payload))
+
+
+class OutboxDispatcher:
+    """Deliver the recorded events to Redis stats and pub/sub, at least once.
+
+    Every delivered event leaves a marker in Redis, written atomically with its
+    effects, so an event delivered again (after a crash or a failed commit) gets
+    skipped instead of being counted twice.
+    """
+
+    APPLIED_KEY = "OUTBOX_APPLIED"
+    APPLIED_TTL = timedelta(days=1)
+    STATS_KEY = "OUTBOX_STATS"
+    CHANNEL = "ORDER_EVENTS"
+
+    def __init__(
+        self,
+        session: AsyncSession,
+        *,
+        redis: aioredis.Redis,
+        stats_service: StatsService,
+        batch_size: int | None = None,
+    ):
+        self._session = session
+        self._redis = redis
+        self._stats_service = stats_service
+        self._admission_service = AdmissionService(redis)
+        self._batch_size = (
+            settings.OUTBOX_BATCH_SIZE if batch_size is None else batch_size
+        )
+
+    async def _fetch_batch(self) -> list[OutboxEvent]:
+        # Concurrent dispatchers skip the events already picked up by the others.
+        query = (
+            select(OutboxEvent)
+            .where(col(OutboxEvent.dispatched_at).is_(None))
+            .order_by(col(OutboxEvent.id))
+            .limit(self._batch_size)
+            .with_for_update(skip_locked=True)
+        )
+        return list((await self._session.exec(query)).all())
+
+    def _queue_events(self, pipe, events: list[OutboxEvent], *, now: datetime):
+        buffer = StatsBuffer()
+        returned: Counter[int] = Counter()
+        for event in events:
+            if event.topic == OutboxTopic.ORDER_CANCELLED.value:
+                # Events recorded before carrying the items have nothing to return.
+                for item in event.payload.get("items", []):
+                    returned[item["icecream_id"]] += item["quantity"]
+            elif event.topic == OutboxTopic.ORDER_CONFIRMED.value:
+                for item in event.payload["items"]:
+                    buffer.add_demand(
+                        item["icecream_id"],
+                        name=item["name"],
+                        quantity=item["quantity"],
+                        revenue=item["revenue"],
+                        buyer_id=event.payload["user_id"],
+                    )
+            message = {
+                "id": event.id,
+                "topic": event.topic,
+                "payload": event.payload,
+                "created_at": _as_utc(event.created_at).isoformat(),
+            }
+            pipe.publish(self.CHANNEL, json.dumps(message))
+            pipe.set(f"{self.APPLIED_KEY}:{event.id}", 1, ex=self.APPLIED_TTL)
+        self._stats_service.queue_stats(pipe, buffer, now=now)
+        self._admission_service.queue_return(pipe, returned)
+
+    async def dispatch_batch(self) -> int:
+        """Deliver the next batch of events and return how many were dispatched."""
+        events = await self._fetch_batch()
+        now = datetime.now(timezone.utc)
+        if not events:
+            await self._redis.hset(  # type: ignore[misc]
+                self.STATS_KEY, mapping={"lag_seconds": 0}
+            )
+            return 0
+
+        applied = await self._redis.mget(
+            [f"{self.APPLIED_KEY}:{event.id}" for event in events]
+        )
+        pending = [
+            event
+            for event, is_applied in zip(events, applied, strict=True)
+            if not is_applied
+        ]
+        lag = (now - _as_utc(events[0].created_at)).total_seconds()
+        pipe = self._redis.pipeline(transaction=True)
+        self._queue_events(pipe, pending, now=now)
+        # Dispatch lag, how long the oldest event of the batch waited to go out.
+        pipe.hset(self.STATS_KEY, mapping={"lag_seconds": lag})
+        pipe.hincrby(self.STATS_KEY, "dispatched", len(pending))
+        async with STATS_WRITE_LATENCY.time_shared(self._redis):
+            await pipe.execute()
+
+        await self._session.exec(
+            update(OutboxEvent)  # type: ignore
+            .where(col(OutboxEvent.id).in_([event.id for event in events]))
+            .values(dispatched_at=now)
+        )
+        await self._session.commit()
+        logger.info(
+            "Dispatched %d events with a lag of %.3fs.", len(events), lag, extra=SAMPLED
+        )
+        return len(events)
+
+    async def dispatch(self) -> int:
+        """Deliver all the pending events in batches."""
+        dispatched = 0
+        try:
+            while count := await self.dispatch_batch():
+                dispatched += count
+                if count < self._batch_size:
+                    break
+        except RedisError as exc:
+            # The events are left in place and retried with the next dispatch.
+            logger.exception("Outbox dispatch error: %s", exc)
+            sentry_sdk.capture_exception(exc)
+            await self._session.rollback()
+
+        retention = datetime.now(timezone.utc) - timedelta(
+            days=settings.OUTBOX_RETENTION_DAYS
+        )
+        await self._session.exec(
+            delete(OutboxEvent).where(  # type: ignore
+                col(OutboxEvent.dispatched_at) < retention
+            )
+        )
+        await self._session.commit()
+        return dispatched
@@ -1,27 +1,51 @@
 import asyncio
+import functools
+import json
 import random
 from abc import ABC, abstractmethod
 from dataclasses import dataclass
 from typing import Literal, cast
 
+import httpx
 import sentry_sdk
-from arq import Retry
+from arq import ArqRedis, Retry
+from sqlmodel import col, update
 from sqlmodel.ext.asyncio.session import AsyncSession
 
-from deep_ice.core import logger
+from deep_ice.core import logger, security
 from deep_ice.core.config import settings
 from deep_ice.core.database import get_async_session
-from deep_ice.models import Order, Payment, PaymentMethod, PaymentStatus
+from deep_ice.core.log import SAMPLED
+from deep_ice.core.metrics import PAYMENT_JOB_LATENCY
+from deep_ice.core.profiling import profiled_task
+from deep_ice.core.timing import timed
+from deep_ice.models import Order, OutboxTopic, Payment, PaymentMethod, PaymentStatus
 from deep_ice.services.order import OrderService
-from deep_ice.services.stats import stats_service
+from deep_ice.services.outbox import OutboxService
 
 
 async def make_payment_task(
     ctx, order_id: int, amount: float, *, method: PaymentMethod, _stub_dict: dict
+) -> str:
+    async with PAYMENT_JOB_LATENCY.time_shared(ctx["redis"]):
+        with profiled_task(f"make_payment_task-{order_id}"):
+            return await _process_payment(
+                ctx, order_id, amount, method=method, _stub_dict=_stub_dict
+            )
+
+
+async def _process_payment(
+    ctx, order_id: int, amount: float, *, method: PaymentMethod, _stub_dict: dict
 ) -> str:
     from deep_ice import TaskQueue
 
     stub = PaymentStub(**_stub_dict)
+    if stub.callback_url:
+        # The gateway calls us back with the result, so there's no need to keep the
+        #  worker waiting for it.
+        pending = await stub.submit_payment(order_id, amount, method=method)
+        return pending.value
+
     status = await stub.make_payment(order_id, amount, method=method)
     if status is PaymentStatus.FAILED:
         attempts = ctx["job_try"]
@@ -36,20 +60,20 @@ async def make_payment_task(
             raise Retry(defer=attempts * settings.TASK_BACKOFF_FACTOR)
 
     async for session in get_async_session():
-        order_service = OrderService(session, stats_service=stats_service)
+        order_service = OrderService(session)
         payment_service = PaymentService(
             session, order_service=order_service, payment_processor=stub
         )
-        await payment_service.set_order_payment_status(order_id, status)
-        if status is PaymentStatus.SUCCESS:
-            await order_service.confirm_order(order_id)
-        elif status is PaymentStatus.FAILED:
-            await order_service.cancel_order(order_id)
+        await payment_service.apply_payment_status(order_id, status)
         await session.commit()
 
     return status.value
 
 
+def get_payment_job_id(order_id: int) -> str:
+    return f"payment:{order_id}"
+
+
 class PaymentError(Exception):
     """Base class for immediate payment failures. (like invalid card info)"""
 
@@ -72,8 +96,77 @@ class PaymentInterface(ABC):
         amount: float,
         *,
         method: PaymentMethod,
+        redis: ArqRedis,
+    ) -> Literal[PaymentStatus.PENDING]:
+        """Non-blocking method for making a payment, queued through `redis`."""
+
+    @abstractmethod
+    async def submit_payment(
+        self,
+        order_id: int,
+        amount: float,
+        *,
+        method: PaymentMethod,
     ) -> Literal[PaymentStatus.PENDING]:
-        """Non-blocking method for making a payment."""
+        """Callback-based method for making a payment."""
+
+
+class FakeGateway:
+    """Local payment gateway calling back our webhook once a charge gets processed.
+
+    This way the whole callback flow can be exercised offline, without a real
+    payment provider.
+    """
+
+    def __init__(self, transport: httpx.AsyncBaseTransport | None = None):
+        self._transport = transport
+        self._charges: set[asyncio.Task] = set()
+
+    def charge(
+        self,
+        order_id: int,
+        *,
+        status: PaymentStatus,
+        delay: int,
+        callback_url: str,
+    ) -> None:
+        # Keep a reference to the running charge, so it doesn't get garbage collected
+        #  before calling us back.
+        charge = asyncio.create_task(
+            self._process(
+                order_id, status=status, delay=delay, callback_url=callback_url
+            )
+        )
+        self._charges.add(charge)
+        charge.add_done_callback(self._charges.discard)
+
+    async def _process(
+        self,
+        order_id: int,
+        *,
+        status: PaymentStatus,
+        delay: int,
+        callback_url: str,
+    ) -> None:
+        await asyncio.sleep(delay)
+        payload = json.dumps({"order_id": order_id, "status": status.value}).encode()
+        headers = {
+            "Content-Type": "application/json",
+            security.SIGNATURE_HEADER: security.sign_payload(payload),
+        }
+        try:
+            async with httpx.AsyncClient(transport=self._transport) as client:
+                response = await client.post(
+                    callback_url, content=payload, headers=headers
+                )
+                response.raise_for_status()
+        except httpx.HTTPError as exc:
+            logger.exception("Payment callback error for order #%d: %s", order_id, exc)
+            sentry_sdk.capture_exception(exc)
+
+    async def join(self):
+        """Wait for all the in-progress charges to call back."""
+        await asyncio.gather(*self._charges)
 
 
 @dataclass
@@ -85,6 +178,22 @@ class PaymentStub(PaymentInterface):
     # Enable failures (or not) and at what rate.
     allow_failures: bool = False
     failure_rate: float = 0.2
+    # Where the gateway reports back the payment result. (blocking mode if not set)
+    callback_url: str | None = None
+
+    def _get_wait_time(self) -> int:
+        return random.randint(self.min_delay, self.max_delay)
+
+    def _get_result(self) -> PaymentStatus:
+        if self.allow_failures:
+            # Simulate payment result: 80% chance of success, 20% chance of failure.
+            return random.choices(
+                [PaymentStatus.SUCCESS, PaymentStatus.FAILED],
+                weights=[1 - self.failure_rate, self.failure_rate],
+                k=1,
+            )[0]
+
+        return PaymentStatus.SUCCESS
 
     async def make_payment(
         self,
@@ -111,6 +220,7 @@ class PaymentStub(PaymentInterface):
             method.value,
             order_id,
             amount,
+            extra=SAMPLED,
         )
 
         if method is PaymentMethod.CASH:
@@ -119,36 +229,67 @@ class PaymentStub(PaymentInterface):
             return PaymentStatus.SUCCESS
 
         # Simulate payment processing times and potential for failure for card ones.
-        wait_time = random.randint(self.min_delay, self.max_delay)
-        logger.info("Processing payment, this may take up to %d seconds...", wait_time)
+        wait_time = self._get_wait_time()
+        logger.info(
+            "Processing payment, this may take up to %d seconds...",
+            wait_time,
+            extra=SAMPLED,
+        )
         await asyncio.sleep(wait_time)
 
-        if self.allow_failures:
-            # Simulate payment result: 80% chance of success, 20% chance of failure.
-            payment_result = random.choices(
-                [PaymentStatus.SUCCESS, PaymentStatus.FAILED],
-                weights=[1 - self.failure_rate, self.failure_rate],
-                k=1,
-            )[0]
-        else:
-            payment_result = PaymentStatus.SUCCESS
-
-        logger.info("Payment result: %s", payment_result.value)
+        payment_result = self._get_result()
+        logger.info("Payment result: %s", payment_result.value, extra=SAMPLED)
         return payment_result
 
     async def make_payment_async(
-        self, order_id: int, amount: float, *, method: PaymentMethod
+        self, order_id: int, amount: float, *, method: PaymentMethod, redis: ArqRedis
     ) -> Literal[PaymentStatus.PENDING]:
-        from deep_ice import app
-
-        with sentry_sdk.start_transaction(name="payment-tasks"):
-            await app.state.redis_pool.enqueue_job(
+        with sentry_sdk.start_transaction(name="payment-tasks"), timed("enqueue"):
+            # Keyed by order, so the same order can't be queued for payment twice.
+            job = await redis.enqueue_job(
                 make_payment_task.__name__,
                 order_id,
                 amount,
                 method=method,
                 _stub_dict=self.__dict__,
+                _job_id=get_payment_job_id(order_id),
             )
+        if not job:
+            logger.warning("Payment for order #%d is already queued.", order_id)
+        return PaymentStatus.PENDING
+
+    async def submit_payment(
+        self, order_id: int, amount: float, *, method: PaymentMethod
+    ) -> Literal[PaymentStatus.PENDING]:
+        """Submit the charge to the gateway and return right away.
+
+        The gateway processes the payment in the meantime and reports its result
+        through the `callback_url` webhook.
+
+        Args:
+            order_id: The ID of the order for which payment is being made.
+            amount: The total amount to be charged. (in USD)
+            method: The payment method to use. (CASH/CARD)
+
+        Returns:
+            The `PENDING` status, as the result is known only on callback.
+        """
+        if not self.callback_url:
+            raise PaymentError("Can't submit a payment without a callback URL")
+
+        logger.info(
+            "Submitting %s payment for order %d of amount $%f...",
+            method.value,
+            order_id,
+            amount,
+            extra=SAMPLED,
+        )
+        fake_gateway.charge(
+            order_id,
+            status=self._get_result(),
+            delay=self._get_wait_time(),
+            callback_url=self.callback_url,
+        )
         return PaymentStatus.PENDING
 
 
@@ -161,21 +302,30 @@ class PaymentService:
         *,
         order_service: OrderService,
         payment_processor: PaymentInterface,
+        redis: ArqRedis | None = None,
     ):
         self._session = session
         self._order_service = order_service
         self._payment_processor = payment_processor
+        # The task queue pool, needed by the card payments only.
+        self._redis = redis
+        self._outbox_service = OutboxService(session)
 
     async def make_payment_from_order(
         self, order: Order, *, method: PaymentMethod
     ) -> Payment:
-        make_payment = {
-            PaymentMethod.CASH: self._payment_processor.make_payment,
-            PaymentMethod.CARD: self._payment_processor.make_payment_async,
-        }
-        payment_status = await make_payment[method](
-            cast(int, order.id), order.amount, method=method
-        )
+        order_id = cast(int, order.id)
+        payment_status: PaymentStatus
+        if method is PaymentMethod.CARD:
+            if not self._redis:
+                raise PaymentError("Card payments can't be queued without Redis")
+            payment_status = await self._payment_processor.make_payment_async(
+                order_id, order.amount, method=method, redis=self._redis
+            )
+        else:
+            payment_status = await self._payment_processor.make_payment(
+                order_id, order.amount, method=method
+            )
         payment = Payment(
             order_id=order.id,
             user_id=order.user_id,
@@ -184,6 +334,12 @@ class PaymentService:
             method=method,
         )
         self._session.add(payment)
+        self._outbox_service.add_event(
+            OutboxTopic.PAYMENT_CREATED,
+            order_id=order.id,
+            status=payment_status.value,
+            method=method.value,
+        )
 
         if payment_status is PaymentStatus.SUCCESS:
             await self._order_service.confirm_order(cast(int, order.id))
@@ -192,12 +348,51 @@ class PaymentService:
 
         return payment
 
-    async def set_order_payment_status(self, order_id: int, status: PaymentStatus):
-        payment: Payment = (
+    async def set_order_payment_status(
+        self, order_id: int, status: PaymentStatus
+    ) -> bool:
+        # Only pending payments can get a result, and only once.
+        result = await self._session.exec(
+            update(Payment)  # type: ignore
+            .where(
+                col(Payment.order_id) == order_id,
+                col(Payment.status) == PaymentStatus.PENDING,
+            )
+            .values(status=status)
+        )
+        if result.rowcount:
+            self._outbox_service.add_event(
+                OutboxTopic.PAYMENT_UPDATED, order_id=order_id, status=status.value
+            )
+            return True
+
+        # Raises if there's no payment at all for this order.
+        (
             await Payment.fetch(self._session, filters=[Payment.order_id == order_id])
         ).one()
-        payment.status = status
-        self._session.add(payment)
+        logger.warning("Payment for order #%d was already processed.", order_id)
+        return False
+
+    async def apply_payment_status(self, order_id: int, status: PaymentStatus):
+        # Reflects the payment result on the payment itself and its order.
+        if not await self.set_order_payment_status(order_id, status):
+            return
+
+        if status is PaymentStatus.SUCCESS:
+            await self._order_service.confirm_order(order_id)
+        elif status is PaymentStatus.FAILED:
+            await self._order_service.cancel_order(order_id)
+
+
+fake_gateway = FakeGateway()
 
 
-payment_stub = PaymentStub(1, 3, allow_failures=True, failure_rate=0.2)
+@functools.cache
+def get_payment_stub() -> PaymentStub:
+    return PaymentStub(
+        1,
+        3,
+        allow_failures=True,
+        failure_rate=0.2,
+        callback_url=settings.PAYMENT_CALLBACK_URL or None,
+    )
@@ -1,50 +1,241 @@
+import enum
+import functools
 from abc import ABC, abstractmethod
-from collections import OrderedDict
+from collections import Counter, OrderedDict, defaultdict
+from dataclasses import dataclass, field
+from datetime import date, datetime, timedelta, timezone
+from typing import NamedTuple
 
 import redis.asyncio as aioredis
+from redis.asyncio.client import Pipeline
 
-from deep_ice.core.config import redis_settings
+from deep_ice.core.config import settings
+
+# Folds the all-time counts of the "<name>:<id>" members (as products used to be
+#  ranked) into their ID ones, keeping the names aside if not known already.
+#  KEYS: popularity ranking, product names
+MIGRATE_POPULARITY_SCRIPT = """
+local members = redis.call("ZRANGE", KEYS[1], 0, -1, "WITHSCORES")
+local migrated = 0
+for idx = 1, #members, 2 do
+    local name, id = string.match(members[idx], "^(.*):(%d+)$")
+    if id then
+        redis.call("ZINCRBY", KEYS[1], members[idx + 1], id)
+        redis.call("ZREM", KEYS[1], members[idx])
+        redis.call("HSETNX", KEYS[2], id, name)
+        migrated = migrated + 1
+    end
+end
+return migrated
+"""
+
+
+class StatsWindow(enum.Enum):
+    HOUR = "HOUR"
+    DAY = "DAY"
+    WEEK = "WEEK"
+
+
+class TimeBucket(NamedTuple):
+    key_format: str
+    span: timedelta
+    ttl: timedelta  # how long it's kept around
+
+
+@dataclass
+class StatsBuffer:
+    """Stats accumulated in memory, per product ID, until written to Redis."""
+
+    demand: Counter[int] = field(default_factory=Counter)
+    revenue: defaultdict[int, float] = field(default_factory=lambda: defaultdict(float))
+    buyers: defaultdict[int, set[int]] = field(default_factory=lambda: defaultdict(set))
+    names: dict[int, str] = field(default_factory=dict)
+
+    def add_demand(
+        self,
+        icecream_id: int,
+        *,
+        name: str,
+        quantity: int,
+        revenue: float,
+        buyer_id: int,
+    ):
+        self.demand[icecream_id] += quantity
+        self.revenue[icecream_id] += revenue
+        self.buyers[icecream_id].add(buyer_id)
+        self.names[icecream_id] = name
 
 
 class StatsInterface(ABC):
     @abstractmethod
-    async def acknowledge_icecream_demand(
-        self, icecream_id: int, *, name: str, quantity: int
-    ):
-        """Count the number of successfully ordered items of a given product."""
+    def queue_stats(self, pipe: Pipeline, buffer: StatsBuffer, *, now: datetime):
+        """Count the successfully ordered items of the buffered products, their
+        revenue and who bought them, within a Redis pipeline."""
 
     @abstractmethod
-    async def get_top_icecream(self, size: int = 1) -> OrderedDict[str, int]:
-        """Retrieve an ordered dictionary with the top ordered icecream brands."""
+    async def get_top_icecream(
+        self, size: int = 1, *, window: StatsWindow | None = None
+    ) -> OrderedDict[str, int]:
+        """Retrieve an ordered dictionary with the top ordered icecream brands.
+
+        Rankings are all-time when no time `window` is provided.
+        """
+
+    @abstractmethod
+    async def get_icecream_revenue(
+        self, day: date | None = None
+    ) -> OrderedDict[str, float]:
+        """Retrieve the revenue of each icecream brand over a day. (today if not set)"""
+
+    @abstractmethod
+    async def count_icecream_buyers(self, icecream_id: int) -> int:
+        """Approximate the number of unique customers who bought a given icecream."""
 
 
 class StatsService(StatsInterface):
+    """Keep stats in Redis, written along with the delivered order events."""
+
     POPULARITY_KEY = "POPULAR_ICECREAM"
+    NAMES_KEY = "ICECREAM_NAMES"
+    REVENUE_KEY = "ICECREAM_REVENUE"
+    BUYERS_KEY = "ICECREAM_BUYERS"
 
-    def __init__(self):
-        self._client = aioredis.Redis(
-            host=redis_settings.host, port=redis_settings.port
+    HOUR_BUCKET = TimeBucket("H:%Y%m%d%H", timedelta(hours=1), timedelta(days=2))
+    DAY_BUCKET = TimeBucket("D:%Y%m%d", timedelta(days=1), timedelta(days=8))
+    # Windows span over a number of buckets, including the current one. As that
+    #  one may have just started, an extra bucket makes sure the whole window is
+    #  covered. (like the last 1-2 hours for the hourly one)
+    WINDOWS = {
+        StatsWindow.HOUR: (HOUR_BUCKET, 2),
+        StatsWindow.DAY: (HOUR_BUCKET, 25),
+        StatsWindow.WEEK: (DAY_BUCKET, 8),
+    }
+
+    @functools.cached_property
+    def _client(self) -> aioredis.Redis:
+        # Created on first use, so importing the service has no side effects. Once
+        #  the pool is exhausted, callers wait for a free connection instead of failing.
+        pool = aioredis.BlockingConnectionPool(
+            host=settings.REDIS_HOST,
+            port=settings.REDIS_PORT,
+            max_connections=settings.REDIS_POOL_SIZE,
         )
+        return aioredis.Redis(connection_pool=pool)
 
     @staticmethod
     def _get_product_key(*args: int | str) -> str:
         return ":".join(map(str, args))
 
-    async def acknowledge_icecream_demand(
-        self, icecream_id: int, *, name: str, quantity: int
-    ):
-        key = self._get_product_key(name, icecream_id)
-        await self._client.zincrby(self.POPULARITY_KEY, quantity, key)
-
-    async def get_top_icecream(self, size: int = 1) -> OrderedDict[str, int]:
-        top_ice = await self._client.zrevrange(
-            self.POPULARITY_KEY, 0, size - 1, withscores=True
-        )
-        popular_ice = OrderedDict()
-        for name, score in top_ice:
-            brand = name.decode().split(":")[0]
-            popular_ice[brand] = score
-        return popular_ice
+    @classmethod
+    def _get_bucket_keys(
+        cls, bucket: TimeBucket, *, now: datetime, count: int = 1
+    ) -> list[str]:
+        # Keys of the current bucket and the previous ones, most recent first.
+        return [
+            cls._get_product_key(
+                cls.POPULARITY_KEY,
+                (now - bucket.span * idx).strftime(bucket.key_format),
+            )
+            for idx in range(count)
+        ]
+
+    @classmethod
+    def _get_revenue_key(cls, day: date) -> str:
+        return cls._get_product_key(cls.REVENUE_KEY, day.strftime("D:%Y%m%d"))
+
+    def queue_stats(self, pipe: Pipeline, buffer: StatsBuffer, *, now: datetime):
+        if not buffer.demand:
+            return
+
+        # Products are ranked by ID, while their latest names are kept aside, so a
+        #  renamed product keeps its counts.
+        buckets = {
+            self._get_bucket_keys(bucket, now=now)[0]: bucket.ttl
+            for bucket in (self.HOUR_BUCKET, self.DAY_BUCKET)
+        }
+        pipe.hset(self.NAMES_KEY, mapping=buffer.names)
+        for icecream_id, quantity in buffer.demand.items():
+            pipe.zincrby(self.POPULARITY_KEY, quantity, icecream_id)
+            for bucket_key in buckets:
+                pipe.zincrby(bucket_key, quantity, icecream_id)
+        for bucket_key, ttl in buckets.items():
+            pipe.expire(bucket_key, ttl)
+        revenue_key = self._get_revenue_key(now.date())
+        for icecream_id, amount in buffer.revenue.items():
+            pipe.hincrbyfloat(revenue_key, str(icecream_id), amount)
+        # Unique buyers are approximated with HyperLogLogs, at a fixed memory cost.
+        for icecream_id, buyer_ids in buffer.buyers.items():
+            pipe.pfadd(self._get_product_key(self.BUYERS_KEY, icecream_id), *buyer_ids)
+
+    async def migrate_popularity(self) -> int:
+        """Rank by ID the products still counted under their names, once.
+
+        Returns the number of products migrated, none on the following calls.
+        """
+        return await self._client.eval(  # type: ignore[misc]
+            MIGRATE_POPULARITY_SCRIPT, 2, self.POPULARITY_KEY, self.NAMES_KEY
+        )
+
+    async def ping(self):
+        """Connect to Redis ahead of the first stats read or write."""
+        await self._client.ping()
+
+    async def _get_window_key(self, window: StatsWindow) -> str:
+        # Merges the buckets making up the window into a short-lived ranking, which
+        #  gets reused by the following queries over the same window.
+        bucket, count = self.WINDOWS[window]
+        bucket_keys = self._get_bucket_keys(
+            bucket, now=datetime.now(timezone.utc), count=count
+        )
+        window_key = self._get_product_key(
+            self.POPULARITY_KEY, window.value, bucket_keys[0]
+        )
+        if not await self._client.exists(window_key):
+            pipe = self._client.pipeline(transaction=False)
+            pipe.zunionstore(window_key, bucket_keys)
+            pipe.expire(window_key, settings.STATS_TOP_CACHE_TTL)
+            await pipe.execute()
+        return window_key
+
+    async def get_top_icecream(
+        self, size: int = 1, *, window: StatsWindow | None = None
+    ) -> OrderedDict[str, int]:
+        key = await self._get_window_key(window) if window else self.POPULARITY_KEY
+        top_ice = await self._client.zrevrange(key, 0, size - 1, withscores=True)
+        ids = [member.decode() for member, _ in top_ice]
+        names = await self._get_names(ids)
+        return OrderedDict((name, score) for name, (_, score) in zip(names, top_ice))
+
+    async def get_icecream_revenue(
+        self, day: date | None = None
+    ) -> OrderedDict[str, float]:
+        day = day or datetime.now(timezone.utc).date()
+        revenue = await self._client.hgetall(  # type: ignore[misc]
+            self._get_revenue_key(day)
+        )
+        revenue = sorted(revenue.items(), key=lambda item: float(item[1]), reverse=True)
+        names = await self._get_names(
+            [icecream_id.decode() for icecream_id, _ in revenue]
+        )
+        return OrderedDict(
+            (name, float(amount)) for name, (_, amount) in zip(names, revenue)
+        )
+
+    async def count_icecream_buyers(self, icecream_id: int) -> int:
+        return await self._client.pfcount(
+            self._get_product_key(self.BUYERS_KEY, icecream_id)
+        )
+
+    async def _get_names(self, ids: list[str]) -> list[str]:
+        # Resolves the latest product names, falling back to their IDs if missing.
+        if not ids:
+            return []
+
+        names = await self._client.hmget(self.NAMES_KEY, ids)  # type: ignore[misc]
+        return [
+            name.decode() if name else icecream_id
+            for icecream_id, name in zip(ids, names)
+        ]
 
 
 stats_service = StatsService()
@@ -0,0 +1,83 @@
+from aioredlock import Aioredlock
+from arq import cron
+
+from deep_ice import init_sentry
+from deep_ice.core import init_logging
+from deep_ice.core.config import redis_settings, settings
+from deep_ice.core.loop_monitor import LoopLagMonitor
+from deep_ice.core.metrics import WORKER_LOOP_LAG, MetricsFlusher
+from deep_ice.services import checkout as checkout_service
+from deep_ice.services import inventory as inventory_service
+from deep_ice.services import outbox as outbox_service
+from deep_ice.services import payment as payment_service
+from deep_ice.services.checkout import get_checkout_queue
+from deep_ice.services.stats import stats_service
+
+
+async def on_worker_startup(ctx: dict):
+    init_logging()
+    init_sentry()
+    ctx["loop_monitor"] = LoopLagMonitor(WORKER_LOOP_LAG, redis=ctx["redis"])
+    ctx["loop_monitor"].start()
+    ctx["metrics_flusher"] = MetricsFlusher(ctx["redis"])
+    ctx["metrics_flusher"].start()
+    await stats_service.migrate_popularity()
+
+
+async def on_worker_shutdown(ctx: dict):
+    await ctx["loop_monitor"].stop()
+    await ctx["metrics_flusher"].stop()
+
+
+async def on_checkout_startup(ctx: dict):
+    init_logging()
+    init_sentry()
+    ctx["redlock"] = Aioredlock(
+        [{"host": redis_settings.host, "port": redis_settings.port}],
+        internal_lock_timeout=settings.REDLOCK_TTL,
+    )
+    # The checkouts record the lock timings and the reservation batch sizes.
+    ctx["metrics_flusher"] = MetricsFlusher(ctx["redis"])
+    ctx["metrics_flusher"].start()
+
+
+async def on_checkout_shutdown(ctx: dict):
+    await ctx["redlock"].destroy()
+    await ctx["metrics_flusher"].stop()
+
+
+class TaskQueue:
+    functions = [payment_service.make_payment_task]
+    on_startup = on_worker_startup
+    on_shutdown = on_worker_shutdown
+    cron_jobs = [
+        cron(
+            outbox_service.dispatch_outbox_task,
+            second=set(range(0, 60, settings.OUTBOX_DISPATCH_INTERVAL)),
+        ),
+        cron(
+            inventory_service.rebalance_inventory_task,
+            second=set(range(0, 60, settings.INVENTORY_REBALANCE_INTERVAL)),
+        ),
+        cron(
+            inventory_service.compact_stock_ledger_task,
+            second=set(range(0, 60, settings.STOCK_LEDGER_COMPACTION_INTERVAL)),
+        ),
+    ]
+    redis_settings = redis_settings
+    max_tries = settings.TASK_MAX_TRIES
+    retry_delay = settings.TASK_RETRY_DELAY
+
+
+class CheckoutQueue:
+    """Serves a single checkout partition, processing its checkouts one at a time."""
+
+    functions = [checkout_service.checkout_task]
+    on_startup = on_checkout_startup
+    on_shutdown = on_checkout_shutdown
+    queue_name = get_checkout_queue(partition=settings.CHECKOUT_PARTITION)
+    max_jobs = 1
+    keep_result = settings.CHECKOUT_RESULT_TTL
+    redis_settings = redis_settings
+    max_tries = settings.TASK_MAX_TRIES
+    retry_delay = settings.TASK_RETRY_DELAY
@@ -30,9 +30,32 @@ def sync_deps(ctx):
 
 
 @task(pre=[sync_deps])
-def test(ctx):
-    """Run tests with pytest and ensure they pass."""
-    uv_run(ctx, "pytest", "Testing")
+def test(ctx, redis_url: str | None = None):
+    """Run tests with pytest and ensure they pass.
+
+    The Redis scripts run only against a real server, given by `redis_url`.
+    """
+    option = f" --redis-url {redis_url}" if redis_url else ""
+    uv_run(ctx, f"pytest{option}", "Testing")
+
+
+@task(pre=[sync_deps])
+def benchmark(
+    ctx, update: bool = False, tolerance: float = 0.5, db_url: str | None = None
+):
+    """Run the API benchmarks and compare them with the stored baseline.
+
+    With `update` on, the results become the new baseline instead. The row lock
+    contention ones run only against a real database, given by `db_url`.
+    """
+    option = "--benchmark-update" if update else "--benchmark"
+    if db_url:
+        option += f" --benchmark-db-url {db_url}"
+    uv_run(
+        ctx,
+        f"pytest tests/benchmarks {option} --benchmark-tolerance {tolerance}",
+        "Benchmarking",
+    )
 
 
 @task(pre=[sync_deps])
@@ -92,15 +115,23 @@ def check_all(ctx):
 
 
 @task(pre=[sync_deps])
-def run_server(ctx, develop: bool = False, port: int | None = None):
-    """Run the app server in production or development mode."""
+def run_server(
+    ctx, develop: bool = False, port: int | None = None, workers: int | None = None
+):
+    """Run the app server in production or development mode.
+
+    In production, the app is served by multiple worker processes. (defaults to the
+    `WEB_WORKERS` setting)
+    """
     if develop:
-        cmd = "dev"
         port = port or 8080
+        uv_run(ctx, f"fastapi dev {APP_PACKAGE} --port {port}", "Server dev")
     else:
-        cmd = "run"
         port = port or 80
-    uv_run(ctx, f"fastapi {cmd} {APP_PACKAGE} --port {port}", f"Server {cmd}")
+        params = f"--port {port}"
+        if workers:
+            params += f" --workers {workers}"
+        uv_run(ctx, f"python -m {APP_PACKAGE}.server {params}", "Server run")
 
 
 @task(pre=[sync_deps])
@@ -110,9 +141,64 @@ def run_migrations(ctx):
 
 
 @task(pre=[sync_deps])
-def run_worker(ctx, develop: bool = False):
-    """Run a worker for processing the task queue in production or development mode."""
+def run_worker(
+    ctx, develop: bool = False, checkout: bool = False, partition: int = 0
+):
+    """Run a worker for processing the task queue in production or development mode.
+
+    With `--checkout`, the worker processes the queued checkouts of the given
+    partition instead.
+    """
     params = ""
     if develop:
         params = f"--watch {APP_PACKAGE}"
+    if checkout:
+        command = f"arq {APP_PACKAGE}.CheckoutQueue {params}"
+        uv_run(
+            ctx,
+            f"env CHECKOUT_PARTITION={partition} {command}",
+            f"Checkout worker #{partition}",
+        )
+        return
+
     uv_run(ctx, f"arq {APP_PACKAGE}.TaskQueue {params}", "Task queue worker")
+
+
+@task(pre=[sync_deps])
+def generate_dataset(
+    ctx,
+    users: int = 100_000,
+    orders: int = 200_000,
+    icecream: int = 1_000,
+    batch_size: int = 5_000,
+    seed: int | None = None,
+):
+    """Bulk-load a synthetic dataset into the configured database, for scale testing.
+
+    Products, users, orders with their items and payments are added on top of the
+    existing data.
+    """
+    params = (
+        f"--users {users} --orders {orders} --icecream {icecream}"
+        f" --batch-size {batch_size}"
+    )
+    if seed is not None:
+        params += f" --seed {seed}"
+    uv_run(ctx, f"python -m {APP_PACKAGE}.dataset {params}", "Dataset generation")
+
+
+@task(pre=[sync_deps])
+def split_stock(ctx, name: str, slots: int = 8):
+    """Split the stock of a hot flavor across this many slots, or merge it with 1."""
+    uv_run(
+        ctx,
+        f'python -m {APP_PACKAGE}.services.inventory "{name}" --slots {slots}',
+        "Stock split",
+    )
+
+
+@task(pre=[sync_deps])
+def flash_sale(ctx, name: str, close: bool = False):
+    """Open a flash sale over the current stock of a flavor, or close it."""
+    params = f'"{name}"' + (" --close" if close else "")
+    uv_run(ctx, f"python -m {APP_PACKAGE}.services.admission {params}", "Flash sale")
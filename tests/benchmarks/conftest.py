@@ -0,0 +1,165 @@
+import asyncio
+import json
+import statistics
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Awaitable, Callable
+
+import pytest
+from httpx import Response
+from sqlmodel import insert, select
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from deep_ice.models import IceCream, Order, OrderItem, OrderStatus, User
+
+BASELINE_PATH = Path(__file__).parent / "baseline.json"
+RESULTS_KEY = pytest.StashKey[dict[str, dict]]()
+
+
+@dataclass
+class BenchmarkResult:
+    requests: int
+    duration: float
+    latencies: list[float]
+
+    def summary(self) -> dict[str, float]:
+        # Latency percentiles in milliseconds.
+        percentiles = statistics.quantiles(self.latencies, n=100, method="inclusive")
+        return {
+            "throughput": round(self.requests / self.duration, 2),
+            "p50": round(percentiles[49] * 1000, 3),
+            "p95": round(percentiles[94] * 1000, 3),
+            "p99": round(percentiles[98] * 1000, 3),
+        }
+
+
+class Benchmark:
+    """Drive concurrent requests through the app and check them against a baseline.
+
+    Numbers depend on the machine, so the baseline has to be refreshed with
+    `--benchmark-update` on the one running the comparisons.
+    """
+
+    def __init__(self, *, baseline: dict, results: dict, tolerance: float):
+        self._baseline = baseline
+        self._results = results
+        self._tolerance = tolerance
+
+    @staticmethod
+    async def measure(
+        operation: Callable[[int], Awaitable[Response]],
+        *,
+        requests: int,
+        concurrency: int,
+    ) -> BenchmarkResult:
+        semaphore = asyncio.Semaphore(concurrency)
+        latencies = []
+
+        async def _run(idx: int):
+            async with semaphore:
+                start = time.perf_counter()
+                response = await operation(idx)
+                latencies.append(time.perf_counter() - start)
+            assert response.is_success, response.text
+
+        start = time.perf_counter()
+        # Each request runs in its own task, thus getting its own scoped DB session.
+        await asyncio.gather(*(_run(idx) for idx in range(requests)))
+        return BenchmarkResult(requests, time.perf_counter() - start, latencies)
+
+    async def run(
+        self,
+        name: str,
+        operation: Callable[[int], Awaitable[Response]],
+        *,
+        requests: int,
+        concurrency: int,
+    ) -> dict[str, float]:
+        result = await self.measure(
+            operation, requests=requests, concurrency=concurrency
+        )
+        return self.record(name, result)
+
+    def record(self, name: str, result: BenchmarkResult) -> dict[str, float]:
+        summary = result.summary()
+        self._results[name] = summary
+        self.check(name, summary)
+        return summary
+
+    def check(self, name: str, summary: dict[str, float]):
+        baseline = self._baseline.get(name)
+        if not baseline:
+            return
+
+        # Regressions are allowed within the tolerance, relative to the baseline.
+        min_throughput = baseline["throughput"] * (1 - self._tolerance)
+        assert (
+            summary["throughput"] >= min_throughput
+        ), f"{name} throughput dropped under {min_throughput:.2f} req/s"
+        max_p95 = baseline["p95"] * (1 + self._tolerance)
+        assert summary["p95"] <= max_p95, f"{name} p95 went over {max_p95:.3f}ms"
+
+
+async def add_orders(session: AsyncSession, user: User, *, count: int):
+    """Bulk-insert confirmed orders for the user, each with all the flavors."""
+    icecream = (await IceCream.fetch(session)).all()
+    await session.exec(
+        insert(Order).values(  # type: ignore
+            [{"user_id": user.id, "status": OrderStatus.CONFIRMED}] * count
+        )
+    )
+    order_ids = (await session.exec(select(Order.id))).all()
+    await session.exec(
+        insert(OrderItem).values(  # type: ignore
+            [
+                {
+                    "order_id": order_id,
+                    "icecream_id": ice.id,
+                    "quantity": 2,
+                    "total_price": ice.price * 2,
+                }
+                for order_id in order_ids
+                for ice in icecream
+            ]
+        )
+    )
+    await session.commit()
+
+
+def pytest_configure(config):
+    config.stash[RESULTS_KEY] = {}
+
+
+def pytest_terminal_summary(terminalreporter, config):
+    results = config.stash[RESULTS_KEY]
+    if not results:
+        return
+
+    terminalreporter.section("benchmarks")
+    terminalreporter.write_line(
+        f"{'scenario':<24}{'req/s':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}"
+    )
+    for name, summary in results.items():
+        terminalreporter.write_line(
+            f"{name:<24}{summary['throughput']:>10.2f}{summary['p50']:>10.3f}"
+            f"{summary['p95']:>10.3f}{summary['p99']:>10.3f}"
+        )
+    if config.getoption("--benchmark-update"):
+        baseline = json.loads(BASELINE_PATH.read_text()) | results
+        BASELINE_PATH.write_text(json.dumps(baseline, indent=2, sort_keys=True) + "\n")
+        terminalreporter.write_line(f"Baseline updated in {BASELINE_PATH}.")
+
+
+@pytest.fixture
+def benchmark(request) -> Benchmark:
+    config = request.config
+    return Benchmark(
+        baseline=(
+            {}
+            if config.getoption("--benchmark-update")
+            else json.loads(BASELINE_PATH.read_text())
+        ),
+        results=config.stash[RESULTS_KEY],
+        tolerance=config.getoption("--benchmark-tolerance"),
+    )
@@ -0,0 +1,124 @@
+import pytest
+from sqlmodel import insert, select
+
+from deep_ice.core.security import create_access_token, get_password_hash
+from deep_ice.models import Cart, CartItem, IceCream, PaymentMethod, User
+
+from .conftest import add_orders
+
+pytestmark = [pytest.mark.benchmark, pytest.mark.anyio]
+
+USERS = 50
+ORDERS = 200
+LOGINS = 20  # password hashing is slow on purpose
+PASSWORD = "bench-password"
+
+
+@pytest.fixture
+async def bench_users(session, initial_data) -> list[User]:
+    # Hashing is slow on purpose, so all the users share the same password.
+    hashed_password = get_password_hash(PASSWORD)
+    await session.exec(
+        insert(User).values(  # type: ignore
+            [
+                {
+                    "name": f"Bench User {idx}",
+                    "email": f"bench.user.{idx}@deepicecream.ai",
+                    "hashed_password": hashed_password,
+                }
+                for idx in range(USERS)
+            ]
+        )
+    )
+    await session.commit()
+    users = await session.exec(
+        select(User).where(User.email.startswith("bench.user."))  # type: ignore
+    )
+    return list(users.all())
+
+
+def _get_headers(user: User) -> dict[str, str]:
+    return {"Authorization": f"Bearer {create_access_token(user)}"}
+
+
+async def _get_icecream(session, name: str) -> IceCream:
+    return (await IceCream.fetch(session, filters=[IceCream.name == name])).one()
+
+
+async def test_catalog_read_storm(benchmark, client, initial_data):
+    await benchmark.run(
+        "catalog_read_storm",
+        lambda idx: client.get("/v1/icecream"),
+        requests=500,
+        concurrency=50,
+    )
+
+
+async def test_cart_building(benchmark, session, client, bench_users):
+    headers = [_get_headers(user) for user in bench_users]
+    icecream_ids = [icecream.id for icecream in (await IceCream.fetch(session)).all()]
+
+    # Every user fills up its cart with all the flavors, one by one.
+    await benchmark.run(
+        "cart_building",
+        lambda idx: client.post(
+            "/v1/cart/items",
+            json={"icecream_id": icecream_ids[idx // USERS], "quantity": 1},
+            headers=headers[idx % USERS],
+        ),
+        requests=USERS * len(icecream_ids),
+        concurrency=USERS,
+    )
+
+
+async def test_contended_checkout(
+    benchmark, redis_client, session, client, bench_users
+):
+    # All the users rush to buy the last scoops of the same flavor.
+    vanilla = await _get_icecream(session, "Vanilla")
+    vanilla.stock = USERS
+    session.add_all([vanilla] + [Cart(user_id=user.id) for user in bench_users])
+    await session.commit()
+    carts = (await Cart.fetch(session)).all()
+    session.add_all(
+        [CartItem(cart_id=cart.id, icecream_id=vanilla.id) for cart in carts]
+    )
+    await session.commit()
+    headers = [_get_headers(user) for user in bench_users]
+
+    await benchmark.run(
+        "contended_checkout",
+        lambda idx: client.post(
+            "/v1/payments",
+            json={"method": PaymentMethod.CASH.value},
+            headers=headers[idx],
+        ),
+        requests=USERS,
+        concurrency=USERS,
+    )
+    await session.refresh(vanilla)
+    assert vanilla.available_stock == 0
+
+
+async def test_order_history(benchmark, session, client, user):
+    await add_orders(session, user, count=ORDERS)
+    headers = _get_headers(user)
+
+    await benchmark.run(
+        "order_history",
+        lambda idx: client.get("/v1/orders", headers=headers),
+        requests=50,
+        concurrency=10,
+    )
+
+
+async def test_login_burst(benchmark, client, bench_users):
+    await benchmark.run(
+        "login_burst",
+        lambda idx: client.post(
+            "/v1/auth/access-token",
+            data={"username": bench_users[idx].email, "password": PASSWORD},
+        ),
+        requests=LOGINS,
+        concurrency=LOGINS,
+    )
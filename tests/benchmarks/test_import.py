@@ -0,0 +1,49 @@
+import os
+import subprocess
+import sys
+from pathlib import Path
+
+import pytest
+
+from .conftest import BenchmarkResult
+
+pytestmark = pytest.mark.benchmark
+
+ROOT = Path(__file__).parents[2]
+RUNS = 10
+
+
+def _import_time(code: str) -> float:
+    # Total import time in seconds, as reported by the interpreter itself.
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        capture_output=True,
+        text=True,
+        cwd=ROOT,
+        env=os.environ,
+    )
+    assert not proc.returncode, proc.stderr
+    total = 0
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+
+        _, cumulative, name = line.split("|")
+        # Only the top level imports, as the nested ones are already included.
+        if not name.startswith("  "):
+            total += int(cumulative)
+    return total / 1_000_000
+
+
+@pytest.mark.parametrize(
+    "name, code",
+    [
+        ("import_api", "import deep_ice; deep_ice.app"),
+        ("import_worker", "from deep_ice import TaskQueue"),
+        # What the migrations need, without the app or the worker.
+        ("import_alembic", "import deep_ice.core.config, deep_ice.models"),
+    ],
+)
+def test_import_time(benchmark, name, code):
+    latencies = [_import_time(code) for _ in range(RUNS)]
+    benchmark.record(name, BenchmarkResult(RUNS, sum(latencies), latencies))
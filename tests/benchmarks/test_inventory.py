@@ -0,0 +1,129 @@
+import asyncio
+import functools
+import time
+from typing import Any, Awaitable, Callable, cast
+
+import pytest
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from sqlmodel import SQLModel
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from deep_ice.models import IceCream
+from deep_ice.services.inventory import (
+    LedgerInventory,
+    ReservationCoalescer,
+    ShardedInventory,
+)
+
+from .conftest import BenchmarkResult
+
+pytestmark = [pytest.mark.benchmark, pytest.mark.anyio]
+
+RESERVATIONS = 1000
+CONCURRENCY = 50
+SLOTS = 8
+WINDOW = 0.005
+
+
+@pytest.fixture
+async def db_sessions(request):
+    # SQLite locks the whole database on writes, so row contention shows up only on
+    #  a server like PostgreSQL.
+    db_url = request.config.getoption("--benchmark-db-url")
+    if not db_url:
+        pytest.skip("needs --benchmark-db-url to run")
+
+    engine = create_async_engine(db_url, pool_size=CONCURRENCY)
+    async with engine.begin() as conn:
+        await conn.run_sync(SQLModel.metadata.create_all)
+    try:
+        yield async_sessionmaker(
+            bind=engine, class_=AsyncSession, expire_on_commit=False
+        )
+    finally:
+        async with engine.begin() as conn:
+            await conn.run_sync(SQLModel.metadata.drop_all)
+        await engine.dispose()
+
+
+async def _add_icecream(sessions, name: str, *, slots: int = 1) -> int:
+    async with sessions() as session:
+        icecream = IceCream(name=name, flavor="hot", stock=RESERVATIONS, price=1)
+        session.add(icecream)
+        await session.commit()
+        if slots > 1:
+            await ShardedInventory(session).set_slots(icecream, slots)
+            await session.commit()
+        return cast(int, icecream.id)
+
+
+async def _reserve_in_place(session, icecream_id: int):
+    # The former model, locking the product row for every change.
+    icecream = await session.get(IceCream, icecream_id, with_for_update=True)
+    icecream.blocked_quantity += 1
+    session.add(icecream)
+
+
+async def _reserve_in_ledger(session, icecream_id: int):
+    icecream = await session.get(IceCream, icecream_id)
+    await LedgerInventory(session).reserve(icecream, 1)
+
+
+async def _reserve_in_slots(session, icecream_id: int):
+    icecream = await session.get(IceCream, icecream_id)
+    await ShardedInventory(session).reserve(icecream, 1)
+
+
+async def _reserve_coalesced(
+    session, icecream_id: int, *, coalescer: ReservationCoalescer
+):
+    # Checked against the stock and committed along with the concurrent ones.
+    icecream = await session.get(IceCream, icecream_id)
+    await coalescer.reserve([(icecream, 1)])
+
+
+async def _reserve_all(
+    sessions, icecream_id: int, reserve: Callable[[Any, int], Awaitable[None]]
+) -> BenchmarkResult:
+    semaphore = asyncio.Semaphore(CONCURRENCY)
+    latencies = []
+
+    async def _reserve():
+        async with semaphore, sessions() as session:
+            start = time.perf_counter()
+            await reserve(session, icecream_id)
+            await session.commit()
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(_reserve() for _ in range(RESERVATIONS)))
+    result = BenchmarkResult(RESERVATIONS, time.perf_counter() - start, latencies)
+
+    async with sessions() as session:
+        icecream = await session.get(IceCream, icecream_id)
+        assert icecream.available_stock == 0  # no reservation got lost
+    return result
+
+
+async def test_hot_flavor_reservations(benchmark, db_sessions):
+    summaries = {}
+    coalescer = ReservationCoalescer(window=WINDOW, session_maker=db_sessions)
+    for name, reserve, slots in [
+        ("inventory_row", _reserve_in_place, 1),
+        ("inventory_ledger", _reserve_in_ledger, 1),
+        ("inventory_sharded", _reserve_in_slots, SLOTS),
+        (
+            "inventory_coalesced",
+            functools.partial(_reserve_coalesced, coalescer=coalescer),
+            1,
+        ),
+    ]:
+        icecream_id = await _add_icecream(db_sessions, name, slots=slots)
+        result = await _reserve_all(db_sessions, icecream_id, reserve)
+        summaries[name] = benchmark.record(name, result)
+
+    # None of them queues up every buyer on the product row lock.
+    for name in ("inventory_ledger", "inventory_sharded", "inventory_coalesced"):
+        assert (
+            summaries[name]["throughput"] > summaries["inventory_row"]["throughput"]
+        ), summaries
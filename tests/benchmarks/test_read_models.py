@@ -0,0 +1,60 @@
+import time
+import tracemalloc
+
+import pytest
+
+from deep_ice.models import Order, OrderItem
+from deep_ice.read_models import fetch_orders
+
+from .conftest import BenchmarkResult, add_orders
+
+pytestmark = [pytest.mark.benchmark, pytest.mark.anyio]
+
+ORDERS = 500
+RUNS = 10
+
+
+async def _load_instances(session, user_id: int) -> list:
+    orders = (
+        await Order.fetch(
+            session,
+            filters=[Order.user_id == user_id],
+            joinedloads=[Order.items, OrderItem.icecream],
+        )
+    ).unique()
+    return list(orders.all())
+
+
+async def _load_rows(session, user_id: int) -> list:
+    return await fetch_orders(session, user_id=user_id)
+
+
+async def _measure(session, user_id, load) -> tuple[list[float], int]:
+    latencies = []
+    peak = 0
+    for _ in range(RUNS):
+        # Start over with an empty identity map, like a new request does.
+        session.expunge_all()
+        tracemalloc.start()
+        start = time.perf_counter()
+        orders = await load(session, user_id)
+        latencies.append(time.perf_counter() - start)
+        peak = max(peak, tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+        assert len(orders) == ORDERS
+    return latencies, peak
+
+
+async def test_load_orders(benchmark, session, user):
+    await add_orders(session, user, count=ORDERS)
+
+    peaks = {}
+    for name, load in [
+        ("orders_load_instances", _load_instances),
+        ("orders_load_rows", _load_rows),
+    ]:
+        latencies, peaks[name] = await _measure(session, user.id, load)
+        benchmark.record(name, BenchmarkResult(RUNS, sum(latencies), latencies))
+
+    # Memory allocated per listed order falls at least by half.
+    assert peaks["orders_load_rows"] * 2 <= peaks["orders_load_instances"], peaks
@@ -0,0 +1,79 @@
+import json
+import time
+
+import pytest
+from fastapi.responses import JSONResponse
+from fastapi.routing import serialize_response
+from fastapi.utils import create_model_field
+
+from deep_ice.core.serialization import FastJSONResponse, serialize_order
+from deep_ice.models import IceCream, Order, OrderItem, OrderStatus, RetrieveOrder
+
+from .conftest import BenchmarkResult
+
+pytestmark = [pytest.mark.benchmark, pytest.mark.anyio]
+
+ORDERS = 1000
+ITEMS = 5  # per order
+RUNS = 20
+
+
+@pytest.fixture
+def orders() -> list[Order]:
+    # Built in memory, as only the serialization is measured.
+    icecream = [
+        IceCream(
+            id=idx, name=f"Flavor {idx}", flavor=f"flavor-{idx}", price=3.5, stock=100
+        )
+        for idx in range(ITEMS)
+    ]
+    return [
+        Order(
+            id=order_id,
+            user_id=1,
+            status=OrderStatus.CONFIRMED,
+            items=[
+                OrderItem(
+                    id=order_id * ITEMS + idx,
+                    order_id=order_id,
+                    icecream_id=ice.id,
+                    icecream=ice,
+                    quantity=2,
+                    total_price=7.0,
+                )
+                for idx, ice in enumerate(icecream)
+            ],
+        )
+        for order_id in range(ORDERS)
+    ]
+
+
+async def _render_validated(orders: list[Order]) -> bytes | memoryview:
+    # What FastAPI does with a `response_model`.
+    field = create_model_field("Response", list[RetrieveOrder], mode="serialization")
+    content = await serialize_response(field=field, response_content=orders)
+    return JSONResponse(content).body
+
+
+async def _render_fast(orders: list[Order]) -> bytes | memoryview:
+    return FastJSONResponse([serialize_order(order) for order in orders]).body
+
+
+@pytest.mark.parametrize(
+    "name, render",
+    [
+        ("orders_json_validated", _render_validated),
+        ("orders_json_fast", _render_fast),
+    ],
+)
+async def test_serialize_orders(benchmark, orders, name, render):
+    assert json.loads(await render(orders)) == json.loads(
+        await _render_validated(orders)
+    )
+
+    latencies = []
+    for _ in range(RUNS):
+        start = time.perf_counter()
+        await render(orders)
+        latencies.append(time.perf_counter() - start)
+    benchmark.record(name, BenchmarkResult(RUNS, sum(latencies), latencies))
@@ -4,7 +4,8 @@ from typing import cast
 from unittest.mock import AsyncMock
 
 import pytest
-from httpx import ASGITransport, AsyncClient
+from httpx import ASGITransport, AsyncClient, Response
+from redis.asyncio import Redis
 from sqlalchemy.ext.asyncio import (
     async_scoped_session,
     async_sessionmaker,
@@ -16,15 +17,53 @@ from sqlmodel.ext.asyncio.session import AsyncSession
 from sqlmodel.pool import StaticPool
 
 from deep_ice import app
-from deep_ice.core.database import get_async_session
+from deep_ice.core.database import get_async_session, instrument_engine
 from deep_ice.core.dependencies import get_lock_manager
+from deep_ice.core.metrics import QueryStatsMiddleware
 from deep_ice.core.security import get_password_hash
 from deep_ice.models import Cart, CartItem, IceCream, Order, SQLModel, User
 from deep_ice.services.cart import CartService
 from deep_ice.services.order import OrderService
+from deep_ice.services.outbox import OutboxDispatcher
 from deep_ice.services.stats import stats_service
 
 
+def pytest_addoption(parser):
+    parser.addoption(
+        "--redis-url", help="Redis URL for the tests running the Lua scripts."
+    )
+    group = parser.getgroup("benchmark")
+    group.addoption(
+        "--benchmark", action="store_true", help="Run the benchmarks as well."
+    )
+    group.addoption(
+        "--benchmark-update",
+        action="store_true",
+        help="Run the benchmarks and store their results as the new baseline.",
+    )
+    group.addoption(
+        "--benchmark-tolerance",
+        type=float,
+        default=0.5,
+        help="Allowed regression, relative to the baseline. (default: 0.5)",
+    )
+    group.addoption(
+        "--benchmark-db-url",
+        help="Async DB URL for the benchmarks needing a real server. (row locks)",
+    )
+
+
+def pytest_collection_modifyitems(config, items):
+    # Benchmarks are slow, so they run only on demand.
+    if config.getoption("--benchmark") or config.getoption("--benchmark-update"):
+        return
+
+    skip_benchmark = pytest.mark.skip(reason="needs --benchmark to run")
+    for item in items:
+        if "benchmark" in item.keywords:
+            item.add_marker(skip_benchmark)
+
+
 # Run tests with `asyncio` only.
 @pytest.fixture(scope="session")
 def anyio_backend():
@@ -33,9 +72,32 @@ def anyio_backend():
 
 @pytest.fixture
 def redis_client(mocker):
-    return mocker.patch(
+    client = mocker.patch(
         "deep_ice.services.stats.stats_service._client", new_callable=AsyncMock
     )
+    # Pipelines are built synchronously and executed asynchronously only.
+    client.pipeline = mocker.MagicMock(return_value=mocker.MagicMock())
+    client.pipeline.return_value.execute = AsyncMock()
+    # No outbox event was delivered before.
+    client.mget.side_effect = lambda keys: [None] * len(keys)
+    return client
+
+
+@pytest.fixture
+async def redis_server(request):
+    # The Lua scripts run on a real server only.
+    url = request.config.getoption("--redis-url")
+    if not url:
+        pytest.skip("needs --redis-url to run")
+
+    redis = Redis.from_url(url)
+    yield redis
+    await redis.aclose()
+
+
+@pytest.fixture
+def outbox_dispatcher(session: AsyncSession, redis_client) -> OutboxDispatcher:
+    return OutboxDispatcher(session, redis=redis_client, stats_service=stats_service)
 
 
 @pytest.fixture
@@ -45,6 +107,7 @@ async def _scoped_session_factory():
         connect_args={"check_same_thread": False},
         poolclass=StaticPool,
     )
+    instrument_engine(async_engine)
     async with async_engine.begin() as conn:
         await conn.run_sync(SQLModel.metadata.create_all)
     session_factory = async_sessionmaker(
@@ -152,8 +215,29 @@ class AsyncLockManager:
         lock.release()
 
 
+async def _check_query_budget(max_queries: int, response: Response):
+    # Requires debug mode, for the number of statements to be sent back.
+    count = int(response.headers[QueryStatsMiddleware.COUNT_HEADER])
+    request = response.request
+    assert (
+        count <= max_queries
+    ), f"{request.method} {request.url.path} issued {count} > {max_queries} queries"
+
+
+@pytest.fixture
+def query_budget(request) -> dict:
+    """Response hooks failing the requests which go over the `max_queries` mark."""
+    marker = request.node.get_closest_marker("max_queries")
+    if not marker:
+        return {}
+
+    return {"response": [functools.partial(_check_query_budget, marker.args[0])]}
+
+
 @pytest.fixture
-async def _client_factory(_scoped_session_factory: async_scoped_session, mocker):
+async def _client_factory(
+    _scoped_session_factory: async_scoped_session, query_budget: dict, mocker
+):
     async def _get_async_session_override():
         async with _scoped_session_factory() as session:
             yield session
@@ -163,10 +247,14 @@ async def _client_factory(_scoped_session_factory: async_scoped_session, mocker)
 
     async def _create_client():
         app.state.redis_pool = mocker.AsyncMock()
+        # No flavor is on flash sale, so every cart gets admitted.
+        app.state.redis_pool.eval.return_value = [1, 0]
         app.dependency_overrides[get_async_session] = _get_async_session_override
         app.dependency_overrides[get_lock_manager] = _get_lock_manager_override
         async with AsyncClient(
-            transport=ASGITransport(app=app), base_url="http://localhost"
+            transport=ASGITransport(app=app),
+            base_url="http://localhost",
+            event_hooks=query_budget,
         ) as client:
             yield client
         app.dependency_overrides.clear()
@@ -254,7 +342,7 @@ async def secondary_cart_items(
 async def order(session: AsyncSession, cart_items: list[CartItem], user: User) -> Order:
     cart_service = CartService(session)
     cart = await cart_service.ensure_cart(cast(int, user.id))
-    order_service = OrderService(session, stats_service=stats_service)
+    order_service = OrderService(session)
     order = await order_service.make_order_from_cart(cart)
     await session.commit()
     return order
@@ -0,0 +1,99 @@
+import time
+
+import pytest
+from redis.asyncio import Redis
+
+from deep_ice.core.config import settings
+from deep_ice.models import IceCream
+from deep_ice.services.admission import AdmissionService, AdmissionStatus, _get_keys
+
+VANILLA, CHOCOLATE = 9001, 9002
+
+
+@pytest.fixture
+async def admission(redis_server, mocker):
+    mocker.patch.object(settings, "WAITING_ROOM_SLOTS", 1)
+    admission = AdmissionService(redis_server)
+    for icecream_id, stock in [(VANILLA, 5), (CHOCOLATE, 1)]:
+        icecream = IceCream(
+            id=icecream_id, name="Hot", flavor="hot", stock=stock, price=1
+        )
+        await admission.open_sale(icecream)
+    yield admission
+    await redis_server.delete(*_get_keys(VANILLA), *_get_keys(CHOCOLATE))
+
+
+async def _get_tokens(redis: Redis, icecream_id: int) -> int:
+    return int(await redis.get(_get_keys(icecream_id)[0]))
+
+
+@pytest.mark.anyio
+async def test_admit_in_line(redis_server, admission):
+    first = await admission.admit(1, {VANILLA: 3})
+    assert first.status is AdmissionStatus.ADMITTED
+    assert await _get_tokens(redis_server, VANILLA) == 2
+    # A single buyer checks out at once, the next one waits right behind.
+    second = await admission.admit(2, {VANILLA: 1})
+    assert (second.status, second.position) == (AdmissionStatus.WAITING, 1)
+
+    # Paid for, so the tokens aren't given back, while the next one gets in.
+    await admission.leave(1, [VANILLA], sold=True)
+    assert await _get_tokens(redis_server, VANILLA) == 2
+    second = await admission.admit(2, {VANILLA: 1})
+    assert second.status is AdmissionStatus.ADMITTED
+
+    await admission.leave(2, [VANILLA], sold=False)
+    assert await _get_tokens(redis_server, VANILLA) == 2
+
+
+@pytest.mark.anyio
+async def test_admit_sold_out(redis_server, admission):
+    sold_out = await admission.admit(1, {VANILLA: 2, CHOCOLATE: 2})
+    assert sold_out.status is AdmissionStatus.SOLD_OUT
+    # Turned away without keeping a place in the line of the other flavor.
+    queue_key = _get_keys(VANILLA)[1]
+    assert not await redis_server.zcard(queue_key)
+    assert await _get_tokens(redis_server, VANILLA) == 5
+
+    admitted = await admission.admit(2, {VANILLA: 2})
+    assert admitted.status is AdmissionStatus.ADMITTED
+
+
+@pytest.mark.anyio
+async def test_return_tokens(redis_server, admission):
+    await admission.close_sale(
+        IceCream(id=CHOCOLATE, name="Hot", flavor="hot", stock=1, price=1)
+    )
+    async with redis_server.pipeline(transaction=True) as pipe:
+        admission.queue_return(pipe, {VANILLA: 2, CHOCOLATE: 3})
+        await pipe.execute()
+
+    # Given back to the flavors still on sale only.
+    assert await _get_tokens(redis_server, VANILLA) == 7
+    assert not await redis_server.exists(_get_keys(CHOCOLATE)[0])
+
+
+@pytest.mark.anyio
+async def test_admit_holding(redis_server, admission, mocker):
+    now = time.time()
+    clock = mocker.patch("deep_ice.services.admission.time").time
+    clock.return_value = now
+    first = await admission.admit(1, {VANILLA: 1})
+    assert first.status is AdmissionStatus.ADMITTED
+
+    # Still checking out past the time the ones waiting in line get.
+    now += settings.WAITING_ROOM_TTL + 1
+    clock.return_value = now
+    second = await admission.admit(2, {VANILLA: 1})
+    assert second.status is AdmissionStatus.WAITING
+    # And even longer once its queued checkout gets picked up.
+    await admission.hold(1, [VANILLA])
+    clock.return_value = now + settings.WAITING_ROOM_HOLD_TTL - 1
+    second = await admission.admit(2, {VANILLA: 1})
+    assert second.status is AdmissionStatus.WAITING
+
+    # Given up on, so its place and tokens go to the next in line.
+    clock.return_value = now + settings.WAITING_ROOM_HOLD_TTL + 1
+    second = await admission.admit(2, {VANILLA: 1})
+    assert second.status is AdmissionStatus.ADMITTED
+    assert await _get_tokens(redis_server, VANILLA) == 4
@@ -4,6 +4,7 @@ from deep_ice.models import IceCream
 
 
 @pytest.mark.anyio
+@pytest.mark.max_queries(5)
 async def test_get_cart(auth_client, initial_data):
     response = await auth_client.get("/v1/cart")
     assert response.status_code == 200
@@ -27,6 +28,7 @@ async def _add_cart_item(session, auth_client, *, flavor, active=True):
 
 
 @pytest.mark.anyio
+@pytest.mark.max_queries(7)
 async def test_add_to_cart(session, auth_client, initial_data):
     response = await _add_cart_item(session, auth_client, flavor="chocolate")
     assert response.status_code == 201
@@ -39,6 +41,7 @@ async def test_add_to_cart(session, auth_client, initial_data):
 
 
 @pytest.mark.anyio
+@pytest.mark.max_queries(7)
 async def test_put_to_cart(session, auth_client, initial_data):
     response = await _add_cart_item(session, auth_client, flavor="vanilla")
     data = response.json()
@@ -57,6 +60,7 @@ async def test_put_to_cart(session, auth_client, initial_data):
 
 
 @pytest.mark.anyio
+@pytest.mark.max_queries(6)
 async def test_add_inactive_icecream(session, auth_client, initial_data):
     response = await _add_cart_item(
         session, auth_client, flavor="strawberry", active=False
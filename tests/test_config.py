@@ -0,0 +1,91 @@
+import subprocess
+import sys
+import textwrap
+
+import pytest
+from pydantic import ValidationError
+
+from deep_ice import server
+from deep_ice.core.config import Settings
+
+
+def test_connection_budget_split():
+    settings = Settings(
+        POSTGRES_SERVER="localhost",
+        POSTGRES_USER="deep",
+        POSTGRES_DB="deep_ice",
+        WEB_WORKERS=4,
+        DB_MAX_CONNECTIONS=90,
+        REDIS_MAX_CONNECTIONS=100,
+    )
+    # Each worker gets its share, so the totals stay under the limits.
+    assert settings.DB_POOL_SIZE == 11
+    assert settings.DB_MAX_OVERFLOW == 11
+    per_worker = settings.DB_POOL_SIZE + settings.DB_MAX_OVERFLOW
+    assert settings.WEB_WORKERS * per_worker <= settings.DB_MAX_CONNECTIONS
+    assert settings.REDIS_POOL_SIZE == 12
+
+
+@pytest.mark.parametrize("interval", [0, 7, 90])
+def test_cron_interval_divides_minute(interval):
+    with pytest.raises(ValidationError, match="must divide 60 seconds evenly"):
+        Settings(
+            POSTGRES_SERVER="localhost",
+            POSTGRES_USER="deep",
+            POSTGRES_DB="deep_ice",
+            INVENTORY_REBALANCE_INTERVAL=interval,
+        )
+
+
+def test_payment_callback_needs_secret():
+    db_settings = {
+        "POSTGRES_SERVER": "localhost",
+        "POSTGRES_USER": "deep",
+        "POSTGRES_DB": "deep_ice",
+    }
+    callback_url = "https://deep-ice.local/v1/payments/callback"
+    with pytest.raises(ValidationError, match="PAYMENT_WEBHOOK_SECRET is required"):
+        Settings(**db_settings, PAYMENT_CALLBACK_URL=callback_url)
+
+    settings = Settings(
+        **db_settings,
+        PAYMENT_CALLBACK_URL=callback_url,
+        PAYMENT_WEBHOOK_SECRET="webhook-secret",
+    )
+    assert settings.PAYMENT_WEBHOOK_SECRET == "webhook-secret"
+
+
+def test_server_workers_split_budget(mocker, monkeypatch):
+    monkeypatch.setenv("WEB_WORKERS", "1")
+    monkeypatch.setattr(sys, "argv", ["server", "--workers", "8"])
+    # Built fresh, so the settings read the worker count passed to the server.
+    mocker.patch("deep_ice.core.config.get_settings", side_effect=Settings)
+    # Uvicorn's config sets up its logging, which is kept out of the other tests.
+    mocker.patch("deep_ice.server.Config")
+    prefork_server = mocker.patch("deep_ice.server.PreforkServer")
+    server.main()
+
+    assert prefork_server.call_args.kwargs["workers"] == 8
+    settings = Settings()
+    assert settings.WEB_WORKERS == 8
+    per_worker = settings.DB_POOL_SIZE + settings.DB_MAX_OVERFLOW
+    assert 8 * per_worker <= settings.DB_MAX_CONNECTIONS
+
+
+def test_import_side_effects():
+    # Only building the app (or a worker) reads the settings and starts the logging
+    #  thread, not importing the modules they share.
+    code = textwrap.dedent("""
+        import threading
+
+        import deep_ice.core.loop_monitor
+        import deep_ice.services.checkout
+        import deep_ice.services.outbox
+        import deep_ice.services.stats
+        from deep_ice.core import config
+
+        assert not config.get_settings.cache_info().currsize
+        assert threading.active_count() == 1
+        """)
+    proc = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True)
+    assert not proc.returncode, proc.stderr
@@ -0,0 +1,34 @@
+from collections import Counter
+
+import pytest
+from sqlmodel import func, select
+
+from deep_ice.dataset import DatasetGenerator, DatasetSpec
+from deep_ice.models import IceCream, Order, OrderItem, Payment, User
+
+
+@pytest.mark.anyio
+async def test_generate_dataset(session, initial_data):
+    spec = DatasetSpec(
+        users=50, orders=300, icecream=20, max_items=3, batch_size=40, seed=1
+    )
+    conn = await session.connection()
+    await DatasetGenerator(conn, spec).generate()
+    await session.commit()
+
+    async def _count(model) -> int:
+        return (await session.exec(select(func.count()).select_from(model))).one()
+
+    # Generated on top of the initial data.
+    assert await _count(IceCream) == spec.icecream + len(initial_data["icecream"])
+    assert await _count(User) == spec.users + len(initial_data["users"])
+    assert await _count(Order) == spec.orders
+    assert await _count(Payment) == spec.orders
+    items = (await session.exec(select(OrderItem))).all()
+    assert spec.orders <= len(items) <= spec.orders * spec.max_items
+
+    # Popularity is skewed towards the first generated products.
+    sales = Counter(item.icecream_id for item in items)
+    first_id = len(initial_data["icecream"]) + 1
+    assert sales[first_id] == max(sales.values())
+    assert sales[first_id] > 5 * sales[first_id + spec.icecream - 1]
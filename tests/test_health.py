@@ -0,0 +1,59 @@
+import pytest
+
+from deep_ice import app
+from deep_ice.core.config import settings
+from deep_ice.core.metrics import QueryStatsMiddleware
+from deep_ice.main import prime_hot_queries, warm_up
+from deep_ice.models import IceCream
+from deep_ice.services.inventory import LedgerInventory
+
+
+@pytest.mark.anyio
+async def test_readiness(client, mocker):
+    mocker.patch.object(app.state, "ready", False, create=True)
+    response = await client.get("/ready")
+    assert response.status_code == 503
+
+    app.state.ready = True
+    response = await client.get("/ready")
+    assert response.status_code == 200
+
+
+@pytest.mark.anyio
+async def test_warm_up_failure(client, mocker, caplog):
+    mocker.patch.object(app.state, "ready", False, create=True)
+    mocker.patch.object(app.state, "warm_up_error", None, create=True)
+    mocker.patch.object(settings, "WARM_UP_ATTEMPTS", 3)
+    mocker.patch("deep_ice.main.WARM_UP_RETRY_DELAY", 0)
+    warm_up_connections = mocker.patch(
+        "deep_ice.main.warm_up_connections",
+        side_effect=ConnectionRefusedError("Connection refused"),
+    )
+    await warm_up(app)
+
+    # Each failed attempt is logged, until giving up with the error reported.
+    assert warm_up_connections.await_count == 3
+    assert "Warm-up attempt 2/3 failed" in caplog.text
+    assert "Warm-up failed 3 times, giving up" in caplog.text
+    response = await client.get("/ready")
+    assert response.status_code == 503
+    assert response.json()["detail"] == "Warm-up failed: Connection refused"
+
+
+@pytest.mark.anyio
+async def test_warm_up(client, session, initial_data):
+    await prime_hot_queries(session)
+
+    # Stock changes show up right away, as the catalog is read on every request.
+    vanilla = (
+        await IceCream.fetch(session, filters=[IceCream.name == "Vanilla"])
+    ).one()
+    await LedgerInventory(session).reserve(vanilla, 1)
+    await session.commit()
+    await session.refresh(vanilla)
+    response = await client.get("/v1/icecream")
+    assert response.status_code == 200
+    catalog = {icecream["id"]: icecream for icecream in response.json()}
+    assert len(catalog) == len(initial_data["icecream"])
+    assert catalog[vanilla.id]["available_stock"] == vanilla.available_stock == 99
+    assert response.headers[QueryStatsMiddleware.COUNT_HEADER] == "1"
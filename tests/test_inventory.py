@@ -0,0 +1,238 @@
+import asyncio
+from collections import Counter
+
+import pytest
+from sqlalchemy.ext.asyncio import async_sessionmaker
+from sqlmodel import col, select
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from deep_ice.models import (
+    IceCream,
+    IceCreamStockSlot,
+    Order,
+    OrderStatus,
+    StockMovement,
+    StockMovementKind,
+)
+from deep_ice.services.cart import CartService
+from deep_ice.services.inventory import (
+    InventoryError,
+    LedgerInventory,
+    ReservationCoalescer,
+    ShardedInventory,
+    rebalance_inventory_task,
+)
+from deep_ice.services.order import OrderService
+
+
+async def _get_vanilla(session) -> IceCream:
+    return (await IceCream.fetch(session, filters=[IceCream.name == "Vanilla"])).one()
+
+
+async def _get_slots(session, icecream: IceCream) -> list[tuple[int, int]]:
+    slots = await session.exec(
+        select(IceCreamStockSlot)
+        .where(IceCreamStockSlot.icecream_id == icecream.id)
+        .order_by(col(IceCreamStockSlot.slot))
+        .execution_options(populate_existing=True)
+    )
+    return [(slot.stock, slot.blocked_quantity) for slot in slots]
+
+
+@pytest.mark.anyio
+async def test_stock_ledger(session, initial_data):
+    icecream = await _get_vanilla(session)
+    inventory = LedgerInventory(session)
+    await inventory.reserve(icecream, 30)
+    await inventory.deduct(icecream, 20)
+    await inventory.release(icecream, 10)
+    await inventory.restock(icecream, 5)
+    await session.commit()
+
+    # The snapshot stays untouched, while the availability adds up the movements.
+    await session.refresh(icecream)
+    assert (icecream.stock, icecream.blocked_quantity) == (100, 0)
+    assert icecream.available_stock == 85
+    response = await session.exec(select(StockMovement.kind, StockMovement.quantity))
+    assert sorted(response.all(), key=lambda row: row[1]) == [
+        (StockMovementKind.RESTOCK, 5),
+        (StockMovementKind.RELEASE, 10),
+        (StockMovementKind.SELL, 20),
+        (StockMovementKind.RESERVE, 30),
+    ]
+
+    assert await inventory.compact() == 4
+    assert not await inventory.compact()  # already compacted
+    await session.commit()
+    await session.refresh(icecream)
+    assert (icecream.stock, icecream.blocked_quantity) == (85, 0)
+    assert icecream.available_stock == 85
+
+
+def test_unloaded_availability():
+    # Products built in memory have no movements loaded along.
+    icecream = IceCream(name="Mint", flavor="mint", stock=10, price=1)
+    assert icecream.available_stock == 10
+
+
+@pytest.mark.anyio
+async def test_reservation_coalescer(session, initial_data, mocker):
+    vanilla, chocolate, _ = (await IceCream.fetch(session)).all()
+    session_maker = async_sessionmaker(
+        bind=session.bind, class_=AsyncSession, expire_on_commit=False
+    )
+    commit_spy = mocker.spy(AsyncSession, "commit")
+    coalescer = ReservationCoalescer(window=0.01, session_maker=session_maker)
+    results = await asyncio.gather(
+        coalescer.reserve([(vanilla, 60)]),
+        coalescer.reserve([(vanilla, 50), (chocolate, 10)]),
+        coalescer.reserve([(vanilla, 40)]),
+        return_exceptions=True,
+    )
+    # Carts are granted in order, each either entirely or not at all, and all of
+    #  them get committed at once.
+    assert results[0] is None and results[2] is None
+    assert isinstance(results[1], InventoryError)
+    assert commit_spy.call_count == 1
+    assert vanilla.available_stock == 0
+    assert chocolate.available_stock == 200
+
+    movements = await session.exec(
+        select(StockMovement.icecream_id, StockMovement.quantity).where(
+            StockMovement.kind == StockMovementKind.RESERVE
+        )
+    )
+    assert sorted(movements.all()) == [(vanilla.id, 40), (vanilla.id, 60)]
+
+
+@pytest.mark.anyio
+async def test_coalesced_order_cancelled(session, user, cart_items):
+    session_maker = async_sessionmaker(
+        bind=session.bind, class_=AsyncSession, expire_on_commit=False
+    )
+    coalescer = ReservationCoalescer(window=0.05, session_maker=session_maker)
+    cart = await CartService(session).ensure_cart(user.id)
+    order_service = OrderService(session, coalescer=coalescer)
+    checkout = asyncio.create_task(order_service.make_order_from_cart(cart))
+    while not (await Order.fetch(session)).all():
+        await asyncio.sleep(0.001)
+
+    # Given up while the reservation waits for its batch to be committed.
+    checkout.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await checkout
+    await asyncio.sleep(0.2)
+    assert not (await Order.fetch(session)).all()
+    for icecream in (await IceCream.fetch(session)).all():
+        await session.refresh(icecream)
+        assert icecream.available_stock == icecream.stock
+    movements = await session.exec(select(StockMovement.kind))
+    assert Counter(movements.all()) == {
+        StockMovementKind.RESERVE: 3,
+        StockMovementKind.RELEASE: 3,
+    }
+
+
+@pytest.mark.anyio
+async def test_release_order(session, order):
+    inventory = LedgerInventory(session)
+    await inventory.release_order(order.id)
+    await session.commit()
+    for icecream in (await IceCream.fetch(session)).all():
+        await session.refresh(icecream)
+        assert icecream.available_stock == icecream.stock
+
+
+@pytest.fixture
+async def sharded_icecream(session, initial_data) -> IceCream:
+    icecream = await _get_vanilla(session)
+    # Pending movements are compacted before splitting the stock.
+    await LedgerInventory(session).reserve(icecream, 20)
+    await LedgerInventory(session).release(icecream, 20)
+    await ShardedInventory(session).set_slots(icecream, 4)
+    await session.commit()
+    await session.refresh(icecream)
+    return icecream
+
+
+@pytest.mark.anyio
+async def test_set_slots(session, sharded_icecream):
+    assert sharded_icecream.stock_slots == 4
+    assert await _get_slots(session, sharded_icecream) == [(25, 0)] * 4
+    assert sharded_icecream.available_stock == 100
+
+    # Merging the slots back keeps the stock on the product row alone.
+    await ShardedInventory(session).set_slots(sharded_icecream, 1)
+    await session.commit()
+    await session.refresh(sharded_icecream)
+    assert await _get_slots(session, sharded_icecream) == []
+    assert sharded_icecream.available_stock == sharded_icecream.stock == 100
+
+
+@pytest.mark.anyio
+async def test_sharded_stock_changes(session, sharded_icecream):
+    inventory = ShardedInventory(session)
+    await inventory.reserve(sharded_icecream, 10)  # fits in a single slot
+    await inventory.reserve(sharded_icecream, 60)  # spread over the slots
+    await session.commit()
+    await session.refresh(sharded_icecream)
+    assert sharded_icecream.available_stock == 30
+    assert sum(blocked for _, blocked in await _get_slots(session, sharded_icecream))
+
+    await inventory.deduct(sharded_icecream, 50)
+    await inventory.release(sharded_icecream, 20)
+    await session.commit()
+    await session.refresh(sharded_icecream)
+    assert sharded_icecream.available_stock == 50
+    slots = await _get_slots(session, sharded_icecream)
+    assert sum(stock for stock, _ in slots) == 50
+    assert not sum(blocked for _, blocked in slots)
+
+    with pytest.raises(InventoryError):
+        await inventory.reserve(sharded_icecream, 51)
+
+    # The movements are still recorded, but already accounted for by the slots.
+    assert not await LedgerInventory(session).compact()
+    movements = await StockMovement.fetch(
+        session, filters=[StockMovement.icecream_id == sharded_icecream.id]
+    )
+    assert len(movements.all()) == 2 + 4
+
+
+@pytest.mark.anyio
+async def test_rebalance(session, sharded_icecream, mocker):
+    inventory = ShardedInventory(session)
+    await inventory.reserve(sharded_icecream, 5)
+    await inventory.deduct(sharded_icecream, 5)
+    await inventory.reserve(sharded_icecream, 3)
+    await session.commit()
+
+    async def _get_async_session():
+        yield session
+
+    mocker.patch(
+        "deep_ice.services.inventory.get_async_session", new=_get_async_session
+    )
+    assert await rebalance_inventory_task({}) == 1
+    await session.refresh(sharded_icecream)
+    # The product row holds the totals, while the free stock is spread evenly.
+    assert (sharded_icecream.stock, sharded_icecream.blocked_quantity) == (95, 3)
+    slots = await _get_slots(session, sharded_icecream)
+    assert sorted(stock - blocked for stock, blocked in slots) == [23, 23, 23, 23]
+
+
+@pytest.mark.anyio
+async def test_sharded_order(session, sharded_icecream, order):
+    # The order reserves a tenth of each flavor. (see `cart_items`)
+    await session.refresh(sharded_icecream)
+    assert sharded_icecream.available_stock == 90
+    assert sharded_icecream.blocked_quantity == 0  # kept by the slots instead
+
+    order_service = OrderService(session)
+    assert await order_service.confirm_order(order.id)
+    await session.commit()
+    await session.refresh(sharded_icecream)
+    await session.refresh(order)
+    assert order.status == OrderStatus.CONFIRMED
+    assert sharded_icecream.available_stock == 90
+    assert sum(stock for stock, _ in await _get_slots(session, sharded_icecream)) == 90
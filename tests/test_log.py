@@ -0,0 +1,71 @@
+import atexit
+import json
+import logging
+
+from deep_ice.core.log import SAMPLED, JsonFormatter, SamplingFilter, _enqueue_handlers
+
+
+class ListHandler(logging.Handler):
+    def __init__(self) -> None:
+        super().__init__()
+        self.records: list[logging.LogRecord] = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+
+def test_queued_logging():
+    logger = logging.getLogger("deep_ice.tests.queued")
+    handler = ListHandler()
+    logger.addHandler(handler)
+    listener = _enqueue_handlers(logger, sample_rate=0.0)
+    assert listener
+
+    args = ["Vanilla"]
+    logger.warning("Out of %s", args)
+    args.append("Chocolate")  # changed after logging, but before being handled
+    logger.info("Hot path", extra=SAMPLED)
+    logger.info("Not sampled, %d left", 3)
+    atexit.unregister(listener.stop)
+    listener.stop()
+
+    # The records went through the listener thread, without the sampled out one.
+    assert [record.getMessage() for record in handler.records] == [
+        "Out of ['Vanilla']",
+        "Not sampled, 3 left",
+    ]
+    # Immutable arguments are kept for the formatters.
+    assert handler.records[1].args == (3,)
+
+
+def test_json_formatter():
+    try:
+        raise ValueError("invalid")
+    except ValueError as exc:
+        record = logging.makeLogRecord(
+            {
+                "name": "deep_ice",
+                "levelno": logging.ERROR,
+                "levelname": "ERROR",
+                "msg": "Payment error: %s",
+                "args": (exc,),
+                "exc_info": (type(exc), exc, exc.__traceback__),
+                "timing": {"total": 1.5},
+            }
+        )
+
+    data = json.loads(JsonFormatter().format(record))
+    assert data["message"] == "Payment error: invalid"
+    assert data["level"] == "ERROR"
+    assert data["timing"] == {"total": 1.5}
+    assert "ValueError: invalid" in data["exception"]
+
+
+def test_sampling_filter(mocker):
+    mocker.patch("random.random", return_value=0.5)
+    record = logging.makeLogRecord({"levelno": logging.INFO, **SAMPLED})
+    assert not SamplingFilter(0.2).filter(record)
+    assert SamplingFilter(0.8).filter(record)
+    # Warnings and above are always kept.
+    record.levelno = logging.WARNING
+    assert SamplingFilter(0.0).filter(record)
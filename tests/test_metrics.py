@@ -0,0 +1,171 @@
+import asyncio
+import time
+
+import pytest
+from redis.exceptions import RedisError
+from sqlmodel import select
+
+from deep_ice import app
+from deep_ice.core.config import settings
+from deep_ice.core.database import track_queries
+from deep_ice.core.loop_monitor import LoopLagMonitor
+from deep_ice.core.metrics import (
+    REQUESTS,
+    STATS_WRITE_LATENCY,
+    Counter,
+    Histogram,
+    MetricsFlusher,
+    QueryStatsMiddleware,
+)
+from deep_ice.models import IceCream, User
+
+
+def _get_sample(lines: list[str], prefix: str) -> float:
+    (line,) = [line for line in lines if line.startswith(prefix + " ")]
+    return float(line.split()[-1])
+
+
+def test_histogram_render():
+    histogram = Histogram("latency", "Latency.", ("route",), buckets=(0.1, 1))
+    histogram.observe(0.05, route="/a")
+    histogram.observe(0.5, route="/a")
+    histogram.observe(5, route="/a")
+
+    lines = histogram.render()
+    assert lines[:2] == ["# HELP latency Latency.", "# TYPE latency histogram"]
+    # Buckets are cumulative.
+    assert _get_sample(lines, 'latency_bucket{route="/a",le="0.1"}') == 1
+    assert _get_sample(lines, 'latency_bucket{route="/a",le="1.0"}') == 2
+    assert _get_sample(lines, 'latency_bucket{route="/a",le="+Inf"}') == 3
+    assert _get_sample(lines, 'latency_count{route="/a"}') == 3
+    assert _get_sample(lines, 'latency_sum{route="/a"}') == 5.55
+
+
+@pytest.mark.anyio
+async def test_get_metrics(client, mocker):
+    redis_pool = app.state.redis_pool
+    redis_pool.pipeline = mocker.MagicMock(return_value=mocker.MagicMock())
+    pipe = redis_pool.pipeline.return_value
+    pipe.execute = mocker.AsyncMock()
+    redis_pool.zcard.return_value = 3
+    # Requests are labeled by route template, not by their actual path.
+    route_field = 'value:["PUT", "/v1/cart/items/{item_id:int}", "401"]'
+    redis_pool.hgetall.side_effect = lambda key: {
+        "OUTBOX_STATS": {b"lag_seconds": b"1.5", b"dispatched": b"10"},
+        STATS_WRITE_LATENCY.key: {b"0": b"2", b"sum": b"0.004"},
+        REQUESTS.key: {route_field.encode(): b"3"},
+    }.get(key, {})
+
+    response = await client.put("/v1/cart/items/123456", json={"quantity": 1})
+    assert response.status_code == 401
+    response = await client.get("/metrics")
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain; version=0.0.4")
+
+    # The requests served by this process are added to the totals in Redis first,
+    #  which are the ones rendered.
+    assert any(
+        call.args[:2] == (REQUESTS.key, route_field)
+        for call in pipe.hincrbyfloat.call_args_list
+    )
+    lines = response.text.splitlines()
+    route_labels = 'method="PUT",route="/v1/cart/items/{item_id:int}"'
+    assert (
+        _get_sample(lines, f'http_requests_total{{{route_labels},status="401"}}') == 3
+    )
+    assert _get_sample(lines, "arq_queue_depth") == 3
+    assert _get_sample(lines, "outbox_lag_seconds") == 1.5
+    assert _get_sample(lines, "stats_write_duration_seconds_count") == 2
+    assert any(line.startswith("db_pool_connections") for line in lines)
+
+
+@pytest.mark.anyio
+async def test_shared_metrics(redis_server):
+    # The same metrics, as recorded by two processes.
+    counters = [Counter("jobs_total", "Jobs.", ("queue",)) for _ in range(2)]
+    histograms = [
+        Histogram("job_seconds", "Jobs.", ("queue",), buckets=(0.1, 1))
+        for _ in range(2)
+    ]
+    await redis_server.delete(counters[0].key, histograms[0].key)
+    for counter, histogram, value in zip(counters, histograms, (0.05, 0.5)):
+        counter.inc(queue="checkout:0")
+        histogram.observe(value, queue="checkout:0")
+        pipe = redis_server.pipeline(transaction=True)
+        counter.flush(pipe)
+        histogram.flush(pipe)
+        await pipe.execute()
+
+    # Flushed values are taken out of the process, then added up in Redis.
+    assert counters[0].render() == counters[0].header()
+    lines = await counters[0].collect(redis_server)
+    assert _get_sample(lines, 'jobs_total{queue="checkout:0"}') == 2
+    lines = await histograms[1].collect(redis_server)
+    assert _get_sample(lines, 'job_seconds_bucket{queue="checkout:0",le="0.1"}') == 1
+    assert _get_sample(lines, 'job_seconds_bucket{queue="checkout:0",le="+Inf"}') == 2
+    assert _get_sample(lines, 'job_seconds_sum{queue="checkout:0"}') == 0.55
+
+
+@pytest.mark.anyio
+async def test_metrics_flusher(mocker, caplog):
+    redis = mocker.MagicMock()
+    execute = redis.pipeline.return_value.execute = mocker.AsyncMock()
+    execute.side_effect = [RedisError("Connection refused"), None, None]
+    flusher = MetricsFlusher(redis, interval=0.01)
+    flusher.start()
+    await asyncio.sleep(0.015)
+    await flusher.stop()
+
+    # Failures don't stop the flushes, and the last one happens on stop.
+    assert "Couldn't flush the metrics: Connection refused" in caplog.text
+    assert execute.await_count >= 2
+
+
+@pytest.mark.anyio
+async def test_query_budget(auth_client, cart_items, mocker, caplog):
+    mocker.patch.object(settings, "QUERY_BUDGET", 1)
+    mocker.patch.object(settings, "QUERY_REPEAT_THRESHOLD", 2)
+    response = await auth_client.get("/v1/cart")
+    assert response.status_code == 200
+
+    count = int(response.headers[QueryStatsMiddleware.COUNT_HEADER])
+    assert count > 1
+    assert float(response.headers[QueryStatsMiddleware.DURATION_HEADER]) > 0
+    assert f"issued {count} SQL statements" in caplog.text
+
+
+@pytest.mark.anyio
+async def test_track_repeated_queries(session, initial_data):
+    with track_queries() as stats:
+        # Loading products one by one, instead of all at once.
+        for icecream_id in range(1, 4):
+            await session.exec(select(IceCream).where(IceCream.id == icecream_id))
+        await session.exec(select(User))
+
+    assert stats.count == 4
+    ((statement, count),) = stats.get_repeated(3)
+    assert count == 3
+    assert "FROM icecream" in statement
+
+
+def _block_loop(seconds: float):
+    time.sleep(seconds)
+
+
+@pytest.mark.anyio
+async def test_loop_lag_monitor(caplog):
+    histogram = Histogram("lag", "Lag.", buckets=(0.1,))
+    monitor = LoopLagMonitor(histogram, interval=0.02, threshold=0.1)
+    monitor.start()
+    await asyncio.sleep(0.05)
+    _block_loop(0.3)
+    await asyncio.sleep(0.05)
+    await monitor.stop()
+
+    # The stall is measured as lag and reported along with the blocking call.
+    lines = histogram.render()
+    assert _get_sample(lines, 'lag_bucket{le="+Inf"}') > _get_sample(
+        lines, 'lag_bucket{le="0.1"}'
+    )
+    assert "Event loop blocked for" in caplog.text
+    assert "in _block_loop" in caplog.text
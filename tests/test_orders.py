@@ -1,6 +1,10 @@
 import pytest
+from redis.exceptions import ConnectionError as RedisConnectionError
 
-from deep_ice.models import OrderStatus
+from deep_ice.models import IceCream, OrderStatus, OutboxEvent, OutboxTopic
+from deep_ice.services.admission import RETURN_SCRIPT, _get_keys
+from deep_ice.services.inventory import LedgerInventory
+from deep_ice.services.order import OrderService
 
 
 @pytest.mark.anyio
@@ -10,3 +14,110 @@ async def test_get_orders(auth_client, order):
     order_data = response.json()[0]
     assert order_data["status"] == OrderStatus.PENDING.value
     assert order_data["amount"] == 111.0
+
+
+def _count_demand(pipe):
+    # Number of all-time demand increments sent to Redis.
+    return len(
+        [
+            call
+            for call in pipe.zincrby.call_args_list
+            if call.args[0] == "POPULAR_ICECREAM"
+        ]
+    )
+
+
+async def _get_events(session):
+    return (await OutboxEvent.fetch(session)).all()
+
+
+@pytest.mark.anyio
+async def test_order_transitions_once(
+    redis_client, outbox_dispatcher, session, order, initial_data
+):
+    order_service = OrderService(session)
+    assert await order_service.confirm_order(order.id)
+    # Repeated or racing transitions over the same order have no effect.
+    assert not await order_service.confirm_order(order.id)
+    assert not await order_service.cancel_order(order.id)
+    await session.commit()
+
+    assert order.status is OrderStatus.CONFIRMED
+    # The stock changes were only appended, until compacting them.
+    assert await LedgerInventory(session).compact() == len(order.items) * 2
+    await session.commit()
+    for item in order.items:
+        icecream = await session.get(IceCream, item.icecream_id, populate_existing=True)
+        initial = [
+            ice for ice in initial_data["icecream"] if ice["name"] == icecream.name
+        ][0]
+        assert icecream.stock == initial["stock"] - item.quantity
+        assert not icecream.blocked_quantity
+
+    # A single event is recorded along with the order confirmation.
+    (event,) = await _get_events(session)
+    assert event.topic == OutboxTopic.ORDER_CONFIRMED.value
+    assert len(event.payload["items"]) == len(order.items)
+    assert await outbox_dispatcher.dispatch() == 1
+    pipe = redis_client.pipeline.return_value
+    assert _count_demand(pipe) == len(order.items)
+    pipe.publish.assert_called_once()
+
+
+@pytest.mark.anyio
+async def test_outbox_redis_down(redis_client, outbox_dispatcher, session, order):
+    pipe = redis_client.pipeline.return_value
+    pipe.execute.side_effect = RedisConnectionError
+    order_service = OrderService(session)
+    # The order gets confirmed even if the stats can't be written.
+    assert await order_service.confirm_order(order.id)
+    await session.commit()
+    assert order.status is OrderStatus.CONFIRMED
+    items_count = len(order.items)
+
+    # Events are kept in the outbox until Redis is reachable again.
+    assert not await outbox_dispatcher.dispatch()
+    (event,) = await _get_events(session)
+    assert not event.dispatched_at
+    pipe.execute.side_effect = None
+    pipe.zincrby.reset_mock()
+    assert await outbox_dispatcher.dispatch() == 1
+    assert _count_demand(pipe) == items_count
+    await session.refresh(event)
+    assert event.dispatched_at
+
+
+@pytest.mark.anyio
+async def test_outbox_redelivery(redis_client, outbox_dispatcher, session, order):
+    assert await OrderService(session).confirm_order(order.id)
+    await session.commit()
+
+    # An event which reached Redis before, but didn't get marked as dispatched, is
+    #  skipped when delivered again.
+    redis_client.mget.side_effect = lambda keys: [b"1"] * len(keys)
+    assert await outbox_dispatcher.dispatch() == 1
+    pipe = redis_client.pipeline.return_value
+    assert not _count_demand(pipe)
+    pipe.publish.assert_not_called()
+    (event,) = await _get_events(session)
+    assert event.dispatched_at
+
+
+@pytest.mark.anyio
+async def test_cancelled_order_returns_tokens(
+    redis_client, outbox_dispatcher, session, order
+):
+    assert await OrderService(session).cancel_order(order.id)
+    await session.commit()
+
+    # The flash sale tokens kept for the order are given back along with its stock.
+    assert await outbox_dispatcher.dispatch() == 1
+    pipe = redis_client.pipeline.return_value
+    (return_call,) = [
+        call for call in pipe.eval.call_args_list if call.args[0] == RETURN_SCRIPT
+    ]
+    count = return_call.args[1]
+    keys, quantities = return_call.args[2 : 2 + count], return_call.args[2 + count :]
+    assert dict(zip(keys, quantities)) == {
+        _get_keys(item.icecream_id)[0]: str(item.quantity) for item in order.items
+    }
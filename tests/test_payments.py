@@ -1,11 +1,34 @@
 import asyncio
+import datetime
 import itertools
 from unittest.mock import call
 
 import pytest
+from arq.jobs import Job, JobDef, JobResult
+from httpx import ASGITransport
+from sqlalchemy.ext.asyncio import async_sessionmaker
+from sqlmodel.ext.asyncio.session import AsyncSession
 
 from deep_ice import app
-from deep_ice.models import Order, OrderItem, OrderStatus, PaymentMethod, PaymentStatus
+from deep_ice.api.routes.payments import QUEUE_POSITION_HEADER
+from deep_ice.core import security
+from deep_ice.core.config import settings
+from deep_ice.models import (
+    CheckoutStatus,
+    IceCream,
+    Order,
+    OrderItem,
+    OrderStatus,
+    PaymentMethod,
+    PaymentStatus,
+)
+from deep_ice.services.admission import ADMIT_SCRIPT, LEAVE_SCRIPT
+from deep_ice.services.cart import CartService
+from deep_ice.services.checkout import checkout_task
+from deep_ice.services.inventory import LedgerInventory
+from deep_ice.services.payment import PaymentStub, fake_gateway, make_payment_task
+
+from .conftest import AsyncLockManager
 
 
 async def _check_order_creation(session, order_id, *, status, amount):
@@ -32,7 +55,16 @@ def _get_icecream(initial_data, flavor):
             return icecream
 
 
-def _check_quantities(order, initial_data):
+async def _compact_stock(session, order):
+    # Brings the stock movements into the products snapshot.
+    await LedgerInventory(session).compact()
+    await session.commit()
+    for item in order.items:
+        await session.refresh(item.icecream)
+
+
+async def _check_quantities(session, order, initial_data):
+    await _compact_stock(session, order)
     for item in order.items:
         before = _get_icecream(initial_data, item.icecream.flavor)["stock"]
         after = item.icecream.stock
@@ -40,19 +72,36 @@ def _check_quantities(order, initial_data):
         assert not item.icecream.blocked_quantity
 
 
-def _check_stats(redis_client):
+async def _check_stats(outbox_dispatcher, redis_client):
+    # Stats are written once the order events get dispatched.
+    assert await outbox_dispatcher.dispatch()
     expected_calls = [
-        call("POPULAR_ICECREAM", 10, "Vanilla:1"),
-        call("POPULAR_ICECREAM", 20, "Chocolate:2"),
-        call("POPULAR_ICECREAM", 5, "Strawberry:3"),
+        call("POPULAR_ICECREAM", 10, 1),
+        call("POPULAR_ICECREAM", 20, 2),
+        call("POPULAR_ICECREAM", 5, 3),
     ]
-    redis_client.zincrby.assert_has_calls(expected_calls)
+    pipe = redis_client.pipeline.return_value
+    pipe.zincrby.assert_has_calls(expected_calls, any_order=True)
+    pipe.hset.assert_any_call(
+        "ICECREAM_NAMES", mapping={1: "Vanilla", 2: "Chocolate", 3: "Strawberry"}
+    )
+    revenue = {call.args[1]: call.args[2] for call in pipe.hincrbyfloat.call_args_list}
+    assert revenue == {"1": 33.0, "2": 58.0, "3": 20.0}
+    pipe.pfadd.assert_any_call("ICECREAM_BUYERS:1", 1)
+    pipe.execute.assert_awaited()
 
 
 @pytest.mark.parametrize("method", list(PaymentMethod))
 @pytest.mark.anyio
+@pytest.mark.max_queries(27)
 async def test_make_successful_payment(
-    redis_client, session, auth_client, cart_items, initial_data, method
+    redis_client,
+    outbox_dispatcher,
+    session,
+    auth_client,
+    cart_items,
+    initial_data,
+    method,
 ):
     # Cash payments are instantly triggered (201), since they don't wait for a
     #  confirmation, while card payments are non-blocking and returning instantly with
@@ -66,9 +115,15 @@ async def test_make_successful_payment(
     )
     assert data["status"] == expected_payment_status.value
     assert data["amount"] == 111.0
+    # The checkout place is freed once paid, keeping the flash sale tokens taken.
+    leave_args = app.state.redis_pool.eval.call_args.args
+    assert leave_args[0] == LEAVE_SCRIPT
+    assert leave_args[-1] == "0"
     if method is PaymentMethod.CARD:
         enqueue_mock = app.state.redis_pool.enqueue_job
         enqueue_mock.assert_called_once()
+        job_id = enqueue_mock.call_args.kwargs["_job_id"]
+        assert job_id == f"payment:{data['order_id']}"
 
     # Any successful payment initiation will trigger an order creation.
     expected_order_status = (
@@ -80,8 +135,8 @@ async def test_make_successful_payment(
         session, data["order_id"], status=expected_order_status, amount=111.0
     )
     if db_order.status is OrderStatus.CONFIRMED:
-        _check_quantities(db_order, initial_data)
-        _check_stats(redis_client)
+        await _check_quantities(session, db_order, initial_data)
+        await _check_stats(outbox_dispatcher, redis_client)
 
     # The list of payments contain our just-made payment.
     response = await auth_client.get("/v1/payments")
@@ -92,6 +147,7 @@ async def test_make_successful_payment(
 
 
 @pytest.mark.anyio
+@pytest.mark.max_queries(2)
 async def test_payment_empty_cart(redis_client, session, auth_client):
     response = await auth_client.post(
         "/v1/payments", json={"method": PaymentMethod.CASH.value}
@@ -100,6 +156,7 @@ async def test_payment_empty_cart(redis_client, session, auth_client):
 
 
 @pytest.mark.anyio
+@pytest.mark.max_queries(12)
 async def test_payment_redirect_insufficient_stock(
     redis_client, session, auth_client, cart_items
 ):
@@ -122,6 +179,213 @@ async def test_payment_redirect_insufficient_stock(
     assert redirect_url.endswith("/v1/cart")
     assert first_item.quantity != initial_quantity
     assert first_item.quantity == max_quantity
+    # The tokens taken at admission are given back, since nothing got sold.
+    leave_args = app.state.redis_pool.eval.call_args.args
+    assert leave_args[0] == LEAVE_SCRIPT
+    assert leave_args[-1] == "1"
+
+
+@pytest.mark.parametrize("sold_out", [False, True])
+@pytest.mark.anyio
+async def test_coalesced_reservations(
+    redis_client, session, auth_client, cart_items, initial_data, mocker, sold_out
+):
+    mocker.patch.object(settings, "RESERVATION_WINDOW", 0.01)
+    mocker.patch(
+        "deep_ice.services.inventory.get_session_maker",
+        return_value=async_sessionmaker(
+            bind=session.bind, class_=AsyncSession, expire_on_commit=False
+        ),
+    )
+    if sold_out:
+        # The stock is gone right after the cart got checked against it.
+        first_item = cart_items[0]
+        max_quantity = first_item.quantity - 1
+        icecream = await first_item.awaitable_attrs.icecream
+        icecream.stock = max_quantity
+        session.add(icecream)
+        await session.commit()
+        check_stock = CartService.check_items_against_stock
+        checks = iter([True])
+
+        async def _check_stock(self, cart):
+            return next(checks, None) or await check_stock(self, cart)
+
+        mocker.patch.object(CartService, "check_items_against_stock", _check_stock)
+
+    sleep_spy = mocker.spy(asyncio, "sleep")
+    response = await auth_client.post(
+        "/v1/payments", json={"method": PaymentMethod.CASH.value}
+    )
+    # The reservations were gathered for the configured window.
+    sleep_spy.assert_any_call(0.01)
+    if not sold_out:
+        assert response.status_code == 201
+        db_order = await _check_order_creation(
+            session,
+            response.json()["order_id"],
+            status=OrderStatus.CONFIRMED,
+            amount=111.0,
+        )
+        await _check_quantities(session, db_order, initial_data)
+        return
+
+    # Nothing got reserved and the cart follows the stock left.
+    assert response.status_code == 307
+    assert first_item.quantity == max_quantity
+    assert not (await Order.fetch(session)).all()
+    for icecream in (await IceCream.fetch(session)).all():
+        await session.refresh(icecream)
+        assert icecream.available_stock == icecream.stock
+
+
+@pytest.mark.parametrize("admission, status_code", [([-1, 0], 409), ([0, 7], 429)])
+@pytest.mark.anyio
+@pytest.mark.max_queries(3)
+async def test_flash_sale_admission(
+    redis_client, session, auth_client, cart_items, admission, status_code
+):
+    app.state.redis_pool.eval.return_value = admission
+    response = await auth_client.post(
+        "/v1/payments", json={"method": PaymentMethod.CASH.value}
+    )
+    assert response.status_code == status_code
+    if status_code == 429:
+        assert response.headers[QUEUE_POSITION_HEADER] == "7"
+        assert response.headers["Retry-After"]
+
+    # The whole cart is turned away at once, before locking or ordering anything.
+    (admit_call,) = app.state.redis_pool.eval.call_args_list
+    assert admit_call.args[0] == ADMIT_SCRIPT
+    assert admit_call.args[-len(cart_items) :] == tuple(
+        str(item.quantity) for item in cart_items
+    )
+    assert not (await Order.fetch(session)).all()
+
+
+@pytest.mark.anyio
+@pytest.mark.max_queries(3)
+async def test_async_checkout(redis_client, session, auth_client, cart_items, mocker):
+    mocker.patch.object(settings, "ASYNC_CHECKOUT", True)
+    response = await auth_client.post(
+        "/v1/payments", json={"method": PaymentMethod.CASH.value}
+    )
+    assert response.status_code == 202
+    data = response.json()
+    assert data["status"] == CheckoutStatus.QUEUED.value
+    assert response.headers["Location"].endswith(f"/v1/payments/checkouts/{data['id']}")
+
+    # Queued in the partition of the lowest flavor, without ordering anything yet.
+    enqueue_mock = app.state.redis_pool.enqueue_job
+    enqueue_mock.assert_called_once()
+    kwargs = enqueue_mock.call_args.kwargs
+    assert kwargs["_job_id"] == data["id"]
+    assert kwargs["_queue_name"] == "arq:checkout:1"
+    assert kwargs["icecream_ids"] == [item.icecream_id for item in cart_items]
+    # The admission place is kept until the job is done with the checkout.
+    (admit_call,) = app.state.redis_pool.eval.call_args_list
+    assert admit_call.args[0] == ADMIT_SCRIPT
+    assert not (await Order.fetch(session)).all()
+
+
+@pytest.mark.anyio
+async def test_checkout_task(session, user, cart_items, initial_data, mocker):
+    mocker.patch(
+        "deep_ice.services.checkout.get_session_maker",
+        return_value=lambda: session,
+    )
+    ctx = {"redis": mocker.AsyncMock(), "redlock": AsyncLockManager()}
+    kwargs = {
+        "user_id": user.id,
+        "method": PaymentMethod.CASH,
+        "icecream_ids": [item.icecream_id for item in cart_items],
+    }
+    result = await checkout_task(ctx, **kwargs)
+    assert result["status"] is CheckoutStatus.COMPLETED
+    assert result["payment"]["status"] == PaymentStatus.SUCCESS.value
+    assert result["payment"]["amount"] == 111.0
+    leave_args = ctx["redis"].eval.call_args.args
+    assert leave_args[0] == LEAVE_SCRIPT
+    assert leave_args[-1] == "0"
+    db_order = await _check_order_creation(
+        session,
+        result["payment"]["order_id"],
+        status=OrderStatus.CONFIRMED,
+        amount=111.0,
+    )
+    await _check_quantities(session, db_order, initial_data)
+
+    # The cart is gone with the checkout, so the same job can't order it twice.
+    result = await checkout_task(ctx, **kwargs)
+    assert result["status"] is CheckoutStatus.FAILED
+    assert ctx["redis"].eval.call_args.args[-1] == "1"
+
+
+@pytest.mark.anyio
+async def test_checkout_task_card(session, user, cart_items, mocker):
+    mocker.patch(
+        "deep_ice.services.checkout.get_session_maker",
+        return_value=lambda: session,
+    )
+    ctx = {"redis": mocker.AsyncMock(), "redlock": AsyncLockManager()}
+    result = await checkout_task(
+        ctx,
+        user_id=user.id,
+        method=PaymentMethod.CARD,
+        icecream_ids=[item.icecream_id for item in cart_items],
+    )
+    assert result["status"] is CheckoutStatus.COMPLETED
+    assert result["payment"]["status"] == PaymentStatus.PENDING.value
+    # Card payments are queued further through the worker's own pool.
+    enqueue_mock = ctx["redis"].enqueue_job
+    enqueue_mock.assert_awaited_once()
+    order_id = result["payment"]["order_id"]
+    assert enqueue_mock.call_args.kwargs["_job_id"] == f"payment:{order_id}"
+
+
+@pytest.mark.parametrize(
+    "finished, in_progress, checkout_status",
+    [
+        (True, False, CheckoutStatus.COMPLETED),
+        (False, True, CheckoutStatus.IN_PROGRESS),
+        (False, False, CheckoutStatus.QUEUED),
+    ],
+)
+@pytest.mark.anyio
+async def test_get_checkout(
+    session, user, auth_client, mocker, finished, in_progress, checkout_status
+):
+    now = datetime.datetime.now(datetime.UTC)
+    job_def = JobDef(
+        function=checkout_task.__name__,
+        args=(),
+        kwargs={"user_id": user.id},
+        job_try=1,
+        enqueue_time=now,
+        score=None,
+        job_id="abc",
+    )
+    job_result = None
+    if finished:
+        job_result = JobResult(
+            **job_def.__dict__,
+            success=True,
+            result={"status": CheckoutStatus.COMPLETED, "payment": None},
+            start_time=now,
+            finish_time=now,
+            queue_name="arq:checkout:1",
+        )
+    mocker.patch.object(Job, "result_info", return_value=job_result)
+    mocker.patch.object(Job, "info", return_value=job_def)
+    app.state.redis_pool.exists.return_value = in_progress
+    response = await auth_client.get("/v1/payments/checkouts/abc")
+    assert response.status_code == 200
+    assert response.json()["status"] == checkout_status.value
+
+    # Checkouts of other users are hidden.
+    job_def.kwargs["user_id"] = user.id + 1
+    response = await auth_client.get("/v1/payments/checkouts/abc")
+    assert response.status_code == 404
 
 
 async def _clients_requests(path, *, _clients, _method, _payloads=None, **payload):
@@ -139,6 +403,7 @@ async def _clients_requests(path, *, _clients, _method, _payloads=None, **payloa
 @pytest.mark.parametrize("quantity_factor", [1, 0.5])
 @pytest.mark.parametrize("method", list(PaymentMethod))
 @pytest.mark.anyio
+@pytest.mark.max_queries(24)
 async def test_concurrent_payments(
     redis_client,
     session,
@@ -199,3 +464,75 @@ async def test_concurrent_payments(
     for order in orders:
         assert order.status is expected_status
         assert order.amount == expected_amount
+
+
+@pytest.mark.parametrize("result", [PaymentStatus.SUCCESS, PaymentStatus.FAILED])
+@pytest.mark.anyio
+@pytest.mark.max_queries(23)
+async def test_payment_callback(
+    redis_client,
+    outbox_dispatcher,
+    session,
+    auth_client,
+    cart_items,
+    initial_data,
+    mocker,
+    result,
+):
+    response = await auth_client.post(
+        "/v1/payments", json={"method": PaymentMethod.CARD.value}
+    )
+    assert response.status_code == 202
+    order_id = response.json()["order_id"]
+
+    # The job only submits the charge, then the gateway calls us back through the
+    #  webhook with the payment result.
+    mocker.patch.object(settings, "PAYMENT_WEBHOOK_SECRET", "webhook-secret")
+    mocker.patch.object(fake_gateway, "_transport", ASGITransport(app=app))
+    mocker.patch.object(PaymentStub, "_get_result", return_value=result)
+    stub = PaymentStub(0, 0, callback_url="http://localhost/v1/payments/callback")
+    status = await make_payment_task(
+        {"job_try": 1, "redis": redis_client},
+        order_id,
+        111.0,
+        method=PaymentMethod.CARD,
+        _stub_dict=stub.__dict__,
+    )
+    assert status == PaymentStatus.PENDING.value
+    await fake_gateway.join()
+
+    session.expire_all()
+    expected_status = (
+        OrderStatus.CONFIRMED
+        if result is PaymentStatus.SUCCESS
+        else OrderStatus.CANCELLED
+    )
+    db_order = await _check_order_creation(
+        session, order_id, status=expected_status, amount=111.0
+    )
+    if db_order.status is OrderStatus.CONFIRMED:
+        await _check_quantities(session, db_order, initial_data)
+        await _check_stats(outbox_dispatcher, redis_client)
+    else:
+        await _compact_stock(session, db_order)
+        for item in db_order.items:
+            assert not item.icecream.blocked_quantity
+
+    response = await auth_client.get("/v1/payments")
+    assert response.json()[0]["status"] == result.value
+
+
+@pytest.mark.parametrize("secret", ["webhook-secret", ""])
+@pytest.mark.anyio
+@pytest.mark.max_queries(0)
+async def test_payment_callback_invalid_signature(client, mocker, secret):
+    mocker.patch.object(settings, "PAYMENT_WEBHOOK_SECRET", secret)
+    payload = b'{"order_id": 1, "status": "SUCCESS"}'
+    # Without a secret, not even the payloads signed with an empty one are trusted.
+    signed_payload = payload + b" " if secret else payload
+    response = await client.post(
+        "/v1/payments/callback",
+        content=payload,
+        headers={security.SIGNATURE_HEADER: security.sign_payload(signed_payload)},
+    )
+    assert response.status_code == 401
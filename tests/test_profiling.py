@@ -0,0 +1,85 @@
+import pytest
+
+from deep_ice.core.config import settings
+from deep_ice.core.profiling import (
+    ProfilingMiddleware,
+    memory_tracker,
+    profiled,
+    profiled_task,
+)
+
+TOKEN = "profiling-token"
+
+
+@pytest.fixture
+def profiling(mocker, tmp_path):
+    mocker.patch.object(settings, "PROFILING_TOKEN", TOKEN)
+    mocker.patch.object(settings, "PROFILING_DIR", str(tmp_path))
+    yield tmp_path
+    memory_tracker.stop()
+
+
+@pytest.mark.anyio
+async def test_profiling_disabled(auth_client):
+    headers = {ProfilingMiddleware.HEADER: TOKEN}
+    response = await auth_client.get("/v1/cart", headers=headers)
+    assert ProfilingMiddleware.HEADER not in response.headers
+    response = await auth_client.post("/v1/profiling/memory/snapshots", headers=headers)
+    assert response.status_code == 404
+
+
+@pytest.mark.anyio
+async def test_profile_request(profiling, auth_client):
+    response = await auth_client.get(
+        "/v1/cart", headers={ProfilingMiddleware.HEADER: "wrong"}
+    )
+    assert ProfilingMiddleware.HEADER not in response.headers
+
+    headers = {ProfilingMiddleware.HEADER: TOKEN}
+    response = await auth_client.get("/v1/cart", headers=headers)
+    assert response.status_code == 200
+    name = response.headers[ProfilingMiddleware.HEADER]
+    assert (profiling / name).is_file()
+
+    response = await auth_client.get(
+        f"/v1/profiling/profiles/{name}", params={"limit": 5}, headers=headers
+    )
+    assert response.status_code == 200
+    assert "function calls" in response.text
+    response = await auth_client.get(
+        "/v1/profiling/profiles/..%2Fsecret.prof", headers=headers
+    )
+    assert response.status_code == 404
+
+
+@pytest.mark.anyio
+async def test_memory_snapshots(profiling, auth_client):
+    response = await auth_client.post("/v1/profiling/memory/snapshots")
+    assert response.status_code == 403
+
+    headers = {ProfilingMiddleware.HEADER: TOKEN}
+    # Nothing to compare with on the first snapshot.
+    response = await auth_client.post("/v1/profiling/memory/snapshots", headers=headers)
+    assert response.json() == []
+    leak = [bytearray(1024) for _ in range(100)]  # noqa: F841
+    response = await auth_client.post("/v1/profiling/memory/snapshots", headers=headers)
+    diffs = response.json()
+    assert diffs
+    assert any(diff["size_diff"] >= 100 * 1024 for diff in diffs)
+
+    response = await auth_client.delete("/v1/profiling/memory", headers=headers)
+    assert response.status_code == 204
+
+
+def test_profiled_task(profiling, mocker, caplog):
+    mocker.patch.object(settings, "PROFILING_TASKS", True)
+    with profiled_task("make_payment_task-1"):
+        # Nested profiling is skipped, as only one profiler can run at a time.
+        with profiled("nested") as path:
+            assert path is None
+        buffer = [bytearray(1024) for _ in range(100)]
+
+    (profile,) = profiling.glob("*.prof")
+    assert profile.name.endswith("-make_payment_task-1.prof")
+    assert "Memory allocated by make_payment_task-1" in caplog.text
+    assert buffer
@@ -0,0 +1,36 @@
+import pytest
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from deep_ice.core.config import settings
+from deep_ice.models import Order, Payment, PaymentMethod, PaymentStatus
+
+
+@pytest.fixture
+async def payment(session: AsyncSession, order: Order) -> Payment:
+    payment = Payment(
+        order_id=order.id,
+        user_id=order.user_id,
+        status=PaymentStatus.SUCCESS,
+        amount=order.amount,
+        method=PaymentMethod.CASH,
+    )
+    session.add(payment)
+    await session.commit()
+    return payment
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize(
+    "path", ["/v1/icecream", "/v1/cart", "/v1/orders", "/v1/payments"]
+)
+async def test_fast_json(auth_client, payment, mocker, path):
+    validated = await auth_client.get(path)
+    assert validated.status_code == 200
+    assert validated.json()
+
+    # The rows encoded directly look the same as the validated response models.
+    mocker.patch.object(settings, "FAST_JSON", True)
+    fast = await auth_client.get(path)
+    assert fast.status_code == 200
+    assert fast.headers["Content-Type"] == "application/json"
+    assert fast.json() == validated.json()
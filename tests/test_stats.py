@@ -0,0 +1,156 @@
+import asyncio
+from collections import OrderedDict
+from datetime import date, datetime, timezone
+
+import pytest
+from redis.exceptions import ConnectionError as RedisConnectionError
+
+from deep_ice.api.routes import stats as stats_routes
+from deep_ice.services.stats import (
+    StatsBuffer,
+    StatsService,
+    StatsWindow,
+    stats_service,
+)
+
+
+def _queue_demand(pipe, *demand):
+    buffer = StatsBuffer()
+    for icecream_id, name, quantity, buyer_id in demand:
+        buffer.add_demand(
+            icecream_id,
+            name=name,
+            quantity=quantity,
+            revenue=quantity * 1.5,
+            buyer_id=buyer_id,
+        )
+    stats_service.queue_stats(pipe, buffer, now=datetime.now(timezone.utc))
+
+
+def test_queue_time_buckets(mocker):
+    pipe = mocker.MagicMock()
+    _queue_demand(pipe, (1, "Vanilla", 2, 1), (1, "Vanilla", 3, 2))
+
+    # Demand is counted all-time and in the current hour and day buckets.
+    keys = [call.args[0] for call in pipe.zincrby.call_args_list]
+    assert keys[0] == "POPULAR_ICECREAM"
+    assert keys[1].startswith("POPULAR_ICECREAM:H:")
+    assert keys[2].startswith("POPULAR_ICECREAM:D:")
+    assert all(call.args[1:] == (5, 1) for call in pipe.zincrby.call_args_list)
+    assert {call.args[0] for call in pipe.expire.call_args_list} == set(keys[1:])
+    pipe.hset.assert_called_once_with("ICECREAM_NAMES", mapping={1: "Vanilla"})
+
+
+def test_queue_revenue_and_buyers(mocker):
+    pipe = mocker.MagicMock()
+    _queue_demand(
+        pipe, (1, "Vanilla", 2, 1), (2, "Chocolate", 4, 1), (1, "Vanilla", 2, 2)
+    )
+
+    revenue_keys = {call.args[0] for call in pipe.hincrbyfloat.call_args_list}
+    assert len(revenue_keys) == 1
+    assert revenue_keys.pop().startswith("ICECREAM_REVENUE:D:")
+    revenue = {call.args[1]: call.args[2] for call in pipe.hincrbyfloat.call_args_list}
+    assert revenue == {"1": 6.0, "2": 6.0}
+    pipe.pfadd.assert_any_call("ICECREAM_BUYERS:1", 1, 2)
+    pipe.pfadd.assert_any_call("ICECREAM_BUYERS:2", 1)
+
+
+@pytest.mark.anyio
+async def test_read_revenue_and_buyers(redis_client):
+    redis_client.hgetall.return_value = {b"1": b"6.5", b"2": b"12"}
+    redis_client.hmget.return_value = [b"Chocolate", b"Vanilla"]
+    revenue = await stats_service.get_icecream_revenue(date(2024, 10, 16))
+    assert revenue == OrderedDict([("Chocolate", 12.0), ("Vanilla", 6.5)])
+    redis_client.hgetall.assert_awaited_once_with("ICECREAM_REVENUE:D:20241016")
+
+    redis_client.pfcount.return_value = 42
+    assert await stats_service.count_icecream_buyers(1) == 42
+    redis_client.pfcount.assert_awaited_once_with("ICECREAM_BUYERS:1")
+
+
+@pytest.mark.parametrize(
+    "window, buckets", [(StatsWindow.HOUR, 2), (StatsWindow.DAY, 25)]
+)
+@pytest.mark.anyio
+async def test_get_top_icecream_window(redis_client, window, buckets):
+    redis_client.exists.return_value = 0
+    redis_client.zrevrange.return_value = [(b"2", 20.0), (b"1", 10.0)]
+    redis_client.hmget.return_value = [b"Chocolate", b"Vanilla"]
+
+    top_ice = await stats_service.get_top_icecream(2, window=window)
+    assert top_ice == OrderedDict([("Chocolate", 20.0), ("Vanilla", 10.0)])
+    redis_client.hmget.assert_awaited_once_with("ICECREAM_NAMES", ["2", "1"])
+
+    # The window ranking is computed out of its time buckets and cached briefly.
+    #  (the current one being partial, along with an extra one)
+    pipe = redis_client.pipeline.return_value
+    window_key, bucket_keys = pipe.zunionstore.call_args.args
+    assert window_key.startswith(f"POPULAR_ICECREAM:{window.value}:")
+    assert len(bucket_keys) == buckets
+    redis_client.zrevrange.assert_awaited_once_with(window_key, 0, 1, withscores=True)
+
+    # Already computed rankings are just read.
+    redis_client.exists.return_value = 1
+    await stats_service.get_top_icecream(2, window=window)
+    pipe.zunionstore.assert_called_once()
+
+
+@pytest.mark.anyio
+async def test_migrate_popularity(redis_server, mocker):
+    mocker.patch.object(stats_service, "_client", redis_server)
+    mocker.patch.object(StatsService, "POPULARITY_KEY", "TEST_POPULAR_ICECREAM")
+    mocker.patch.object(StatsService, "NAMES_KEY", "TEST_ICECREAM_NAMES")
+    # Products counted both under their names and IDs, or only one way.
+    await redis_server.zadd(
+        StatsService.POPULARITY_KEY, {"Vanilla:1": 10, "1": 5, "2": 7, "Mint:3": 1}
+    )
+    await redis_server.hset(StatsService.NAMES_KEY, "2", "Chocolate")
+    try:
+        assert await stats_service.migrate_popularity() == 2
+        assert await stats_service.migrate_popularity() == 0
+        top_ice = await stats_service.get_top_icecream(3)
+    finally:
+        await redis_server.delete(StatsService.POPULARITY_KEY, StatsService.NAMES_KEY)
+
+    assert top_ice == OrderedDict(
+        [("Vanilla", 15.0), ("Chocolate", 7.0), ("Mint", 1.0)]
+    )
+
+
+@pytest.fixture
+def top_icecream_cache():
+    top_icecream_cache = stats_routes.get_top_icecream_cache()
+    top_icecream_cache.clear()
+    yield top_icecream_cache
+    top_icecream_cache.clear()
+
+
+@pytest.mark.anyio
+async def test_get_top_icecream(redis_client, top_icecream_cache, client):
+    redis_client.zrevrange.return_value = [(b"2", 20.0), (b"1", 10.0)]
+    redis_client.hmget.return_value = [b"Chocolate", b"Vanilla"]
+
+    # A burst of identical requests ends up in a single Redis query.
+    responses = await asyncio.gather(
+        *(client.get("/v1/stats/top", params={"size": 2}) for _ in range(5))
+    )
+    for response in responses:
+        assert response.status_code == 200
+        assert response.json() == [
+            {"name": "Chocolate", "quantity": 20},
+            {"name": "Vanilla", "quantity": 10},
+        ]
+    redis_client.zrevrange.assert_awaited_once()
+
+    # While different parameters are queried separately.
+    response = await client.get("/v1/stats/top", params={"size": 1})
+    assert response.status_code == 200
+    assert redis_client.zrevrange.await_count == 2
+
+
+@pytest.mark.anyio
+async def test_get_top_icecream_unavailable(redis_client, top_icecream_cache, client):
+    redis_client.zrevrange.side_effect = RedisConnectionError
+    response = await client.get("/v1/stats/top", params={"window": "DAY"})
+    assert response.status_code == 503
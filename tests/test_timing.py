@@ -0,0 +1,49 @@
+import pytest
+
+from deep_ice.core.config import settings
+from deep_ice.core.timing import ServerTimingMiddleware
+from deep_ice.models import PaymentMethod
+
+
+def _parse_server_timing(header: str) -> dict[str, float]:
+    stages = {}
+    for metric in header.split(", "):
+        name, duration = metric.split(";dur=")
+        stages[name] = float(duration)
+    return stages
+
+
+@pytest.mark.anyio
+async def test_payment_server_timing(
+    redis_client, auth_client, cart_items, mocker, caplog
+):
+    mocker.patch.object(settings, "SERVER_TIMING_SAMPLE_RATE", 1.0)
+    response = await auth_client.post(
+        "/v1/payments", json={"method": PaymentMethod.CARD.value}
+    )
+    assert response.status_code == 202
+
+    # Every checkout stage gets timed, within the total time of the request.
+    stages = _parse_server_timing(response.headers[ServerTimingMiddleware.HEADER])
+    expected = {
+        "jwt",
+        "user",
+        "cart",
+        "admission",
+        "lock",
+        "stock",
+        "order",
+        "payment",
+        "enqueue",
+    }
+    assert set(stages) == expected | {"total"}
+    assert all(stages[stage] <= stages["total"] for stage in expected)
+    assert "POST /v1/payments 202 timing: jwt=" in caplog.text
+
+
+@pytest.mark.anyio
+async def test_server_timing_not_sampled(auth_client, mocker):
+    mocker.patch.object(settings, "SERVER_TIMING_SAMPLE_RATE", 0.0)
+    response = await auth_client.get("/v1/cart")
+    assert response.status_code == 200
+    assert ServerTimingMiddleware.HEADER not in response.headers